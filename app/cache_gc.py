@@ -0,0 +1,401 @@
+"""
+Garbage collection and compaction for the metadata cache database.
+
+Cached rows outlive their files whenever images are deleted, moved or renamed
+outside of yipyap, and derivative blobs outlive the last path referencing
+them. This module drops that dead weight and hands the freed pages back to the
+file system.
+
+A collection pass:
+1. Walks image_info in primary key order, one batch per transaction, and drops
+   rows whose file is gone or that are marked deleted, with their captions.
+   A file only counts as gone when a listing confirms it, so an unmounted
+   share or a listing error never costs rows (favorites live only here).
+2. Drops persisted directory listings of directories that no longer exist
+3. Drops derivatives and integrity outcomes no cached path references
+   anymore, once they are older than a grace period (a thumbnail may be
+   requested, or a file verified, before its path is cached)
+4. Runs an incremental vacuum and reports the bytes reclaimed
+
+In-memory indexes built from these rows (the tag index, folder tree and
+perceptual hash index) are told what was dropped through an on_remove
+callback, see Removed.
+
+It runs on a schedule inside the server, through `POST /api/cache/gc`, or from
+the command line:
+    ```bash
+    python -m app.cache_gc --db cache.db --root /path/to/dataset
+    ```
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, List, Optional, Tuple, Union
+
+from .cache_schema import migrate
+from .db import ConnectionManager
+
+logger = logging.getLogger("uvicorn.error")
+
+GC_BATCH_SIZE = 1000  # image_info rows checked per transaction
+DERIVATIVE_GRACE_PERIOD = 3600.0  # seconds before unreferenced blobs are dropped
+
+_gc_lock = threading.Lock()
+
+
+@dataclass
+class GCReport:
+    """
+    Outcome of a garbage collection pass.
+
+    Attributes:
+        images_scanned (int): image_info rows checked
+        images_removed (int): Rows of missing or deleted images dropped
+        captions_removed (int): Caption rows dropped with them or orphaned
+        listings_removed (int): Persisted listings of missing directories
+        derivatives_removed (int): Unreferenced derivative sets dropped
+        integrity_removed (int): Unreferenced integrity outcomes dropped
+        bytes_reclaimed (int): Shrinkage of the database file
+        duration (float): Seconds the pass took
+    """
+
+    images_scanned: int = 0
+    images_removed: int = 0
+    captions_removed: int = 0
+    listings_removed: int = 0
+    derivatives_removed: int = 0
+    integrity_removed: int = 0
+    bytes_reclaimed: int = 0
+    duration: float = 0.0
+
+
+@dataclass
+class Removed:
+    """
+    Cache entries dropped by a pass, for in-memory indexes built from them.
+
+    Attributes:
+        images (List[Tuple[str, str]]): (directory, name) of dropped image rows
+        directories (List[str]): Directories found missing
+        fingerprints (List[str]): Fingerprints whose derivatives were dropped
+    """
+
+    images: List[Tuple[str, str]] = field(default_factory=list)
+    directories: List[str] = field(default_factory=list)
+    fingerprints: List[str] = field(default_factory=list)
+
+
+def _notify(on_remove: Optional[Callable[[Removed], None]], removed: Removed):
+    if on_remove is None:
+        return
+    try:
+        on_remove(removed)
+    except Exception as e:
+        logger.error(f"Error updating indexes after cache garbage collection: {e}")
+
+
+def _database_size(db: ConnectionManager) -> int:
+    with db.reader() as conn:
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+class _DirectoryNames:
+    """
+    Names in a directory, listed once per directory instead of a stat per file.
+
+    Args:
+        root_dir (str): Dataset root, directories outside of it are never
+            considered gone
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = os.path.abspath(root_dir)
+        self.directory = None
+        self.names: Optional[frozenset] = None
+        self.gone = False
+
+    def vanished(self, directory: str) -> bool:
+        """Whether an existing ancestor below root_dir lists without `directory`."""
+        child = os.path.abspath(directory)
+        if os.path.commonpath([self.root_dir, child]) != self.root_dir:
+            return False
+        while child != self.root_dir:
+            parent = os.path.dirname(child)
+            try:
+                return os.path.basename(child) not in os.listdir(parent)
+            except FileNotFoundError:
+                child = parent
+            except OSError:
+                return False
+        return False
+
+    def __call__(self, directory: str) -> Tuple[Optional[frozenset], bool]:
+        """
+        List a directory.
+
+        Returns:
+            Tuple[Optional[frozenset], bool]: Its names, None if it could not
+                be listed, and whether it is confirmed gone in that case
+        """
+        if directory != self.directory:
+            try:
+                self.names, self.gone = frozenset(os.listdir(directory)), False
+            except OSError as e:
+                self.names, self.gone = None, self.vanished(directory)
+                if not self.gone:
+                    logger.warning(f"Cannot list {directory}, keeping its rows: {e}")
+            self.directory = directory
+        return self.names, self.gone
+
+
+def _is_dead(
+    listed: _DirectoryNames, directory: str, name: str, deleted: int, favorite: int
+) -> bool:
+    """Whether an image row can be dropped, keeping it when in doubt."""
+    if deleted:
+        return True
+    names, gone = listed(directory)
+    if names is not None:
+        return name not in names
+    # Favorites live only in the database, a folder that vanished from its
+    # parent's listing is not proof enough to lose them
+    return gone and not favorite
+
+
+def _collect_images(
+    db: ConnectionManager,
+    listed: _DirectoryNames,
+    report: GCReport,
+    batch_size: int,
+    on_remove: Optional[Callable[[Removed], None]],
+):
+    last = ("", "")
+    while True:
+        with db.reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT directory, name, deleted, favorite_state FROM image_info
+                WHERE (directory, name) > (?, ?)
+                ORDER BY directory, name
+                LIMIT ?
+                """,
+                (*last, batch_size),
+            ).fetchall()
+        if not rows:
+            return
+        last = rows[-1][:2]
+        report.images_scanned += len(rows)
+
+        dead = [row[:2] for row in rows if _is_dead(listed, *row)]
+        if dead:
+            with db.writer() as conn:
+                report.images_removed += conn.executemany(
+                    "DELETE FROM image_info WHERE directory = ? AND name = ?", dead
+                ).rowcount
+                report.captions_removed += conn.executemany(
+                    "DELETE FROM image_caption WHERE directory = ? AND name = ?", dead
+                ).rowcount
+            _notify(on_remove, Removed(images=dead))
+
+
+def collect_garbage(
+    db: ConnectionManager,
+    root_dir: Union[str, os.PathLike],
+    batch_size: int = GC_BATCH_SIZE,
+    grace_period: float = DERIVATIVE_GRACE_PERIOD,
+    on_remove: Optional[Callable[[Removed], None]] = None,
+) -> GCReport:
+    """
+    Run a garbage collection and compaction pass over the cache database.
+
+    Args:
+        db (ConnectionManager): Connections to the cache database
+        root_dir (Union[str, os.PathLike]): Dataset root the cached rows
+            live under
+        batch_size (int): Rows checked per write transaction
+        grace_period (float): Minimum age in seconds of unreferenced
+            derivatives before they are dropped
+        on_remove (Optional[Callable[[Removed], None]]): Called with what
+            was dropped, once per batch of images and once for directories
+            and fingerprints
+
+    Returns:
+        GCReport: What was removed and how many bytes were reclaimed
+
+    Raises:
+        RuntimeError: If another pass is already running
+        FileNotFoundError: If root_dir is not a directory, e.g. an unmounted
+            share; nothing is dropped then
+
+    Notes:
+        - Short transactions keep queued cache fills and edits flowing while
+          a pass runs
+        - The first pass on a database created before incremental vacuum was
+          enabled converts it with a full VACUUM
+        - Rows are dropped only when their file is missing from a listing of
+          its directory, or their directory is missing from a listing of an
+          ancestor. Directories that fail to list otherwise keep their rows.
+    """
+    if not os.path.isdir(root_dir):
+        raise FileNotFoundError(f"Dataset root {root_dir} is not a directory")
+    if not _gc_lock.acquire(blocking=False):
+        raise RuntimeError("Cache garbage collection is already running")
+    try:
+        start = time.monotonic()
+        db.flush()  # Queued cache fills must be seen by the walk
+        size_before = _database_size(db)
+        report = GCReport()
+
+        listed = _DirectoryNames(os.fspath(root_dir))
+        _collect_images(db, listed, report, batch_size, on_remove)
+
+        with db.writer() as conn:
+            # Captions whose image row is gone, e.g. from older versions
+            report.captions_removed += conn.execute(
+                """
+                DELETE FROM image_caption
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM image_info AS i
+                    WHERE i.directory = image_caption.directory
+                    AND i.name = image_caption.name
+                )
+                """
+            ).rowcount
+
+        with db.reader() as conn:
+            listings = [
+                row[0]
+                for row in conn.execute("SELECT directory FROM directory_listing")
+            ]
+        missing = [(d,) for d in listings if listed.vanished(d)]
+        if missing:
+            with db.writer() as conn:
+                report.listings_removed = conn.executemany(
+                    "DELETE FROM directory_listing WHERE directory = ?", missing
+                ).rowcount
+
+        cutoff = int(time.time() - grace_period)
+        with db.writer() as conn:
+            fingerprints = [
+                row[0]
+                for row in conn.execute(
+                    """
+                    DELETE FROM image_derivative
+                    WHERE cache_time < ?
+                    AND md5sum NOT IN (
+                        SELECT md5sum FROM image_info WHERE md5sum IS NOT NULL
+                    )
+                    RETURNING md5sum
+                    """,
+                    (cutoff,),
+                )
+            ]
+            report.derivatives_removed = len(fingerprints)
+            report.integrity_removed = conn.execute(
+                """
+                DELETE FROM image_integrity
+                WHERE checked_time < ?
+                AND md5sum NOT IN (
+                    SELECT md5sum FROM image_info WHERE md5sum IS NOT NULL
+                )
+                """,
+                (cutoff,),
+            ).rowcount
+        _notify(
+            on_remove,
+            Removed(directories=[d for d, in missing], fingerprints=fingerprints),
+        )
+
+        with db.writer() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("Enabling incremental vacuum, rebuilding the database")
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # Each step frees one page; execute() would only step once
+                conn.executescript("PRAGMA incremental_vacuum;")
+            # Let the WAL file shrink back as well
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        report.bytes_reclaimed = max(0, size_before - _database_size(db))
+        report.duration = time.monotonic() - start
+        logger.info(f"Cache garbage collection finished: {asdict(report)}")
+        return report
+    finally:
+        _gc_lock.release()
+
+
+def start_scheduler(
+    db: ConnectionManager,
+    root_dir: Union[str, os.PathLike],
+    interval: float,
+    on_remove: Optional[Callable[[Removed], None]] = None,
+) -> threading.Thread:
+    """
+    Run collect_garbage every `interval` seconds in a daemon thread.
+
+    Args:
+        db (ConnectionManager): Connections to the cache database
+        root_dir (Union[str, os.PathLike]): Passed on to collect_garbage
+        interval (float): Seconds between passes, the first pass runs after
+            one interval
+        on_remove (Optional[Callable[[Removed], None]]): Passed on to
+            collect_garbage
+
+    Returns:
+        threading.Thread: The started scheduler thread
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                collect_garbage(db, root_dir, on_remove=on_remove)
+            except Exception as e:
+                logger.error(f"Scheduled cache garbage collection failed: {e}")
+
+    thread = threading.Thread(target=run, name="cache-gc", daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.cache_gc",
+        description="Drop stale rows and blobs from the yipyap cache database.",
+    )
+    parser.add_argument("--db", default="cache.db", help="Cache database path")
+    parser.add_argument(
+        "--root", default=os.getcwd(), help="Dataset root the cache describes"
+    )
+    parser.add_argument("--batch-size", type=int, default=GC_BATCH_SIZE)
+    parser.add_argument(
+        "--grace-period",
+        type=float,
+        default=DERIVATIVE_GRACE_PERIOD,
+        help="Seconds before unreferenced derivatives are dropped",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not os.path.exists(args.db):
+        parser.error(f"No cache database at {args.db}")
+    db = ConnectionManager(args.db)
+    with db.writer() as conn:
+        migrate(conn)
+    try:
+        report = collect_garbage(db, args.root, args.batch_size, args.grace_period)
+    finally:
+        db.close()
+    for field, value in asdict(report).items():
+        print(f"{field}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Schema and migrations of the metadata cache database.
+
+The schema version is stored in SQLite's `user_version` header field. Each
+entry of MIGRATIONS upgrades the database by one version; `migrate()` runs the
+missing ones in order inside the caller's transaction, so a fresh database and
+an old one end up with the same schema.
+
+Version history:
+1. Columnar image_info: file metadata (mtime, size, mime, md5sum, width,
+   height) in typed, indexed columns instead of a JSON blob, captions in the
+   image_caption child table, nullable derivatives. Databases created before
+   versioning (user_version 0 with a JSON `info` column) are converted.
+2. Content-addressed derivatives: thumbnails, previews and placeholders move
+   to image_derivative, keyed by the MD5 fingerprint of the file contents, so
+   byte-identical copies share one set of blobs. Requires SQLite 3.35 for
+   DROP COLUMN.
+3. Folder tree: one row per known directory with the mtime its
+   subdirectories were last listed at, see app.folder_tree.
+4. Folder statistics: image count, bytes, favorites and caption coverage of
+   the images directly inside each folder.
+5. Caption search: image_caption gets an explicit integer key, and the
+   caption_search FTS5 index over its captions is kept in sync by triggers,
+   see app.caption_search. Requires SQLite built with FTS5.
+6. Perceptual hashes: image_derivative gets the dHash of each fingerprint,
+   computed with the thumbnail and backfilled from stored thumbnails, see
+   app.duplicates.
+7. Image integrity: the outcome of strictly decoding each fingerprint, so
+   verification runs only decode new contents, see app.integrity.
+"""
+
+import json
+import logging
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _create_v1_tables(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE image_info (
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            mtime REAL,
+            size INTEGER,
+            mime TEXT,
+            md5sum TEXT,
+            width INTEGER,
+            height INTEGER,
+            cache_time INTEGER NOT NULL,
+            thumbnail_webp BLOB,
+            preview_webp BLOB,
+            placeholder TEXT,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            favorite_state INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (directory, name)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE image_caption (
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            caption_type TEXT NOT NULL,
+            caption TEXT NOT NULL,
+            PRIMARY KEY (directory, name, caption_type)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX image_info_mime ON image_info (mime)")
+    conn.execute("CREATE INDEX image_info_size ON image_info (size)")
+    conn.execute("CREATE INDEX image_info_dimensions ON image_info (width, height)")
+    conn.execute("CREATE INDEX image_info_md5sum ON image_info (md5sum)")
+
+
+def _migrate_legacy_favorites(rows: list) -> dict:
+    """Read `.favorite` sidecar files of databases that predate favorite_state."""
+    favorites = {}
+    for directory, name in rows:
+        favorite_path = Path(directory) / f"{Path(name).stem}.favorite"
+        try:
+            if favorite_path.exists():
+                favorites[(directory, name)] = int(favorite_path.read_text().strip())
+                favorite_path.unlink()  # Delete the file after migration
+        except (ValueError, IOError) as e:
+            logger.warning(
+                f"Error migrating favorite state for {directory}/{name}: {e}"
+            )
+    return favorites
+
+
+def _migrate_v1(conn: sqlite3.Connection):
+    """Create the columnar schema, converting a JSON-blob image_info table."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS directory_listing (
+            directory TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            listing JSON NOT NULL
+        )
+        """
+    )
+
+    legacy_columns = _table_columns(conn, "image_info")
+    if not legacy_columns:
+        _create_v1_tables(conn)
+        return
+
+    logger.info("Migrating image_info from JSON blobs to typed columns")
+    conn.execute("ALTER TABLE image_info RENAME TO image_info_legacy")
+    _create_v1_tables(conn)
+
+    optional = [
+        c
+        for c in ("placeholder", "preview_webp", "favorite_state")
+        if c in legacy_columns
+    ]
+    rows = conn.execute(
+        f"""
+        SELECT directory, name, info, cache_time, thumbnail_webp, deleted
+        {"".join(f", {c}" for c in optional)}
+        FROM image_info_legacy
+        """
+    ).fetchall()
+
+    favorites = {}
+    if "favorite_state" not in legacy_columns:
+        favorites = _migrate_legacy_favorites([row[:2] for row in rows])
+
+    images, captions = [], []
+    for row in rows:
+        directory, name, info, cache_time, thumbnail, deleted = row[:6]
+        extra = dict(zip(optional, row[6:]))
+        try:
+            info = json.loads(info)
+        except (TypeError, ValueError):
+            info = {}
+        mtime = info.get("mtime")
+        if mtime is not None:
+            mtime = datetime.fromisoformat(mtime.replace("Z", "+00:00")).timestamp()
+        images.append(
+            (
+                directory,
+                name,
+                mtime,
+                info.get("size"),
+                info.get("mime"),
+                info.get("md5sum"),
+                info.get("width"),
+                info.get("height"),
+                cache_time,
+                thumbnail or None,
+                extra.get("preview_webp"),
+                extra.get("placeholder"),
+                deleted,
+                extra.get("favorite_state", favorites.get((directory, name), 0)),
+            )
+        )
+        for caption_type, caption in info.get("captions", []):
+            captions.append((directory, name, caption_type, caption))
+
+    conn.executemany(
+        """
+        INSERT INTO image_info
+        (directory, name, mtime, size, mime, md5sum, width, height, cache_time,
+         thumbnail_webp, preview_webp, placeholder, deleted, favorite_state)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        images,
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO image_caption VALUES (?, ?, ?, ?)", captions
+    )
+    conn.execute("DROP TABLE image_info_legacy")
+    logger.info(f"Migrated {len(images)} cached images, {len(captions)} captions")
+
+
+def _migrate_v2(conn: sqlite3.Connection):
+    """Move derivatives out of image_info into a fingerprint-keyed table."""
+    conn.execute(
+        """
+        CREATE TABLE image_derivative (
+            md5sum TEXT PRIMARY KEY,
+            width INTEGER,
+            height INTEGER,
+            mime TEXT,
+            thumbnail_webp BLOB,
+            preview_webp BLOB,
+            placeholder TEXT,
+            cache_time INTEGER NOT NULL
+        )
+        """
+    )
+    # The newest copy of each fingerprint wins
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO image_derivative
+        SELECT md5sum, width, height, mime, thumbnail_webp, preview_webp,
+               placeholder, cache_time
+        FROM image_info
+        WHERE md5sum IS NOT NULL
+        ORDER BY cache_time DESC
+        """
+    )
+    # Rows that only held derivatives have no fingerprint to key them by
+    conn.execute("DELETE FROM image_info WHERE md5sum IS NULL")
+    for column in ("thumbnail_webp", "preview_webp", "placeholder"):
+        conn.execute(f"ALTER TABLE image_info DROP COLUMN {column}")
+
+
+def _migrate_v3(conn: sqlite3.Connection):
+    """Add the persisted folder tree."""
+    conn.execute(
+        """
+        CREATE TABLE folder (
+            directory TEXT PRIMARY KEY,
+            mtime REAL
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _migrate_v4(conn: sqlite3.Connection):
+    """Add per-folder statistics, filled in as folders are listed again."""
+    for column in ("images INTEGER", "bytes INTEGER", "favorites INTEGER"):
+        conn.execute(f"ALTER TABLE folder ADD COLUMN {column}")
+    conn.execute("ALTER TABLE folder ADD COLUMN captions JSON")
+    # Folders listed without statistics have to be listed again
+    conn.execute("UPDATE folder SET mtime = NULL")
+
+
+def _migrate_v5(conn: sqlite3.Connection):
+    """Index captions for full-text search."""
+    # The index refers to captions by rowid, which VACUUM may renumber unless
+    # it is an explicit INTEGER PRIMARY KEY
+    conn.execute("ALTER TABLE image_caption RENAME TO image_caption_v4")
+    conn.execute(
+        """
+        CREATE TABLE image_caption (
+            id INTEGER PRIMARY KEY,
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            caption_type TEXT NOT NULL,
+            caption TEXT NOT NULL,
+            UNIQUE (directory, name, caption_type)
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO image_caption (directory, name, caption_type, caption)
+        SELECT directory, name, caption_type, caption FROM image_caption_v4
+        """
+    )
+    conn.execute("DROP TABLE image_caption_v4")
+
+    # External content: the index stores no copy of the captions
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE caption_search USING fts5(
+            caption,
+            content = 'image_caption',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+        """
+    )
+    conn.execute("INSERT INTO caption_search (caption_search) VALUES ('rebuild')")
+    # Every write path goes through image_caption, including REPLACE conflict
+    # resolution, which fires the delete trigger since app.db enables
+    # recursive_triggers
+    conn.execute(
+        """
+        CREATE TRIGGER image_caption_insert AFTER INSERT ON image_caption BEGIN
+            INSERT INTO caption_search (rowid, caption)
+            VALUES (new.id, new.caption);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER image_caption_delete AFTER DELETE ON image_caption BEGIN
+            INSERT INTO caption_search (caption_search, rowid, caption)
+            VALUES ('delete', old.id, old.caption);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER image_caption_update AFTER UPDATE OF caption ON image_caption
+        BEGIN
+            INSERT INTO caption_search (caption_search, rowid, caption)
+            VALUES ('delete', old.id, old.caption);
+            INSERT INTO caption_search (rowid, caption)
+            VALUES (new.id, new.caption);
+        END
+        """
+    )
+
+
+def _migrate_v6(conn: sqlite3.Connection):
+    """Add perceptual hashes, filled in by app.duplicates.HashIndex."""
+    conn.execute("ALTER TABLE image_derivative ADD COLUMN dhash INTEGER")
+
+
+def _migrate_v7(conn: sqlite3.Connection):
+    """Add verification outcomes, written by app.integrity.IntegrityVerifier."""
+    conn.execute(
+        """
+        CREATE TABLE image_integrity (
+            md5sum TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            error TEXT,
+            checked_time INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+
+
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Bring the cache database up to SCHEMA_VERSION.
+
+    Args:
+        conn (sqlite3.Connection): Write connection, the caller commits
+
+    Raises:
+        RuntimeError: If the database was written by a newer version
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Cache database schema version {version} is newer than supported "
+            f"version {SCHEMA_VERSION}, delete it or upgrade yipyap"
+        )
+    if version < SCHEMA_VERSION and not conn.in_transaction:
+        # DDL does not open a transaction implicitly, keep each upgrade atomic
+        conn.execute("BEGIN")
+    for number in range(version, SCHEMA_VERSION):
+        logger.info(f"Migrating cache database to schema version {number + 1}")
+        MIGRATIONS[number](conn)
+        conn.execute(f"PRAGMA user_version = {number + 1}")
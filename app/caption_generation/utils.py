@@ -3,35 +3,30 @@ Utility functions for caption generation.
 
 This module provides common utility functions used by multiple caption generators,
 including:
-- Running CPU-bound tasks in a thread pool
+- Running CPU-bound tasks on the inference executor
 - Image loading and preprocessing utilities
 - Error handling helpers
 """
 
-import asyncio
-import functools
 import logging
 import importlib
-from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Callable, Any, TypeVar, cast
 
-logger = logging.getLogger("uvicorn.error")
+from .. import executors
 
-# Create a global thread pool executor for CPU-bound operations
-# Using max_workers=None will use the default based on CPU count
-_executor = ThreadPoolExecutor(max_workers=None)
+logger = logging.getLogger("uvicorn.error")
 
 T = TypeVar("T")
 
 
 async def run_in_executor(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
     """
-    Run a CPU-bound function in a thread pool executor.
+    Run a CPU-bound function on the inference executor.
 
     This function allows running blocking CPU-bound code without blocking the
-    event loop. It's particularly useful for ML model inference and image
-    processing operations.
+    event loop. Model inference gets its own concurrency limit (see
+    app.executors), so a captioning burst does not starve browsing.
 
     Args:
         func: The function to run
@@ -49,16 +44,7 @@ async def run_in_executor(func: Callable[..., T], *args: Any, **kwargs: Any) ->
         result = await run_in_executor(process_image, image_path)
         ```
     """
-    loop = asyncio.get_event_loop()
-
-    # Handle both normal functions and instance methods
-    if kwargs:
-        # If we have kwargs, wrap the function call
-        wrapped = functools.partial(func, *args, **kwargs)
-        return await loop.run_in_executor(_executor, wrapped)
-    else:
-        # Without kwargs, we can call directly (more efficient)
-        return await loop.run_in_executor(_executor, func, *args)
+    return await executors.run("inference", func, *args, **kwargs)
 
 
 def is_module_available(module_name: str) -> bool:
@@ -0,0 +1,165 @@
+"""
+Full-text search over cached captions.
+
+Captions live in the image_caption table of the cache database, one row per
+image and caption type. The caption_search FTS5 index (schema version 5, see
+app.cache_schema) covers them and is kept in sync by triggers, so every path
+writing captions updates it in the same transaction:
+- Image info cache fills and caption edits, through the browse and caption
+  endpoints
+- Directory scans, which cache the captions of new and changed images (see
+  CachedFileSystemDataSource._index_captions)
+- Moves, deletions and garbage collection of cached rows
+
+Queries are ranked with BM25 and collapsed to one hit per image, scored by its
+best matching caption. Scoring visits every match, so queries matching more
+than SEARCH_RANK_LIMIT captions (e.g. a tag half the dataset carries) are
+returned in path order instead. The query syntax is deliberately small:
+- Every word has to match as a whole token
+- "quoted words" match as a phrase
+- A trailing * matches a prefix, e.g. `fox*`
+- A leading - excludes images matching the word or phrase in any of their
+  captions
+"""
+
+import re
+import sqlite3
+from typing import List, Optional, Tuple
+
+# Words, quoted phrases and their prefix and exclusion markers. Commas
+# separate words as well, so tag lists can be pasted as queries.
+_TERM = re.compile(r'(-?)(?:"([^"]*)"|([^\s,"]+))(\*?)')
+
+# Matching captions above which results are sorted by path instead of rank
+SEARCH_RANK_LIMIT = 20000
+
+
+def _quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def match_expression(query: str) -> Tuple[str, Optional[str]]:
+    """
+    Translate a user query into FTS5 MATCH expressions.
+
+    Args:
+        query (str): Words, "phrases", prefix* and -excluded terms
+
+    Returns:
+        Tuple[str, Optional[str]]: MATCH expression of the required terms,
+            and one matching any excluded term, None without exclusions.
+            Every term is quoted so user input cannot inject FTS5 operators.
+
+    Raises:
+        ValueError: If the query has no term to match
+    """
+    include, exclude = [], []
+    for minus, phrase, word, star in _TERM.findall(query):
+        text = phrase if phrase else word
+        # Trailing stars of a word belong to the prefix marker
+        if word and word.endswith("*"):
+            text, star = word.rstrip("*"), "*"
+        if not text.strip():
+            continue
+        term = _quote(text) + star
+        (exclude if minus else include).append(term)
+    if not include:
+        raise ValueError("Search query has no terms to match")
+    return " AND ".join(include), " OR ".join(exclude) or None
+
+
+def search_captions(
+    conn: sqlite3.Connection,
+    expression: str,
+    limit: int,
+    offset: int = 0,
+    caption_type: Optional[str] = None,
+    subtree: Optional[Tuple[str, str, str]] = None,
+    exclude: Optional[str] = None,
+) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Find cached images whose captions match, best first.
+
+    Args:
+        conn (sqlite3.Connection): Read connection to the cache database
+        expression (str): FTS5 MATCH expression, see match_expression
+        limit (int): Maximum number of hits to return
+        offset (int): Hits to skip, for pagination
+        caption_type (Optional[str]): Only search captions of this type, e.g.
+            "txt" or "tags"
+        subtree (Optional[Tuple[str, str, str]]): Only search below a
+            directory, parameters of app.data_access.SUBTREE_WHERE
+        exclude (Optional[str]): FTS5 MATCH expression of excluded terms,
+            an image is skipped if any of its searched captions matches it
+
+    Returns:
+        Tuple[int, List[Tuple[str, str]]]: Number of matching images, and
+            the (directory, name) of the requested page of them
+
+    Raises:
+        sqlite3.OperationalError: If an expression is malformed
+
+    Notes:
+        - Images marked deleted are skipped
+        - Ties are broken by path, so pages are stable
+        - Results are in path order if more than SEARCH_RANK_LIMIT captions
+          match
+    """
+    # Counting matches without scoring them only reads the index
+    matched = conn.execute(
+        "SELECT count(*) FROM caption_search WHERE caption_search MATCH ?",
+        (expression,),
+    ).fetchone()[0]
+    if not matched:
+        return 0, []
+    score = "caption_search.rank" if matched <= SEARCH_RANK_LIMIT else "0.0"
+
+    where = ["caption_search MATCH ?", "NOT i.deleted"]
+    params: list = [expression]
+    if caption_type:
+        where.append("c.caption_type = ?")
+        params.append(caption_type)
+    if subtree:
+        where.append("(c.directory = ? OR (c.directory >= ? AND c.directory < ?))")
+        params.extend(subtree)
+    if exclude:
+        # Exclusions apply per image, not to the matching caption only
+        excluded = """
+            NOT EXISTS (
+                SELECT 1 FROM caption_search
+                JOIN image_caption AS x ON x.id = caption_search.rowid
+                WHERE caption_search MATCH ?
+                AND x.directory = c.directory AND x.name = c.name
+        """
+        params.append(exclude)
+        if caption_type:
+            excluded += " AND x.caption_type = ?"
+            params.append(caption_type)
+        where.append(excluded + ")")
+    matches = f"""
+        SELECT c.directory, c.name, {score} AS score
+        FROM caption_search
+        JOIN image_caption AS c ON c.id = caption_search.rowid
+        JOIN image_info AS i ON i.directory = c.directory AND i.name = c.name
+        WHERE {" AND ".join(where)}
+    """
+    hits = conn.execute(
+        f"""
+        SELECT directory, name, min(score) AS best,
+               count(*) OVER () AS total
+        FROM ({matches})
+        GROUP BY directory, name
+        ORDER BY best, directory, name
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit, offset),
+    ).fetchall()
+    if hits:
+        total = hits[0][3]
+    else:
+        # Past the last page the window count comes back without rows
+        total = conn.execute(
+            f"SELECT count(*) FROM (SELECT 1 FROM ({matches}) GROUP BY directory, name)",
+            params,
+        ).fetchone()[0]
+    return total, [(directory, name) for directory, name, *_ in hits]
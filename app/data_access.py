@@ -1,27 +1,63 @@
 import logging
 import hashlib
+import os
+import time
 import threading
 import sqlite3
 import json
-from io import BytesIO
 from collections import defaultdict
 from pathlib import Path
-from stat import S_ISDIR, S_ISREG
-from typing import Dict, Optional, List, Tuple
+from typing import AsyncIterator, Dict, Iterable, Optional, List, Sequence, Tuple
 from datetime import datetime, timezone
 import asyncio
+import itertools
+from bisect import bisect_left
 import aiofiles
 from natsort import os_sort_keygen as natsort_keygen
-import magic
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pillow_jxl
 
-from .drhead_loader import open_srgb
+from .cache_gc import Removed
+from .cache_schema import migrate
+from .db import ConnectionManager
+from .derivatives import Derivatives, generate_derivatives
+from .duplicates import HashIndex, dhash_thumbnail, to_signed, to_unsigned
+from . import executors
+from .caption_search import match_expression, search_captions
+from .folder_tree import FolderTree
+from .integrity import IntegrityVerifier
+from .tag_index import TagIndex
+from .directory_cache import (
+    DIRECTORY_CACHE_BYTES,
+    DirectoryCache,
+    DirectoryListing,
+    ImageEntry,
+    to_datetime,
+)
+from .remote_fs import ExpiringCache
 from .models import ImageModel, DirectoryModel, BrowseHeader
 
 logger = logging.getLogger("uvicorn.error")
 
+# Natural sort order of listings
+_NAME_ORDER = natsort_keygen()
+
+
+def _find_image(listing: DirectoryListing, name: str) -> Optional[ImageEntry]:
+    """Find an image of a listing by name, relying on its natural sort order."""
+    images = listing.images
+    key = _NAME_ORDER(name)
+    i = bisect_left(images, key, key=lambda entry: _NAME_ORDER(entry.name))
+    while i < len(images) and _NAME_ORDER(images[i].name) == key:
+        if images[i].name == name:
+            return images[i]
+        i += 1
+    return None
+
+
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".jxl", ".avif"}
 CAPTION_EXTENSIONS = {".caption", ".txt", ".tags", ".florence", ".wd"}
 METADATA_EXTENSIONS = set()
@@ -33,6 +69,114 @@ try:
 except ImportError:
     pass
 
+SCANNED_EXTENSIONS = IMAGE_EXTENSIONS | CAPTION_EXTENSIONS | METADATA_EXTENSIONS
+
+# Directory scans stat entries sequentially below this count, and in batches of
+# this size on the stat pool above it. The pool is separate from the io
+# workload (see app.executors) since scans themselves run on io workers, and
+# waiting on batches queued behind them in the same pool could deadlock.
+STAT_BATCH_SIZE = 512
+_stat_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stat")
+
+# Primary key of the image_info table, and the values columns take when a row
+# only exists as a queued write-behind update
+IMAGE_INFO_KEY = ("directory", "name")
+IMAGE_INFO_DEFAULTS = {"deleted": 0, "favorite_state": 0}
+
+# Derivatives are stored once per content fingerprint (the MD5 of the file) in
+# image_derivative, and shared by every path with the same contents
+DERIVATIVE_KEY = ("md5sum",)
+DERIVATIVE_COLUMNS = (
+    "width",
+    "height",
+    "mime",
+    "thumbnail_webp",
+    "preview_webp",
+    "placeholder",
+)
+
+# image_info columns needed to build an ImageModel, "captions" is read from the
+# image_caption child table (see CachedFileSystemDataSource._read_row)
+IMAGE_MODEL_COLUMNS = (
+    "mtime",
+    "size",
+    "mime",
+    "md5sum",
+    "width",
+    "height",
+    "favorite_state",
+    "captions",
+)
+CAPTIONS_SELECT = """(
+    SELECT json_group_array(json_array(caption_type, caption))
+    FROM image_caption AS c
+    WHERE c.directory = image_info.directory AND c.name = image_info.name
+)"""
+
+# Tables keyed by directory that hold per-path cache state
+CACHE_TABLES = ("image_info", "image_caption", "directory_listing", "folder")
+
+# Matches a directory and all of its subdirectories as a primary key range
+# instead of a LIKE pattern, which cannot use the index and would also match
+# sibling directories sharing a prefix
+SUBTREE_WHERE = "(directory = ? OR (directory >= ? AND directory < ?))"
+
+
+def _subtree_range(directory: Path) -> Tuple[str, str, str]:
+    """
+    Parameters for SUBTREE_WHERE.
+
+    Args:
+        directory (Path): Root of the subtree
+
+    Returns:
+        Tuple[str, str, str]: The directory itself, and the bounds of all
+            paths below it ("/" sorts right before "0")
+    """
+    base = str(directory).rstrip("/")
+    return str(directory), base + "/", base + "0"
+
+
+# Image info jobs each browse stream keeps queued or running at most
+BROWSE_WINDOW = 16
+
+
+def _stat_batch(entries: List[os.DirEntry]) -> List[Optional[os.stat_result]]:
+    stats = []
+    for entry in entries:
+        try:
+            stats.append(entry.stat())
+        except OSError:
+            stats.append(None)
+    return stats
+
+
+def _stat_entries(entries: List[os.DirEntry]) -> List[Optional[os.stat_result]]:
+    """
+    Stat directory entries, in parallel batches for large directories.
+
+    Args:
+        entries (List[os.DirEntry]): Entries from os.scandir
+
+    Returns:
+        List[Optional[os.stat_result]]: Stat results in entry order, None for
+            entries that could not be stat'ed (e.g. deleted since the scan)
+
+    Notes:
+        - Follows symlinks like Path.stat()
+        - DirEntry caches its stat result, later calls are free
+    """
+    if len(entries) <= STAT_BATCH_SIZE:
+        return _stat_batch(entries)
+    batches = [
+        entries[i : i + STAT_BATCH_SIZE]
+        for i in range(0, len(entries), STAT_BATCH_SIZE)
+    ]
+    stats = []
+    for batch_stats in _stat_executor.map(_stat_batch, batches):
+        stats.extend(batch_stats)
+    return stats
+
 
 class ImageDataSource:
     """Abstract interface for image data access"""
@@ -126,26 +270,42 @@ class CachedFileSystemDataSource(ImageDataSource):
     - Image metadata and thumbnails are cached in SQLite with the full directory path and filename as key
     - Directory listings are cached in memory temporarily (cleared when contents change)
     - Cache entries include:
-        - Image metadata as JSON (size, dimensions, captions etc)
+        - Image metadata in typed columns (mtime, size, MIME, MD5, dimensions)
+        - Captions, one row per caption type in the image_caption table
         - WebP thumbnail blob
+        - Placeholder color computed alongside the thumbnail
         - Cache timestamp
         - Soft delete flag
     - Cache invalidation occurs:
-        - When images are modified (checked via mtime)
+        - When images are modified (checked via recorded mtime and size)
         - When images or captions are deleted
         - When directory contents change
 
     Notes:
     - Directory paths stored in the database are full absolute paths (root_dir + relative path)
-    - Each thread gets its own SQLite connection to avoid threading issues
+    - Connections come from a shared pool with a single writer, see app.db
     - Soft deletion is supported - deleted images are marked but kept in cache
-    - The cache uses a busy timeout to handle concurrent access
+    - The database runs in WAL mode, so reads never wait for writes
+    - The schema is versioned and migrated on startup, see app.cache_schema
+
+    Remote file system mode (for NFS and similar mounts):
+    - Directory listings are persisted in SQLite and served without touching the
+      file system, then revalidated in the background once they are older than
+      `revalidate_interval`
+    - Paths found missing are remembered for `negative_ttl` seconds
+    - Cache misses read each image once, hashing and decoding from memory
 
     Args:
         root_dir (Path): Base directory for all images
         thumbnail_size (tuple[int, int]): Max width/height for thumbnails
         preview_size (tuple[int, int]): Max width/height for preview images
         db_path (str, optional): Path to SQLite database file. Defaults to "cache.db"
+        remote_fs (bool, optional): Enable remote file system mode
+        revalidate_interval (float, optional): Seconds before a served listing is
+            revalidated in remote mode
+        negative_ttl (float, optional): Seconds a missing path is remembered
+        directory_cache_bytes (int, optional): Memory budget of the in-memory
+            directory listings
     """
 
     def __init__(
@@ -154,83 +314,40 @@ class CachedFileSystemDataSource(ImageDataSource):
         thumbnail_size: tuple[int, int],
         preview_size: tuple[int, int],
         db_path: str = "cache.db",
+        remote_fs: bool = False,
+        revalidate_interval: float = 30.0,
+        negative_ttl: float = 60.0,
+        directory_cache_bytes: int = DIRECTORY_CACHE_BYTES,
     ):
         self.root_dir = root_dir
         self.thumbnail_size = thumbnail_size
         self.preview_size = preview_size
         self.db_path = db_path
-        self.db_connnections = {}
+        self.db = ConnectionManager(db_path)
         self._init_db()
-        self.directory_cache = {}
+        self.remote_fs = remote_fs
+        self.revalidate_interval = revalidate_interval
+        # Remote mode state: last validation time per cached directory, the
+        # directories being revalidated and paths known to be missing
+        self._validated_at: Dict[Path, float] = {}
+        self.directory_cache = DirectoryCache(
+            directory_cache_bytes,
+            on_evict=lambda directory: self._validated_at.pop(directory, None),
+        )
+        self._revalidating: set = set()
+        self._revalidate_lock = threading.Lock()
+        self.missing_paths = ExpiringCache(negative_ttl)
+        # Cache misses served from another path's derivatives since startup
+        self.reused_derivatives = 0
+        self.folder_tree = FolderTree(root_dir, self.db, self._scan_and_index)
+        self.tag_index = TagIndex(root_dir, self.db)
+        self.hash_index = HashIndex(self.db)
+        self.verifier = IntegrityVerifier(self.db, self._compute_md5)
 
     def _init_db(self):
         logger.info(f"Initializing database at {self.db_path}")
-        conn = self._get_connection()
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS image_info (
-                directory TEXT NOT NULL,
-                name TEXT NOT NULL,
-                info JSON NOT NULL,
-                cache_time INTEGER NOT NULL,
-                thumbnail_webp BLOB NOT NULL,
-                deleted INTEGER NOT NULL DEFAULT 0,
-                favorite_state INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (directory, name)
-            )
-            """
-        )
-        conn.commit()
-
-        # Add favorite_state column if it doesn't exist (for backwards compatibility)
-        try:
-            conn.execute("SELECT favorite_state FROM image_info LIMIT 1")
-        except sqlite3.OperationalError:
-            logger.info("Adding favorite_state column to image_info table")
-            conn.execute(
-                "ALTER TABLE image_info ADD COLUMN favorite_state INTEGER NOT NULL DEFAULT 0"
-            )
-            conn.commit()
-
-            # Migrate existing favorite states from files to SQLite
-            logger.info("Migrating existing favorite states to SQLite")
-            for directory, name in conn.execute(
-                "SELECT directory, name FROM image_info"
-            ).fetchall():
-                try:
-                    favorite_path = Path(directory) / f"{Path(name).stem}.favorite"
-                    if favorite_path.exists():
-                        with open(favorite_path, "r") as f:
-                            favorite_state = int(f.read().strip())
-                            conn.execute(
-                                "UPDATE image_info SET favorite_state = ? WHERE directory = ? AND name = ?",
-                                (favorite_state, directory, name),
-                            )
-                        favorite_path.unlink()  # Delete the file after migration
-                except (ValueError, IOError) as e:
-                    logger.warning(
-                        f"Error migrating favorite state for {directory}/{name}: {e}"
-                    )
-            conn.commit()
-
-    def _get_connection(self):
-        """
-        Get a thread-local SQLite connection.
-
-        Returns:
-            sqlite3.Connection: Database connection for current thread
-
-        Notes:
-            - Creates new connection if none exists for thread
-            - Sets busy timeout to handle concurrent access
-            - Caches connection in thread-local storage
-        """
-        thread_id = threading.get_ident()
-        conn = self.db_connnections.get(thread_id)
-        if conn is None:
-            self.db_connnections[thread_id] = conn = sqlite3.connect(self.db_path)
-            conn.execute("PRAGMA busy_timeout = 30000")
-        return conn
+        with self.db.writer() as conn:
+            migrate(conn)
 
     def _compute_md5(self, path: Path) -> str:
         """
@@ -255,244 +372,811 @@ class CachedFileSystemDataSource(ImageDataSource):
     async def get_thumbnail(self, path: Path) -> Optional[bytes]:
         """Get cached thumbnail WebP data."""
         try:
-            conn = self._get_connection()
-            directory = str(path.parent)
-            filename = path.name
-
-            # Get the exact matching thumbnail
-            result = conn.execute(
-                """
-                SELECT thumbnail_webp 
-                FROM image_info 
-                WHERE directory = ? 
-                AND name = ? 
-                AND deleted = 0
-                """,
-                (directory, filename),
-            ).fetchone()
-
-            if result and result[0]:
-                return result[0]
+            # Get the thumbnail of the cached fingerprint
+            row = self._cached_row(path.parent, path.name, "md5sum")
+            if row and not row["deleted"] and row["md5sum"]:
+                derivative = self._cached_derivative(row["md5sum"], "thumbnail_webp")
+                if derivative and derivative["thumbnail_webp"]:
+                    return derivative["thumbnail_webp"]
 
             # If not found or null, generate it
-            if not path.exists():
+            if self._known_missing(path) or not path.exists():
+                self._remember_missing(path)
                 logger.error(f"Image file not found: {path}")
                 raise FileNotFoundError(f"Image file not found: {path}")
 
-            with open_srgb(path) as img:
-                img.thumbnail(self.thumbnail_size)
-                output = BytesIO()
-                img.save(output, format="WebP", quality=80)
-                thumbnail_data = output.getvalue()
-
-                # Cache the thumbnail with the original filename
-                conn.execute(
-                    """
-                    INSERT OR REPLACE INTO image_info 
-                    (directory, name, info, cache_time, thumbnail_webp, deleted)
-                    VALUES (?, ?, ?, ?, ?, 0)
-                    """,
-                    (
-                        directory,
-                        filename,
-                        "{}",  # Empty info for now
-                        int(datetime.now(timezone.utc).timestamp()),
-                        thumbnail_data,
-                    ),
-                )
-                conn.commit()
-
-                return thumbnail_data
+            return await executors.run("image", self._render_thumbnail, path)
         except Exception as e:
             logger.exception(f"Error generating thumbnail for {path}: {e}")
             raise
 
-    def get_image_info(self, directory: Path, item: Dict) -> ImageModel:
-        """Get image info with caching"""
-        path = directory / item["name"]
+    def _render_thumbnail(self, path: Path) -> bytes:
+        """Read an image and generate its thumbnail, unless the contents are known."""
+        # The contents may be known under another path
+        data = path.read_bytes()
+        stat = path.stat()
+        md5sum = hashlib.md5(data).hexdigest()
+        derivative = self._cached_derivative(
+            md5sum, "thumbnail_webp", "width", "height", "mime"
+        )
+        if derivative and derivative["thumbnail_webp"]:
+            self.reused_derivatives += 1
+            if derivative["width"]:
+                known = {k: derivative[k] for k in ("width", "height", "mime")}
+                self._remember_fingerprint(path, stat, md5sum, Derivatives(**known))
+            return derivative["thumbnail_webp"]
+
+        derivatives = generate_derivatives(
+            path,
+            thumbnail_size=self.thumbnail_size,
+            placeholder=True,
+            dhash=True,
+            data=data,
+        )
+        self._store_derivatives(md5sum, derivatives)
+        self._remember_fingerprint(path, stat, md5sum, derivatives)
+        return derivatives.thumbnail_webp
+
+    def _listed_entry(self, path: Path) -> Optional[ImageEntry]:
+        """Find an image in the current listing of its directory, if any."""
+        try:
+            listing = self.scan_directory(path.parent)
+        except OSError:
+            return None
+        return _find_image(listing, path.name)
+
+    def _current_entry(self, path: Path, stat: os.stat_result) -> Optional[ImageEntry]:
+        """
+        Find the listing entry of an image, if it still describes the file.
+
+        Args:
+            path (Path): Image file
+            stat (os.stat_result): Stat of the file, taken after any read of
+                its contents
+
+        Returns:
+            Optional[ImageEntry]: The entry, None if the listing lacks the
+                image or the file changed since it was listed
+
+        Notes:
+            - Cached rows record the entry's mtime, the newest of the image
+              and its sidecars, so they are compared through the entry
+        """
+        entry = self._listed_entry(path)
+        if entry and entry.size == stat.st_size and stat.st_mtime <= entry.mtime:
+            return entry
+        return None
+
+    def _remember_fingerprint(
+        self, path: Path, stat: os.stat_result, md5sum: str, derivatives
+    ):
+        """
+        Complete the caption-only row of an image whose contents were hashed.
+
+        Args:
+            path (Path): Image file
+            stat (os.stat_result): Stat of the file taken after it was read
+            md5sum (str): MD5 of the contents read
+            derivatives (Derivatives): Dimensions and MIME of the contents
+
+        Notes:
+            - Caption-only rows lack a fingerprint (see _index_captions), so
+              thumbnails and previews would hash the file on every request
+              until the folder is browsed
+            - Only a row recording the current listing entry is completed,
+              which makes it valid for get_image_info as well
+        """
+        entry = self._current_entry(path, stat)
+        if entry is None:
+            return
+        with self.db.writer() as conn:
+            conn.execute(
+                """
+                UPDATE image_info SET md5sum = ?, mime = ?, width = ?, height = ?
+                WHERE directory = ? AND name = ? AND mtime = ? AND size = ?
+                AND md5sum IS NULL
+                """,
+                (
+                    md5sum,
+                    derivatives.mime,
+                    derivatives.width,
+                    derivatives.height,
+                    str(path.parent),
+                    path.name,
+                    entry.mtime,
+                    entry.size,
+                ),
+            )
+
+    def _store_derivatives(self, md5sum: str, derivatives):
+        """
+        Store freshly generated derivatives under a content fingerprint.
+
+        Args:
+            md5sum (str): MD5 of the source file contents
+            derivatives (Derivatives): Output of generate_derivatives
+
+        Notes:
+            - Existing rows only get the generated derivatives updated, so a
+              preview does not drop a cached thumbnail and vice versa
+            - Written behind, see _read_row
+            - A perceptual hash is added to the hash index right away
+        """
+        generated = {
+            "thumbnail_webp": derivatives.thumbnail_webp,
+            "preview_webp": derivatives.preview_webp,
+            "placeholder": derivatives.placeholder,
+        }
+        if derivatives.dhash is not None:
+            generated["dhash"] = to_signed(derivatives.dhash)
+            self.hash_index.add(md5sum, derivatives.dhash)
+        self.db.write_behind(
+            "image_derivative",
+            DERIVATIVE_KEY,
+            {
+                "md5sum": md5sum,
+                "width": derivatives.width,
+                "height": derivatives.height,
+                "mime": derivatives.mime,
+                **generated,
+                "cache_time": int(datetime.now(timezone.utc).timestamp()),
+            },
+            update=("width", "height", "mime")
+            + tuple(k for k, v in generated.items() if v is not None),
+        )
+
+    def _read_row(self, table: str, key: Dict, columns) -> Optional[Dict]:
+        """
+        Read a cache row, including writes that are still queued.
+
+        Args:
+            table (str): Table to read
+            key (Dict): Primary key columns and values
+            columns (Iterable[str]): Columns to read. For image_info, "captions"
+                reads the image's rows of image_caption as (type, text) pairs.
+
+        Returns:
+            Optional[Dict]: Column values, or None if there is no row
+
+        Notes:
+            - Cache fills are written behind (see app.db), so a row generated a
+              moment ago may only exist in memory; queued values are applied on
+              top of the committed row
+        """
+        columns = tuple(columns)
+        select = [CAPTIONS_SELECT if c == "captions" else c for c in columns]
+        where = " AND ".join(f"{k} = ?" for k in key)
+        with self.db.reader() as conn:
+            result = conn.execute(
+                f"SELECT {', '.join(select)} FROM {table} WHERE {where}",
+                tuple(key.values()),
+            ).fetchone()
+        row = dict(zip(columns, result)) if result else None
+        if row and "captions" in row:
+            row["captions"] = [tuple(c) for c in json.loads(row["captions"])]
+
+        pending = self.db.pending(table, *key.values())
+        if pending is None:
+            return row
+        values = pending.values(row)
+        if "image_caption" in pending.children:
+            values["captions"] = [
+                (c["caption_type"], c["caption"])
+                for c in pending.children["image_caption"]
+            ]
+        values.setdefault("captions", [])
+        return {c: values.get(c, IMAGE_INFO_DEFAULTS.get(c)) for c in columns}
+
+    def _cached_row(self, directory: Path, name: str, *columns: str) -> Optional[Dict]:
+        """Read the image_info row of an image, see _read_row."""
+        return self._read_row(
+            "image_info",
+            {"directory": str(directory), "name": name},
+            ("deleted",) + columns,
+        )
+
+    def _cached_derivative(self, md5sum: str, *columns: str) -> Optional[Dict]:
+        """Read the derivatives stored for a fingerprint, see _read_row."""
+        return self._read_row("image_derivative", {"md5sum": md5sum}, columns)
+        # Images are sorted by natural name order, see _scan_directory
+        images = listing.images
+        key = _NAME_ORDER(path.name)
+        i = bisect_left(images, key, key=lambda entry: _NAME_ORDER(entry.name))
+        while i < len(images) and _NAME_ORDER(images[i].name) == key:
+            if images[i].name == path.name:
+                return images[i]
+            i += 1
+        return None
+
+    def get_image_info(self, directory: Path, item: ImageEntry) -> ImageModel:
+        """
+        Get image info with caching.
+
+        Args:
+            directory (Path): Directory containing the image
+            item (ImageEntry): Scanned image entry
+
+        Returns:
+            ImageModel: Image metadata
+
+        Notes:
+            - A cached row is valid when its recorded file mtime and size
+              match the scanned ones
+            - On a miss, derivatives already stored for the same fingerprint
+              are reused, so a copy of a known image is hashed but not decoded
+        """
+        path = directory / item.name
         logger.debug(f"Getting image info with caching for {path}")
 
-        conn = self._get_connection()
         # Use exact filename match
-        result = conn.execute(
-            r"""
-            SELECT info, cache_time, deleted, favorite_state FROM image_info 
-            WHERE directory = ? AND name = ? AND deleted = 0
-            """,
-            (str(directory), item["name"]),
-        ).fetchone()
-
-        current_mtime = item["mtime"]
-
-        if result:
-            cache_mtime = datetime.fromtimestamp(result[1], tz=timezone.utc)
-            if cache_mtime >= current_mtime:
-                info = ImageModel.model_validate_json(result[0])
-                # Update favorite state from the dedicated column
-                info.favorite_state = result[3]
-                return info
+        result = self._cached_row(directory, path.name, *IMAGE_MODEL_COLUMNS)
+
+        current_mtime = item.mtime
+
+        if (
+            result
+            and not result["deleted"]
+            and result["md5sum"] is not None
+            and result["mtime"] == current_mtime
+            and result["size"] == item.size
+        ):
+            derivative = self._cached_derivative(result["md5sum"], "placeholder")
+            return ImageModel(
+                name=path.name,
+                mtime=to_datetime(current_mtime),
+                size=result["size"],
+                mime=result["mime"],
+                md5sum=result["md5sum"],
+                width=result["width"],
+                height=result["height"],
+                captions=result["captions"],
+                favorite_state=result["favorite_state"],
+                placeholder=derivative["placeholder"] if derivative else None,
+            )
 
         # Cache miss - generate new info
-        md5sum = self._compute_md5(path)
+        if self.remote_fs:
+            # One sequential read serves both the hash and the decode
+            data = path.read_bytes()
+            md5sum = hashlib.md5(data).hexdigest()
+        else:
+            data = None
+            md5sum = self._compute_md5(path)
 
         # Get captions:
         captions = []
-        for ext, caption_name in item["captions"].items():
+        for ext, caption_name in item.captions.items():
             caption_path = directory / caption_name
             with open(caption_path, "r") as f:
                 caption = f.read()
             assert ext[0] == "."
             captions.append((ext[1:], caption))
+        self.tag_index.update(directory, path.name, captions)
 
-        # Get favorite state from SQLite if it exists, otherwise default to 0
-        favorite_state = 0
-        existing_favorite = conn.execute(
-            "SELECT favorite_state FROM image_info WHERE directory = ? AND name = ?",
-            (str(directory), item["name"]),
-        ).fetchone()
-        if existing_favorite:
-            favorite_state = existing_favorite[0]
+        # Keep the favorite state of an existing row, otherwise default to 0
+        favorite_state = result["favorite_state"] if result else 0
 
-        # Generate thumbnail in memory
-        with open_srgb(path, force_load=False) as img:
-            width, height = img.size
-
-            # Create thumbnail
-            img.thumbnail(self.thumbnail_size)
-
-            thumbnail_buffer = BytesIO()
-            img.save(thumbnail_buffer, format="WebP", quality=80)
-            thumbnail_data = thumbnail_buffer.getvalue()
+        # Reuse the derivatives of known contents, otherwise decode once for
+        # dimensions, MIME, thumbnail and placeholder
+        derivatives = self._cached_derivative(md5sum, *DERIVATIVE_COLUMNS)
+        if derivatives and derivatives["thumbnail_webp"] and derivatives["width"]:
+            self.reused_derivatives += 1
+            derivatives = Derivatives(**derivatives)
+        else:
+            derivatives = generate_derivatives(
+                path,
+                thumbnail_size=self.thumbnail_size,
+                placeholder=True,
+                dhash=True,
+                data=data,
+            )
+            self._store_derivatives(md5sum, derivatives)
 
         info = ImageModel(
             name=path.name,
-            mtime=item["mtime"],
-            size=item["size"],
+            mtime=to_datetime(current_mtime),
+            size=item.size,
             md5sum=md5sum,
-            mime=magic.from_file(str(path), mime=True),
-            width=width,
-            height=height,
+            mime=derivatives.mime,
+            width=derivatives.width,
+            height=derivatives.height,
             captions=captions,
             favorite_state=favorite_state,
+            placeholder=derivatives.placeholder,
         )
 
-        # Cache image info and thumbnail
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO image_info 
-            (directory, name, info, cache_time, thumbnail_webp, deleted, favorite_state) 
-            VALUES (?, ?, ?, ?, ?, 0, ?)
-            """,
-            (
-                str(directory),
-                path.name,
-                info.model_dump_json(),
-                int(datetime.now(timezone.utc).timestamp()),
-                thumbnail_data,
-                favorite_state,
-            ),
+        # Cache image info, group-committed in the background
+        self.db.write_behind(
+            "image_info",
+            IMAGE_INFO_KEY,
+            {
+                "directory": str(directory),
+                "name": path.name,
+                "mtime": current_mtime,
+                "size": info.size,
+                "mime": info.mime,
+                "md5sum": md5sum,
+                "width": info.width,
+                "height": info.height,
+                "cache_time": int(datetime.now(timezone.utc).timestamp()),
+                "deleted": 0,
+                "favorite_state": favorite_state,
+            },
+            children={
+                "image_caption": [
+                    {
+                        "directory": str(directory),
+                        "name": path.name,
+                        "caption_type": caption_type,
+                        "caption": caption,
+                    }
+                    for caption_type, caption in captions
+                ]
+            },
         )
-        conn.commit()
 
         return info
 
     def _scan_directory(
         self,
         directory: Path,
-    ) -> List[DirectoryModel | Dict]:
+        directory_mtime: float,
+    ) -> DirectoryListing:
         """
         Scan directory for images and subdirectories.
 
         Args:
             directory (Path): Directory to scan
+            directory_mtime (float): Modification time of the directory, taken
+                before the scan
 
         Returns:
-            List[DirectoryModel | Dict]: List of directory and image entries
+            DirectoryListing: Compact listing of directory and image entries
 
         Notes:
             - Skips hidden files
             - Groups related files (image + captions)
             - Sorts entries naturally
             - Handles various image and caption formats
+            - Uses os.scandir so file types come from d_type without a stat
+            - Only stats entries it keeps, batched on a thread pool for large
+              directories since every stat is a round trip on network mounts
+            - Entries that vanish mid-scan are skipped
         """
+        # First pass: classify entries by name and d_type, no stat calls yet
+        dir_candidates = list()
+        file_candidates = list()
+        with os.scandir(directory) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        dir_candidates.append(entry)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                stem, suffix = os.path.splitext(name)
+                if suffix.lower() in SCANNED_EXTENSIONS:
+                    file_candidates.append((entry, stem, suffix))
+
+        # Second pass: stat only the entries we keep, in parallel for big folders
+        dir_stats = _stat_entries(dir_candidates)
+        file_stats = _stat_entries([entry for entry, _, _ in file_candidates])
+
         dir_entries = list()
         img_entries = list()
         mtimes = dict()
-        all_side_car_files = defaultdict(dict)
-        for entry in directory.iterdir():
-            name = entry.name
-            if name.startswith("."):
+        all_side_car_files = defaultdict(list)
+        for entry, stat in zip(dir_candidates, dir_stats):
+            if stat is None:
                 continue
-            stat = entry.stat()
-            st_mode = stat.st_mode
-
-            if S_ISDIR(st_mode):
-                dir_entries.append(
-                    DirectoryModel(
-                        name=name,
-                        mtime=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
-                    )
+            dir_entries.append((entry.name, stat.st_mtime))
+        for (entry, stem, suffix), stat in zip(file_candidates, file_stats):
+            if stat is None:
+                continue
+            if suffix.lower() in IMAGE_EXTENSIONS:
+                img_entries.append((stem, suffix, stat.st_size))
+            else:
+                all_side_car_files[stem].append(suffix)
+            mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
+
+        images = list()
+        for stem, suffix, size in img_entries:
+            side_car_files = all_side_car_files.get(stem, ())
+            images.append(
+                ImageEntry(
+                    stem,
+                    suffix,
+                    size,
+                    mtimes[stem],
+                    tuple(s for s in side_car_files if s.lower() in CAPTION_EXTENSIONS),
+                    tuple(
+                        s for s in side_car_files if s.lower() in METADATA_EXTENSIONS
+                    ),
+                )
+            )
+
+        dir_entries.sort(key=natsort_keygen(lambda x: x[0]))
+        images.sort(key=lambda x: _NAME_ORDER(x.name))
+        return DirectoryListing(
+            directory_mtime,
+            [name for name, _ in dir_entries],
+            [mtime for _, mtime in dir_entries],
+            images,
+        )
+
+    def scan_directory(self, directory: Path) -> DirectoryListing:
+        if self.remote_fs:
+            return self._scan_directory_remote(directory)
+
+        directory_mtime = directory.stat().st_mtime
+        listing = self.directory_cache.get(directory)
+        if listing is None or directory_mtime > listing.mtime:
+            listing = self._scan_directory(directory, directory_mtime)
+            self._publish_listing(directory, listing)
+
+        return listing
+
+    def _publish_listing(self, directory: Path, listing: DirectoryListing):
+        """Cache a fresh listing and update what is derived from it."""
+        self.directory_cache[directory] = listing
+        if self.remote_fs:
+            self._validated_at[directory] = time.monotonic()
+            self._store_listing(directory, listing)
+        self.folder_tree.update(directory, listing)
+        self._schedule_caption_indexing(directory, listing)
+
+    def _scan_and_index(
+        self, directory: Path, directory_mtime: float
+    ) -> DirectoryListing:
+        """Scan a directory and cache its new captions, for background walks."""
+        listing = self._scan_directory(directory, directory_mtime)
+        self._index_captions(directory, listing)
+        return listing
+
+    def _schedule_caption_indexing(self, directory: Path, listing: DirectoryListing):
+        executors.submit(
+            "io",
+            self._index_captions,
+            directory,
+            listing,
+            priority=executors.BACKGROUND,
+        )
+
+    def _index_captions(self, directory: Path, listing: DirectoryListing):
+        """
+        Cache the captions of images that are new or changed since cached.
+
+        Args:
+            directory (Path): Scanned directory
+            listing (DirectoryListing): Its fresh listing
+
+        Notes:
+            - Makes captions searchable without browsing their folder first
+            - Rows of changed images are demoted to caption-only rows (no
+              fingerprint, see get_image_info), so their file info is still
+              regenerated on the next browse
+            - Caption-only rows record the scanned mtime, so unchanged images
+              are skipped on later scans
+            - Cached images missing from the listing are dropped from the tag
+              index, their rows are left to cache garbage collection
+        """
+        with self.db.reader() as conn:
+            cached = dict(
+                conn.execute(
+                    "SELECT name, mtime FROM image_info WHERE directory = ?",
+                    (str(directory),),
                 )
-            elif S_ISREG(st_mode):
-                suffix = entry.suffix.lower()
-                if suffix in IMAGE_EXTENSIONS:
-                    stem = entry.stem
-                    img_entries.append(
+            )
+        listed = {entry.name for entry in listing.images}
+        vanished = [name for name in cached if name not in listed]
+        if vanished:
+            self.tag_index.discard(directory, vanished)
+        indexed = 0
+        for entry in listing.images:
+            if entry.name not in cached and not entry.caption_suffixes:
+                continue
+            if cached.get(entry.name) == entry.mtime:
+                continue
+            pending = self.db.pending("image_info", str(directory), entry.name)
+            if pending is not None and pending.row.get("mtime") == entry.mtime:
+                continue
+            captions = []
+            try:
+                for ext, caption_name in entry.captions.items():
+                    with open(directory / caption_name, "r") as f:
+                        captions.append((ext[1:], f.read()))
+            except (OSError, UnicodeDecodeError) as e:
+                logger.debug(f"Skipping captions of {directory / entry.name}: {e}")
+                continue
+            self.tag_index.update(directory, entry.name, captions)
+            self.db.write_behind(
+                "image_info",
+                IMAGE_INFO_KEY,
+                {
+                    "directory": str(directory),
+                    "name": entry.name,
+                    "mtime": entry.mtime,
+                    "size": entry.size,
+                    "md5sum": None,
+                    "cache_time": int(datetime.now(timezone.utc).timestamp()),
+                },
+                update=("mtime", "size", "md5sum", "cache_time"),
+                children={
+                    "image_caption": [
                         {
-                            "name": name,
-                            "stem": stem,
-                            "type": "image",
-                            "size": stat.st_size,
+                            "directory": str(directory),
+                            "name": entry.name,
+                            "caption_type": caption_type,
+                            "caption": caption,
                         }
-                    )
-                    mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
-                elif suffix in CAPTION_EXTENSIONS:
-                    stem = entry.stem
-                    all_side_car_files[stem][suffix] = name
-                    mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
-                    continue
-                elif suffix in METADATA_EXTENSIONS:
-                    stem = entry.stem
-                    all_side_car_files[stem][suffix] = name
-                    mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
-                    continue
-                else:
-                    continue
+                        for caption_type, caption in captions
+                    ]
+                },
+            )
+            indexed += 1
+        if indexed:
+            logger.debug(f"Indexed captions of {indexed} images in {directory}")
+
+    def forget_collected(self, removed: Removed):
+        """
+        Update the in-memory indexes after cache garbage collection.
+
+        Args:
+            removed (Removed): Rows dropped by app.cache_gc.collect_garbage
+
+        Notes:
+            - Folders that lost images are listed again, which updates their
+              statistics, missing ones are dropped from the folder tree
+        """
+        names = defaultdict(list)
+        for directory, name in removed.images:
+            names[directory].append(name)
+        for directory, dropped in names.items():
+            self.tag_index.discard(Path(directory), dropped)
+        for directory in map(Path, {*names, *removed.directories}):
+            if not directory.is_dir():
+                self.folder_tree.remove(directory)
+            elif directory in self.folder_tree:
+                try:
+                    self.scan_directory(directory)
+                except OSError as e:
+                    logger.warning(f"Cannot list {directory} after collection: {e}")
+        if removed.fingerprints:
+            self.hash_index.remove(removed.fingerprints)
+
+    def _known_missing(self, path: Path) -> bool:
+        """Whether a path was found missing lately, only tracked in remote mode."""
+        return self.remote_fs and path in self.missing_paths
+
+    def _remember_missing(self, path: Path):
+        """Remember a missing path in remote mode, where checking it is slow."""
+        if self.remote_fs:
+            self.missing_paths.set(path)
+
+    def _scan_directory_remote(self, directory: Path) -> DirectoryListing:
+        """
+        Remote file system variant of scan_directory.
+
+        Serves the in-memory or persisted listing without any file system
+        access and schedules a background revalidation when it is older than
+        revalidate_interval. Only directories never seen before are scanned
+        synchronously.
+
+        Raises:
+            FileNotFoundError: If the directory is missing, including when it
+                was recently found missing
+        """
+        if directory in self.missing_paths:
+            raise FileNotFoundError(f"Directory not found: {directory}")
+
+        listing = self.directory_cache.get(directory)
+        if listing is None:
+            listing = self._load_listing(directory)
+            if listing is not None:
+                self.directory_cache[directory] = listing
+
+        if listing is None:
+            listing = self._rescan_remote(directory)
+        else:
+            validated_at = self._validated_at.get(directory, 0.0)
+            if time.monotonic() - validated_at > self.revalidate_interval:
+                self._schedule_revalidation(directory)
+
+        return listing
+
+    def _rescan_remote(self, directory: Path) -> DirectoryListing:
+        """Scan a directory and persist the listing, remembering misses."""
+        try:
+            listing = self._scan_directory(directory, directory.stat().st_mtime)
+        except FileNotFoundError:
+            self.missing_paths.set(directory)
+            self.directory_cache.pop(directory, None)
+            self._delete_listing(directory)
+            raise
+        self._publish_listing(directory, listing)
+        return listing
+
+    def _schedule_revalidation(self, directory: Path):
+        with self._revalidate_lock:
+            if directory in self._revalidating:
+                return
+            self._revalidating.add(directory)
+        executors.submit(
+            "io", self._revalidate, directory, priority=executors.BACKGROUND
+        )
+
+    def _revalidate(self, directory: Path):
+        """Background check of a served listing against the file system."""
+        try:
+            listing = self.directory_cache.get(directory)
+            directory_mtime = directory.stat().st_mtime
+            if listing is None or directory_mtime > listing.mtime:
+                logger.debug(f"Listing of {directory} changed, rescanning")
+                self._rescan_remote(directory)
             else:
-                continue
+                self._validated_at[directory] = time.monotonic()
+        except FileNotFoundError:
+            logger.debug(f"Directory {directory} disappeared")
+            self.missing_paths.set(directory)
+            self.invalidate_directory(directory, forget_missing=False)
+        except Exception as e:
+            logger.warning(f"Error revalidating {directory}: {e}")
+        finally:
+            with self._revalidate_lock:
+                self._revalidating.discard(directory)
+
+    def _store_listing(self, directory: Path, listing: DirectoryListing):
+        stored = {
+            "dirs": [list(d) for d in zip(listing.dir_names, listing.dir_mtimes)],
+            "images": [
+                [
+                    e.name,
+                    e.stem,
+                    e.size,
+                    e.mtime,
+                    e.captions,
+                    e.metadata,
+                ]
+                for e in listing.images
+            ],
+        }
+        with self.db.writer() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO directory_listing (directory, mtime, listing) VALUES (?, ?, ?)",
+                (str(directory), listing.mtime, json.dumps(stored)),
+            )
 
-        for entry in img_entries:
-            side_car_files = all_side_car_files.get(entry["stem"], {})
-            entry["captions"] = {
-                k: v for k, v in side_car_files.items() if k in CAPTION_EXTENSIONS
-            }
-            entry["metadata"] = {
-                k: v for k, v in side_car_files.items() if k in METADATA_EXTENSIONS
-            }
-            entry["mtime"] = datetime.fromtimestamp(
-                mtimes[entry["stem"]], tz=timezone.utc
+    def _load_listing(self, directory: Path) -> Optional[DirectoryListing]:
+        with self.db.reader() as conn:
+            row = conn.execute(
+                "SELECT mtime, listing FROM directory_listing WHERE directory = ?",
+                (str(directory),),
+            ).fetchone()
+        if row is None:
+            return None
+        stored = json.loads(row[1])
+        # Sidecar names are the image stem plus their suffix as found on disk
+        images = [
+            ImageEntry(
+                stem,
+                name[len(stem) :],
+                size,
+                mtime,
+                tuple(n[len(stem) :] for n in captions.values()),
+                tuple(n[len(stem) :] for n in metadata.values()),
             )
+            for name, stem, size, mtime, captions, metadata in stored["images"]
+        ]
+        return DirectoryListing(
+            row[0],
+            [name for name, _ in stored["dirs"]],
+            [mtime for _, mtime in stored["dirs"]],
+            images,
+        )
 
-        dir_entries.sort(key=natsort_keygen(lambda x: x.name))
-        img_entries.sort(key=natsort_keygen(lambda x: x["name"]))
-        return dir_entries, img_entries
+    def _delete_listing(self, directory: Path):
+        with self.db.writer() as conn:
+            conn.execute(
+                "DELETE FROM directory_listing WHERE directory = ?", (str(directory),)
+            )
 
-    def scan_directory(
-        self,
-        directory: Path,
-    ) -> Tuple[float, List[DirectoryModel], List[Dict]]:
-        directory_mtime = directory.stat().st_mtime
-        items = None
-        from_cache = self.directory_cache.get(directory)
-        if from_cache is not None:
-            from_cache, cache_mtime = from_cache
-            if directory_mtime <= cache_mtime:
-                items = from_cache
-        if items is None:
-            items = list(self._scan_directory(directory))
-            self.directory_cache[directory] = (items, directory_mtime)
-
-        return directory_mtime, *items
+    def invalidate_directory(
+        self, directory: Path, recursive: bool = False, forget_missing: bool = True
+    ):
+        """
+        Drop cached listings after the contents of a directory changed.
+
+        Args:
+            directory (Path): Directory whose listing is stale
+            recursive (bool): Also drop listings of all subdirectories
+            forget_missing (bool): Clear the negative cache, since the change
+                may have created previously missing paths
+
+        Notes:
+            - Drops both the in-memory and the persisted listing
+        """
+        self.directory_cache.pop(directory, None)
+        self._validated_at.pop(directory, None)
+        if recursive:
+            for cached_dir in list(self.directory_cache.keys()):
+                if cached_dir.is_relative_to(directory):
+                    self.directory_cache.pop(cached_dir, None)
+                    self._validated_at.pop(cached_dir, None)
+        if forget_missing:
+            self.missing_paths.clear()
+        if self.remote_fs:
+            self._delete_listing(directory)
+            if recursive:
+                with self.db.writer() as conn:
+                    conn.execute(
+                        f"DELETE FROM directory_listing WHERE {SUBTREE_WHERE}",
+                        _subtree_range(directory),
+                    )
+
+    def _forget_subtree(self, conn, directory: Path):
+        """Delete all cached rows of a directory and its subdirectories."""
+        for table in CACHE_TABLES:
+            conn.execute(
+                f"DELETE FROM {table} WHERE {SUBTREE_WHERE}",
+                _subtree_range(directory),
+            )
+
+    def move_cached(self, source: Path, target: Path):
+        """
+        Re-key cached rows after a file or directory was moved or renamed.
+
+        Args:
+            source (Path): Previous path of the image or directory
+            target (Path): New path
+
+        Notes:
+            - Call after the move succeeded on disk
+            - Thumbnails, previews, captions and favorites move with the rows,
+              and since a move keeps mtime and size the rows stay valid
+            - Stale rows already cached under the target are replaced
+            - Runs in a single transaction
+            - Moved directories are re-keyed in the folder tree as well, and
+              images in the tag index. The folder tree is updated after the
+              transaction, as it may queue rows and a full write-behind queue
+              waits for the flusher, which needs the writer.
+        """
+        self.tag_index.move(source, target)
+        is_dir = target.is_dir()
+        with self.db.writer() as conn:
+            if is_dir:
+                self._forget_subtree(conn, target)
+                prefix = len(str(source)) + 1
+                for table in CACHE_TABLES:
+                    conn.execute(
+                        f"""
+                        UPDATE OR REPLACE {table}
+                        SET directory = ? || substr(directory, ?)
+                        WHERE {SUBTREE_WHERE}
+                        """,
+                        (str(target), prefix, *_subtree_range(source)),
+                    )
+            else:
+                keys = (str(target.parent), target.name)
+                conn.execute(
+                    "DELETE FROM image_caption WHERE directory = ? AND name = ?",
+                    keys,
+                )
+                for table in ("image_info", "image_caption"):
+                    conn.execute(
+                        f"""
+                        UPDATE OR REPLACE {table}
+                        SET directory = ?, name = ?
+                        WHERE directory = ? AND name = ?
+                        """,
+                        (*keys, str(source.parent), source.name),
+                    )
+        if is_dir:
+            self.folder_tree.move(source, target)
 
     def _calculate_dynamic_page_size(self, page: int) -> int:
         """
@@ -516,18 +1200,17 @@ class CachedFileSystemDataSource(ImageDataSource):
         page_size: Optional[int] = None,
         http_head: bool = False,
         if_modified_since: Optional[datetime] = None,
-    ) -> Tuple[BrowseHeader, Optional[List[Dict]], Optional[List[asyncio.Future]]]:
+    ) -> Tuple[BrowseHeader, Optional[List[DirectoryModel]], Optional[AsyncIterator]]:
         # Calculate dynamic page size if not explicitly provided
         if page_size is None:
             page_size = self._calculate_dynamic_page_size(page)
 
         # Get directory contents
-        directory_mtime, dir_items, img_items = self.scan_directory(directory)
-        mtime_dt = datetime.fromtimestamp(directory_mtime, tz=timezone.utc)
+        listing = self.scan_directory(directory)
 
         # Calculate totals
-        total_folders = len(dir_items)
-        total_images = len(img_items)
+        total_folders = len(listing.dir_names)
+        total_images = len(listing.images)
 
         # If only folders exist, skip pagination
         if total_images == 0:
@@ -552,8 +1235,8 @@ class CachedFileSystemDataSource(ImageDataSource):
             img_end = end - total_folders
 
         # Slice the items
-        dir_items = dir_items[dir_start:dir_end]
-        img_items = img_items[img_start:img_end]
+        folder_names = list(listing.dir_names[dir_start:dir_end])
+        img_items = listing.images[img_start:img_end]
 
         # Calculate total pages, ensuring page_size is at least 1
         total_pages = (total_folders + total_images + max(page_size, 1) - 1) // max(
@@ -561,11 +1244,12 @@ class CachedFileSystemDataSource(ImageDataSource):
         )
 
         # Extract names and update mtime
-        folder_names = [f.name for f in dir_items]
+        mtime = listing.mtime
         image_names = []
         for item in img_items:
-            mtime_dt = max(mtime_dt, item["mtime"])
-            image_names.append(item["name"])
+            mtime = max(mtime, item.mtime)
+            image_names.append(item.name)
+        mtime_dt = to_datetime(mtime)
 
         browser_header = BrowseHeader(
             mtime=mtime_dt,
@@ -582,14 +1266,396 @@ class CachedFileSystemDataSource(ImageDataSource):
         ):
             return browser_header, None, None
 
-        loop = asyncio.get_event_loop()
-        run = loop.run_in_executor
+        dir_items = listing.directories(dir_start, dir_end)
+        return browser_header, dir_items, self.stream_image_info(directory, img_items)
+
+    def stream_image_info(
+        self,
+        directory: Path,
+        items: Sequence[ImageEntry],
+        window: int = BROWSE_WINDOW,
+    ) -> AsyncIterator[ImageModel]:
+        """
+        Get image info for a page of images, yielding in completion order.
+
+        Args:
+            directory (Path): Directory containing the images
+            items (Sequence[ImageEntry]): Scanned image entries of the page
+            window (int): Maximum number of jobs queued or running at a time
+
+        Returns:
+            AsyncIterator[ImageModel]: Image metadata, fastest first
+
+        Notes:
+            - Jobs are submitted as earlier ones finish, so a large page does
+              not flood the executor
+            - Jobs of the most recently started stream run first
+            - Closing the generator (e.g. the client disconnected) cancels the
+              jobs that have not started yet
+        """
+        return self._stream_jobs(
+            self.get_image_info, ((directory, item) for item in items), window
+        )
+
+    async def _stream_jobs(
+        self, fn, jobs: Iterable[Tuple], window: int
+    ) -> AsyncIterator[ImageModel]:
+        """Run fn(*args) per job on the image executor, see stream_image_info."""
+        priority = executors.interactive_priority()
+        queued = iter(jobs)
+        pending = set()
+        try:
+            while True:
+                for args in itertools.islice(queued, window - len(pending)):
+                    job = executors.submit("image", fn, *args, priority=priority)
+                    pending.add(asyncio.wrap_future(job))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def search(
+        self,
+        query: str,
+        page: int = 1,
+        page_size: int = 100,
+        caption_type: Optional[str] = None,
+        directory: Optional[Path] = None,
+    ) -> Tuple[BrowseHeader, AsyncIterator]:
+        """
+        Search cached captions, see app.caption_search.
+
+        Args:
+            query (str): Search query
+            page (int): Page number, starting at 1
+            page_size (int): Images per page
+            caption_type (Optional[str]): Only search captions of this type
+            directory (Optional[Path]): Only search this directory and its
+                subdirectories
+
+        Returns:
+            Tuple[BrowseHeader, AsyncIterator]: Header listing the page's
+                images best match first, and a stream of their ImageModels in
+                completion order. Image names are paths relative to root_dir.
+
+        Raises:
+            ValueError: If the query has no terms to match
+            sqlite3.OperationalError: If the query cannot be evaluated
 
-        image_info_futures = [
-            run(None, self.get_image_info, directory, item) for item in img_items
+        Notes:
+            - Blocking, run it on an executor
+            - Captions cached a moment ago become searchable once their
+              write-behind batch is committed
+            - Hits whose file is gone are left out of the stream
+        """
+        expression, exclude = match_expression(query)
+        with self.db.reader() as conn:
+            total, hits = search_captions(
+                conn,
+                expression,
+                page_size,
+                (page - 1) * page_size,
+                caption_type,
+                _subtree_range(directory) if directory else None,
+                exclude,
+            )
+        return self._hit_page(hits, total, page, page_size)
+
+    def query_tags(
+        self,
+        query: str,
+        page: int = 1,
+        page_size: int = 100,
+        directory: Optional[Path] = None,
+    ) -> Tuple[BrowseHeader, AsyncIterator]:
+        """
+        Find images by a boolean tag query, see app.tag_index.
+
+        Args:
+            query (str): Tag query
+            page (int): Page number, starting at 1
+            page_size (int): Images per page
+            directory (Optional[Path]): Only match this directory and its
+                subdirectories
+
+        Returns:
+            Tuple[BrowseHeader, AsyncIterator]: Header listing the page's
+                images sorted by path, and a stream of their ImageModels, as
+                returned by search()
+
+        Raises:
+            TagQueryError: If the query cannot be parsed
+
+        Notes:
+            - Blocking, run it on an executor
+        """
+        paths = self.tag_index.query(query, directory)
+        start = (page - 1) * page_size
+        return self._hit_page(
+            paths[start : start + page_size], len(paths), page, page_size
+        )
+
+    def _hit_page(
+        self,
+        hits: Sequence[Tuple[str, str]],
+        total: int,
+        page: int,
+        page_size: int,
+    ) -> Tuple[BrowseHeader, AsyncIterator]:
+        """
+        Build the browse-shaped response of a page of search hits.
+
+        Args:
+            hits (Sequence[Tuple[str, str]]): (directory, name) of the page's
+                images, in result order
+            total (int): Number of hits on all pages
+            page (int): Page number
+            page_size (int): Images per page
+
+        Returns:
+            Tuple[BrowseHeader, AsyncIterator]: See search()
+        """
+        # One listing per directory of the page resolves the scanned entries
+        entries = {}
+        jobs = []
+        for hit_directory, name in hits:
+            path = Path(hit_directory)
+            if path not in entries:
+                try:
+                    listing = self.scan_directory(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    listing = None
+                entries[path] = {e.name: e for e in listing.images} if listing else {}
+            entry = entries[path].get(name)
+            if entry is not None:
+                jobs.append((path, entry))
+
+        header = BrowseHeader(
+            mtime=to_datetime(max((e.mtime for _, e in jobs), default=0.0)),
+            page=page,
+            pages=(total + page_size - 1) // page_size,
+            folders=[],
+            images=[self._search_name(d, e) for d, e in jobs],
+            total_folders=0,
+            total_images=total,
+        )
+        return header, self._stream_jobs(self._get_search_hit, jobs, BROWSE_WINDOW)
+
+    def _search_name(self, directory: Path, item: ImageEntry) -> str:
+        return str((directory / item.name).relative_to(self.root_dir))
+
+    def _get_search_hit(self, directory: Path, item: ImageEntry) -> ImageModel:
+        info = self.get_image_info(directory, item)
+        info.name = self._search_name(directory, item)
+        return info
+
+    def _perceptual_hash(self, path: Path) -> Tuple[str, int]:
+        """
+        Get the fingerprint and perceptual hash of an image.
+
+        Args:
+            path (Path): Image file
+
+        Returns:
+            Tuple[str, int]: MD5 of the contents and their dHash
+
+        Notes:
+            - Fingerprints with a thumbnail but no hash are hashed from the
+              thumbnail, unknown ones get their derivatives generated
+        """
+        md5sum = self._compute_md5(path)
+        dhash = self.hash_index.get(md5sum)
+        if dhash is not None:
+            return md5sum, dhash
+        derivative = self._cached_derivative(md5sum, "thumbnail_webp", "dhash")
+        if derivative and derivative["dhash"] is not None:
+            dhash = to_unsigned(derivative["dhash"])
+        elif derivative and derivative["thumbnail_webp"]:
+            dhash = dhash_thumbnail(derivative["thumbnail_webp"])
+            self.db.write_behind(
+                "image_derivative",
+                DERIVATIVE_KEY,
+                {
+                    "md5sum": md5sum,
+                    "dhash": to_signed(dhash),
+                    "cache_time": int(datetime.now(timezone.utc).timestamp()),
+                },
+                update=("dhash",),
+            )
+        else:
+            derivatives = generate_derivatives(
+                path, thumbnail_size=self.thumbnail_size, placeholder=True, dhash=True
+            )
+            self._store_derivatives(md5sum, derivatives)
+            return md5sum, derivatives.dhash
+        self.hash_index.add(md5sum, dhash)
+        return md5sum, dhash
+
+    def _cached_paths(self, where: str, params: Sequence) -> List[Tuple[str, str, str]]:
+        """(directory, name, md5sum) of the cached, not deleted images matching."""
+        with self.db.reader() as conn:
+            return conn.execute(
+                f"""
+                SELECT directory, name, md5sum FROM image_info
+                WHERE {where} AND NOT deleted AND md5sum IS NOT NULL
+                ORDER BY directory, name
+                """,
+                params,
+            ).fetchall()
+
+    def similar_images(
+        self, path: Path, distance: int, page: int = 1, page_size: int = 100
+    ) -> Tuple[BrowseHeader, AsyncIterator]:
+        """
+        Find images that look like an image, see app.duplicates.
+
+        Args:
+            path (Path): Image to compare with
+            distance (int): Largest Hamming distance between perceptual hashes
+            page (int): Page number, starting at 1
+            page_size (int): Images per page
+
+        Returns:
+            Tuple[BrowseHeader, AsyncIterator]: Header listing the page's
+                images closest first, and a stream of their ImageModels, as
+                returned by search()
+
+        Notes:
+            - Blocking and may decode the image, run it on the image executor
+            - Only cached images are found, i.e. those of folders browsed
+              since their files last changed
+        """
+        _, dhash = self._perceptual_hash(path)
+        matches = self.hash_index.similar(dhash, distance)
+        fingerprints = list(matches)
+        rows = []
+        # Stay below SQLite's default limit of bound parameters
+        for start in range(0, len(fingerprints), 500):
+            batch = fingerprints[start : start + 500]
+            rows += self._cached_paths(
+                f"md5sum IN ({', '.join('?' for _ in batch)})", batch
+            )
+        key = (str(path.parent), path.name)
+        hits = sorted(
+            (matches[md5sum], directory, name)
+            for directory, name, md5sum in rows
+            if (directory, name) != key
+        )
+        start = (page - 1) * page_size
+        return self._hit_page(
+            [
+                (directory, name)
+                for _, directory, name in hits[start : start + page_size]
+            ],
+            len(hits),
+            page,
+            page_size,
+        )
+
+    def find_duplicates(self, directory: Path, distance: int, limit: int) -> Dict:
+        """
+        Group the images of a folder subtree into clusters of duplicates.
+
+        Args:
+            directory (Path): Root of the subtree
+            distance (int): Largest Hamming distance between perceptual hashes
+                of near duplicates, 0 for visually identical images
+            limit (int): Number of clusters to return
+
+        Returns:
+            Dict: Duplicates
+                - images: Cached images in the subtree
+                - hashed: Distinct contents among them with a perceptual hash
+                - total_clusters: Number of clusters
+                - clusters: Largest clusters first, each a list of image
+                  paths relative to root_dir
+
+        Notes:
+            - Blocking, run it on an executor
+            - Byte-identical copies are always clustered, also without a hash
+            - Only cached images are compared, and paths whose file is gone
+              are left out
+        """
+        rows = self._cached_paths(SUBTREE_WHERE, _subtree_range(directory))
+        paths = defaultdict(list)
+        for row_directory, name, md5sum in rows:
+            paths[md5sum].append(Path(row_directory, name))
+        groups = self.hash_index.clusters(paths, distance)
+        clustered = set().union(*groups)
+        groups += [
+            {md5sum}
+            for md5sum, copies in paths.items()
+            if len(copies) > 1 and md5sum not in clustered
         ]
 
-        return browser_header, dir_items, image_info_futures
+        clusters = []
+        for group in groups:
+            images = sorted(
+                str(image.relative_to(self.root_dir))
+                for md5sum in group
+                for image in paths[md5sum]
+                if image.exists()
+            )
+            if len(images) > 1:
+                clusters.append(images)
+        clusters.sort(key=lambda images: (-len(images), images[0]))
+        return {
+            "images": len(rows),
+            "hashed": sum(
+                1 for md5sum in paths if self.hash_index.get(md5sum) is not None
+            ),
+            "total_clusters": len(clusters),
+            "clusters": clusters[:limit],
+        }
+
+    def verification_targets(self, directory: Path) -> List[Tuple[Path, Optional[str]]]:
+        """
+        List the images of a folder subtree for app.integrity.
+
+        Args:
+            directory (Path): Root of the subtree
+
+        Returns:
+            List[Tuple[Path, Optional[str]]]: Image paths in browse order, with
+                the cached fingerprint of those whose row matches the file's
+                mtime and size, None for the others
+
+        Notes:
+            - Blocking, run it on the io executor
+            - Folders that cannot be listed are skipped
+        """
+        with self.db.reader() as conn:
+            cached = {
+                (row_directory, name): (mtime, size, md5sum)
+                for row_directory, name, mtime, size, md5sum in conn.execute(
+                    f"""
+                    SELECT directory, name, mtime, size, md5sum FROM image_info
+                    WHERE {SUBTREE_WHERE} AND md5sum IS NOT NULL
+                    """,
+                    _subtree_range(directory),
+                )
+            }
+        targets = []
+        folders = [directory]
+        while folders:
+            folder = folders.pop()
+            try:
+                listing = self.scan_directory(folder)
+            except OSError as e:
+                logger.warning(f"Cannot list {folder} for verification: {e}")
+                continue
+            folders.extend(folder / name for name in reversed(listing.dir_names))
+            for item in listing.images:
+                row = cached.get((str(folder), item.name))
+                current = row and row[0] == item.mtime and row[1] == item.size
+                targets.append((folder / item.name, row[2] if current else None))
+        return targets
 
     async def save_caption(self, path: Path, caption: str, caption_type: str) -> None:
         """Save image caption to file and update cache"""
@@ -608,60 +1674,124 @@ class CachedFileSystemDataSource(ImageDataSource):
             # Update cache
             directory = path.parent
             name = path.name  # Original image name with extension
+            self.tag_index.set_caption(directory, name, caption_type, caption_text)
 
             # Clear directory cache to force rescan
-            if directory in self.directory_cache:
-                del self.directory_cache[directory]
+            self.invalidate_directory(directory)
 
-            conn = self._get_connection()
-            result = conn.execute(
-                "SELECT info FROM image_info WHERE directory = ? AND name = ?",
-                (str(directory), name),
-            ).fetchone()
+            # Touch the file to force cache invalidation
+            path.touch()
+            path.parent.touch()  # Touch parent directory too
 
-            if result:
-                info = ImageModel.model_validate_json(result[0])
-                # Update or add the caption in the cached info
-                existing_captions = [c for c in info.captions if c[0] != caption_type]
-                info.captions = existing_captions + [(caption_type, caption_text)]
+            await executors.run(
+                "io", self._record_caption, path, caption_type, caption_text
+            )
 
-                # Update cache
-                conn.execute(
+        except Exception as e:
+            logger.error(f"Error saving caption for {path}: {e}")
+            raise
+
+    def _record_caption(self, path: Path, caption_type: str, caption_text: str):
+        """
+        Update the cached row of an image whose caption was just written.
+
+        Args:
+            path (Path): Image file
+            caption_type (str): Caption type written
+            caption_text (str): Caption text written
+
+        Notes:
+            - Records the mtime the scanner sees, the newest of the image and
+              its sidecars, so the cached row stays valid and only the caption
+              row changes
+            - The fresh listing is published after the row is updated, so its
+              caption indexing does not demote the row
+        """
+        directory = path.parent
+        listing = self._scan_directory(directory, directory.stat().st_mtime)
+        entry = _find_image(listing, path.name)
+        if entry is not None:
+            with self.db.writer() as conn:
+                updated = conn.execute(
                     """
-                    UPDATE image_info 
-                    SET info = ?, cache_time = ?
+                    UPDATE image_info
+                    SET mtime = ?, cache_time = ?
                     WHERE directory = ? AND name = ?
                     """,
                     (
-                        info.model_dump_json(),
+                        entry.mtime,
                         int(datetime.now(timezone.utc).timestamp()),
                         str(directory),
-                        name,
+                        path.name,
                     ),
-                )
-                conn.commit()
-
-                # Touch the file to force cache invalidation
-                path.touch()
-                path.parent.touch()  # Touch parent directory too
-
-        except Exception as e:
-            logger.error(f"Error saving caption for {path}: {e}")
-            raise
+                ).rowcount
+                if updated:
+                    conn.execute(
+                        """
+                        INSERT OR REPLACE INTO image_caption
+                        (directory, name, caption_type, caption)
+                        VALUES (?, ?, ?, ?)
+                        """,
+                        (str(directory), path.name, caption_type, caption_text),
+                    )
+        self._publish_listing(directory, listing)
 
     async def get_preview(self, path: Path) -> bytes:
-        """Generate preview image."""
+        """Get cached preview WebP data, generating it on a miss."""
+        return await executors.run("image", self._load_preview, path)
+
+    def _load_preview(self, path: Path) -> bytes:
         try:
-            if not path.exists():
+            # A single stat both checks existence and gives the mtime
+            try:
+                if self._known_missing(path):
+                    raise FileNotFoundError(path)
+                stat = path.stat()
+            except FileNotFoundError:
+                self._remember_missing(path)
                 logger.error(f"Image file not found: {path}")
                 raise FileNotFoundError(f"Image file not found: {path}")
 
-            with open_srgb(path) as img:
-                img.thumbnail(self.preview_size)
-                output = BytesIO()
-                img.save(output, format="WebP", quality=70, method=6)
-                output.seek(0)
-                return output.getvalue()
+            # The cached fingerprint holds while the file is unchanged
+            row = self._cached_row(path.parent, path.name, "md5sum", "mtime", "size")
+            entry = self._current_entry(path, stat)
+            if (
+                row
+                and not row["deleted"]
+                and row["md5sum"]
+                and entry
+                and row["mtime"] == entry.mtime
+                and row["size"] == entry.size
+            ):
+                md5sum, data = row["md5sum"], None
+            else:
+                data = path.read_bytes()
+                stat = path.stat()
+                md5sum = hashlib.md5(data).hexdigest()
+
+            derivative = self._cached_derivative(
+                md5sum, "preview_webp", "thumbnail_webp", "width", "height", "mime"
+            )
+            if derivative and derivative["preview_webp"]:
+                if data is not None and derivative["width"]:
+                    known = {k: derivative[k] for k in ("width", "height", "mime")}
+                    self._remember_fingerprint(path, stat, md5sum, Derivatives(**known))
+                return derivative["preview_webp"]
+
+            # Produce the thumbnail in the same pass if the fingerprint lacks one
+            need_thumbnail = not (derivative and derivative["thumbnail_webp"])
+            derivatives = generate_derivatives(
+                path,
+                preview_size=self.preview_size,
+                thumbnail_size=self.thumbnail_size if need_thumbnail else None,
+                placeholder=need_thumbnail,
+                dhash=need_thumbnail,
+                data=data,
+            )
+            self._store_derivatives(md5sum, derivatives)
+            if data is not None:
+                self._remember_fingerprint(path, stat, md5sum, derivatives)
+            return derivatives.preview_webp
         except Exception as e:
             logger.exception(f"Error generating preview for {path}: {e}")
             raise
@@ -683,30 +1813,22 @@ class CachedFileSystemDataSource(ImageDataSource):
 
             try:
                 # Clear cache for this directory and all subdirectories before deletion
-                for cached_dir in list(self.directory_cache.keys()):
-                    if str(cached_dir).startswith(str(path)):
-                        del self.directory_cache[cached_dir]
+                self.invalidate_directory(path, recursive=True)
 
                 # Clear database entries for all files in this directory and subdirectories
-                conn = self._get_connection()
-                conn.execute(
-                    """
-                    DELETE FROM image_info 
-                    WHERE directory LIKE ?
-                    """,
-                    (str(path) + "%",),
-                )
-                conn.commit()
+                with self.db.writer() as conn:
+                    self._forget_subtree(conn, path)
+                self.folder_tree.forget(path)
+                self.tag_index.remove(path)
 
                 # Recursively delete directory and all contents
-                shutil.rmtree(path)
+                await executors.run("fs-mutation", shutil.rmtree, path)
 
                 # Touch parent directory to force cache update
                 path.parent.touch()
 
                 # Clear parent directory cache to force rescan
-                if path.parent in self.directory_cache:
-                    del self.directory_cache[path.parent]
+                self.invalidate_directory(path.parent)
 
                 return [], [str(path)], []
 
@@ -737,6 +1859,15 @@ class CachedFileSystemDataSource(ImageDataSource):
                 f"Deleting {path.name!r} in {path.parent!r}, it was still present among the captions {captions} and the files {files}"
             )
             path.unlink()
+        if confirm:
+            self.invalidate_directory(path.parent)
+            self.tag_index.remove(path)
+            with self.db.writer() as conn:
+                for table in ("image_info", "image_caption"):
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE directory = ? AND name = ?",
+                        (str(path.parent), path.name),
+                    )
         return captions, files, preserved_files
 
     async def delete_caption(self, path: Path, caption_type: str) -> None:
@@ -757,36 +1888,20 @@ class CachedFileSystemDataSource(ImageDataSource):
             # Update cache
             directory = str(full_path.parent)
             name = full_path.name
-            conn = self._get_connection()
-            result = conn.execute(
-                "SELECT info FROM image_info WHERE directory = ? AND name = ?",
-                (directory, name),
-            ).fetchone()
-
-            if result:
-                info = ImageModel.model_validate_json(result[0])
-                # Remove the caption from cached info
-                original_captions = info.captions
-                info.captions = [(t, c) for t, c in info.captions if t != caption_type]
-
-                # Update cache
-                conn.execute(
+            self.tag_index.set_caption(full_path.parent, name, caption_type, None)
+            with self.db.writer() as conn:
+                deleted = conn.execute(
                     """
-                    UPDATE image_info 
-                    SET info = ?, cache_time = ?
-                    WHERE directory = ? AND name = ?
+                    DELETE FROM image_caption
+                    WHERE directory = ? AND name = ? AND caption_type = ?
                     """,
-                    (
-                        info.model_dump_json(),
-                        int(datetime.now(timezone.utc).timestamp()),
-                        directory,
-                        name,
-                    ),
-                )
-                conn.commit()
+                    (directory, name, caption_type),
+                ).rowcount
+
+            if deleted:
                 logger.info(f"Updated cache for {name} after caption deletion")
             else:
-                logger.warning(f"No cached info found for {directory}/{name}")
+                logger.warning(f"No cached caption found for {directory}/{name}")
         except Exception as e:
             logger.error(f"Error deleting caption for {path}: {e}")
             raise
@@ -797,6 +1912,71 @@ class CachedFileSystemDataSource(ImageDataSource):
 
     def clear_thumbnail_cache(self):
         """Clear thumbnail cache to force regeneration."""
-        conn = self._get_connection()
-        conn.execute("UPDATE image_info SET thumbnail_webp = NULL")
-        conn.commit()
+        with self.db.writer() as conn:
+            conn.execute("UPDATE image_derivative SET thumbnail_webp = NULL")
+
+    def cache_stats(self) -> Dict:
+        """
+        Report cache size and how much content-addressing saves.
+
+        Returns:
+            Dict: Statistics
+                - images: Cached paths with a fingerprint, i.e. without the
+                  caption-only rows of paths not browsed yet
+                - fingerprints: Distinct contents among them
+                - derivatives: Stored derivative sets
+                - dedup_ratio: Cached paths per distinct fingerprint
+                - derivative_bytes: Size of the stored derivative blobs
+                - saved_bytes: Blob bytes the duplicates would take on their own
+                - reused_derivatives: Misses served without decoding since
+                  startup
+                - connections: Connection pool and write-behind counters
+                - directory_cache: Memory use and evictions of the in-memory
+                  listings
+                - tag_index: Size of the tag index and its statistics
+                - hash_index: Size of the perceptual hash index
+        """
+        with self.db.writer() as conn:  # Flushes queued writes first
+            images, fingerprints = conn.execute(
+                """
+                SELECT count(*), count(DISTINCT md5sum) FROM image_info
+                WHERE md5sum IS NOT NULL
+                """
+            ).fetchone()
+            derivatives, derivative_bytes = conn.execute(
+                """
+                SELECT count(*), total(
+                    ifnull(length(thumbnail_webp), 0)
+                    + ifnull(length(preview_webp), 0)
+                )
+                FROM image_derivative
+                """
+            ).fetchone()
+            saved_bytes = conn.execute(
+                """
+                SELECT total(
+                    (i.copies - 1) * (
+                        ifnull(length(d.thumbnail_webp), 0)
+                        + ifnull(length(d.preview_webp), 0)
+                    )
+                )
+                FROM (
+                    SELECT md5sum, count(*) AS copies FROM image_info
+                    GROUP BY md5sum HAVING copies > 1
+                ) AS i
+                JOIN image_derivative AS d USING (md5sum)
+                """
+            ).fetchone()[0]
+        return {
+            "images": images,
+            "fingerprints": fingerprints,
+            "derivatives": derivatives,
+            "dedup_ratio": images / fingerprints if fingerprints else 1.0,
+            "derivative_bytes": int(derivative_bytes),
+            "saved_bytes": int(saved_bytes),
+            "reused_derivatives": self.reused_derivatives,
+            "connections": self.db.stats(),
+            "directory_cache": self.directory_cache.stats(),
+            "tag_index": self.tag_index.stats(),
+            "hash_index": self.hash_index.stats(),
+        }
@@ -0,0 +1,389 @@
+"""
+SQLite connection management for the metadata cache.
+
+This module owns every connection to the cache database. It replaces the
+former one-connection-per-thread dictionary, which never closed connections
+and leaked them as executor threads came and went.
+
+Design:
+- The database runs in WAL mode, so readers never wait for the writer
+- A bounded pool of read connections is shared by all threads; connections
+  are checked out for the duration of a `with` block and returned afterwards
+- A single writer connection serializes all writes in-process, so writers
+  never contend on the SQLite lock and the busy timeout is only a safety net
+- Each connection keeps a cache of prepared statements and is tuned with
+  `synchronous=NORMAL`, memory-mapped I/O and a larger page cache
+- Cache fills can be queued with `write_behind()` instead of being written
+  right away. A background thread group-commits queued rows every
+  `batch_size` rows or `flush_interval` seconds, so a cold browse of
+  thousands of images costs a handful of commits instead of one per image.
+  Queued rows stay visible through `pending()` until they are committed, and
+  every `writer()` block first flushes the queue so direct writes always
+  apply on top of queued ones.
+
+Usage:
+    ```python
+    db = ConnectionManager("cache.db")
+    with db.reader() as conn:
+        row = conn.execute("SELECT ...").fetchone()
+    with db.writer() as conn:
+        conn.execute("INSERT ...")  # committed when the block exits
+    db.write_behind("image_info", ("directory", "name"), row)  # committed soon
+    ```
+"""
+
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger("uvicorn.error")
+
+# Tuning defaults, see https://www.sqlite.org/pragma.html
+MMAP_SIZE = 256 * 1024**2  # bytes of the database file mapped into memory
+CACHE_SIZE_KIB = 16 * 1024  # page cache per connection
+BUSY_TIMEOUT_MS = 5000  # only hit when another process writes
+CACHED_STATEMENTS = 256  # prepared statements kept per connection
+
+# Write-behind defaults
+WRITE_BATCH_SIZE = 256  # rows per group commit
+WRITE_FLUSH_INTERVAL = 0.1  # seconds a queued row may wait
+WRITE_MAX_PENDING = 4096  # producers block once this many rows are queued
+
+
+@dataclass
+class PendingWrite:
+    """
+    A row queued for write-behind.
+
+    Attributes:
+        table (str): Target table
+        key (tuple[str, ...]): Primary key column names
+        row (Dict): Column values used when the row is inserted
+        update (Optional[tuple[str, ...]]): Columns overwritten when the row
+            already exists, or None to replace the whole row
+        children (Dict[str, List[Dict]]): Rows of child tables that replace
+            all child rows sharing this row's key, per child table
+    """
+
+    table: str
+    key: tuple
+    row: Dict
+    update: Optional[tuple] = None
+    children: Dict[str, List[Dict]] = field(default_factory=dict)
+
+    def merge(self, newer: "PendingWrite") -> "PendingWrite":
+        """Combine with a newer write to the same row."""
+        children = {**self.children, **newer.children}
+        if newer.update is None:
+            return PendingWrite(newer.table, newer.key, newer.row, None, children)
+        row = dict(self.row)
+        row.update({c: newer.row[c] for c in newer.update})
+        update = self.update
+        if update is not None:
+            update = tuple(dict.fromkeys(update + newer.update))
+        return PendingWrite(self.table, self.key, row, update, children)
+
+    def values(self, existing: Optional[Dict] = None) -> Dict:
+        """Column values after applying this write on top of an existing row."""
+        if existing is None or self.update is None:
+            return dict(self.row)
+        values = dict(existing)
+        values.update({c: self.row[c] for c in self.update})
+        return values
+
+
+class ConnectionManager:
+    """
+    Pooled SQLite connections with a single writer.
+
+    Args:
+        db_path (str): Path to the SQLite database file
+        read_pool_size (int): Maximum number of concurrent read connections
+        batch_size (int): Queued rows that trigger a group commit
+        flush_interval (float): Seconds before queued rows are committed
+
+    Notes:
+        - Connections are created lazily, up to read_pool_size readers plus
+          one writer
+        - reader() blocks when all read connections are checked out
+        - writer() commits on success and rolls back on exceptions
+        - Reads issued inside writer() see the uncommitted writes
+        - Queued writes are flushed on close() and at interpreter exit; a
+          crash loses at most flush_interval worth of cache fills
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        read_pool_size: int = 8,
+        batch_size: int = WRITE_BATCH_SIZE,
+        flush_interval: float = WRITE_FLUSH_INTERVAL,
+    ):
+        self.db_path = db_path
+        self.read_pool_size = read_pool_size
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._reader_available = threading.Semaphore(read_pool_size)
+        self._writer_lock = threading.RLock()
+        self._writer = None
+        self._closed = False
+
+        # Write-behind state: queued rows, rows being committed and the
+        # background thread draining them
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: Dict[tuple, PendingWrite] = {}
+        self._flushing: Dict[tuple, PendingWrite] = {}
+        self._pending_cond = threading.Condition()
+        self._flusher: Optional[threading.Thread] = None
+        self._batches = 0
+        self._rows_written = 0
+
+        # WAL is a persistent property of the database file, set it once
+        with self.writer() as conn:
+            # Only takes effect on new databases, existing ones are converted
+            # by the first garbage collection (see app.cache_gc)
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if mode.lower() != "wal":
+                logger.warning(f"Could not enable WAL mode for {db_path}: {mode}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # Rows deleted by REPLACE conflict resolution fire delete triggers too,
+        # which keep the caption search index in sync
+        conn.execute("PRAGMA recursive_triggers = ON")
+        return conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Check out a read connection for the duration of the block."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection manager is closed")
+        self._reader_available.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._reader_lock:
+                    self._reader_count += 1
+            try:
+                yield conn
+            finally:
+                # End any implicit read transaction so WAL checkpoints can
+                # proceed past this connection's snapshot
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+        finally:
+            self._reader_available.release()
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Hold the single write connection; commit when the block exits."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection manager is closed")
+        with self._writer_lock:
+            conn = self._writer_connection()
+            # Queued rows go first so direct writes apply on top of them
+            self._flush_locked(conn)
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._connect()
+        return self._writer
+
+    def write_behind(
+        self,
+        table: str,
+        key: tuple,
+        row: Dict,
+        update: Optional[tuple] = None,
+        children: Optional[Dict[str, List[Dict]]] = None,
+    ):
+        """
+        Queue a row to be written by the background flusher.
+
+        Args:
+            table (str): Target table
+            key (tuple[str, ...]): Primary key column names, all present in row
+            row (Dict): Column values to insert
+            update (Optional[tuple[str, ...]]): Columns to overwrite if the row
+                exists; None replaces the whole row (INSERT OR REPLACE)
+            children (Optional[Dict[str, List[Dict]]]): Child rows per table.
+                Child tables carry the parent's key columns; their existing
+                rows for this key are deleted before the new ones are inserted.
+
+        Notes:
+            - A later write to the same row is merged into the queued one
+            - Blocks while WRITE_MAX_PENDING rows are already queued
+        """
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection manager is closed")
+        write = PendingWrite(
+            table, tuple(key), row, update and tuple(update), children or {}
+        )
+        pk = (table,) + tuple(row[c] for c in key)
+        with self._pending_cond:
+            while len(self._pending) >= WRITE_MAX_PENDING:
+                self._pending_cond.notify_all()
+                self._pending_cond.wait()
+            queued = self._pending.get(pk)
+            self._pending[pk] = queued.merge(write) if queued else write
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_loop, name="db-write-behind", daemon=True
+                )
+                self._flusher.start()
+                atexit.register(self.close)
+            if len(self._pending) >= self.batch_size:
+                self._pending_cond.notify_all()
+
+    def pending(self, table: str, *key) -> Optional[PendingWrite]:
+        """
+        Get the queued, not yet committed write for a row.
+
+        Args:
+            table (str): Table name
+            *key: Primary key values
+
+        Returns:
+            Optional[PendingWrite]: Combined queued write, or None
+        """
+        pk = (table,) + key
+        with self._pending_cond:
+            flushing = self._flushing.get(pk)
+            queued = self._pending.get(pk)
+        if flushing and queued:
+            return flushing.merge(queued)
+        return queued or flushing
+
+    def flush(self):
+        """Commit all queued rows now."""
+        with self._writer_lock:
+            self._flush_locked(self._writer_connection())
+
+    def _flush_loop(self):
+        while not self._closed:
+            with self._pending_cond:
+                if len(self._pending) < self.batch_size:
+                    self._pending_cond.wait(self.flush_interval)
+                if not self._pending:
+                    continue
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Write-behind flush failed: {e}")
+
+    def _flush_locked(self, conn: sqlite3.Connection):
+        # Caller holds the writer lock
+        with self._pending_cond:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._pending_cond.notify_all()
+
+        # Group rows with the same statement shape into one executemany
+        groups: Dict[tuple, list] = {}
+        child_deletes: Dict[tuple, list] = {}
+        child_inserts: Dict[tuple, list] = {}
+        for write in self._flushing.values():
+            columns = tuple(write.row)
+            groups.setdefault(
+                (write.table, write.key, columns, write.update), []
+            ).append(tuple(write.row[c] for c in columns))
+            key_values = tuple(write.row[c] for c in write.key)
+            for child, rows in write.children.items():
+                child_deletes.setdefault((child, write.key), []).append(key_values)
+                for row in rows:
+                    child_columns = tuple(row)
+                    child_inserts.setdefault((child, child_columns), []).append(
+                        tuple(row[c] for c in child_columns)
+                    )
+
+        try:
+            for (table, key, columns, update), rows in groups.items():
+                verb = "INSERT OR REPLACE" if update is None else "INSERT"
+                sql = f"{verb} INTO {table} ({', '.join(columns)}) "
+                sql += f"VALUES ({', '.join('?' for _ in columns)})"
+                if update is not None:
+                    assignments = ", ".join(f"{c} = excluded.{c}" for c in update)
+                    sql += (
+                        f" ON CONFLICT ({', '.join(key)}) DO UPDATE SET {assignments}"
+                    )
+                conn.executemany(sql, rows)
+            for (child, key), keys in child_deletes.items():
+                where = " AND ".join(f"{c} = ?" for c in key)
+                conn.executemany(f"DELETE FROM {child} WHERE {where}", keys)
+            for (child, columns), rows in child_inserts.items():
+                conn.executemany(
+                    f"INSERT INTO {child} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})",
+                    rows,
+                )
+            conn.commit()
+            self._batches += 1
+            self._rows_written += len(self._flushing)
+        except sqlite3.Error as e:
+            # Queued rows are cache fills, they are regenerated on the next miss
+            conn.rollback()
+            logger.error(f"Dropping {len(self._flushing)} queued rows: {e}")
+        finally:
+            with self._pending_cond:
+                self._flushing = {}
+
+    def stats(self) -> dict:
+        """Connection and write-behind counters, for diagnostics."""
+        return {
+            "read_pool_size": self.read_pool_size,
+            "readers_open": self._reader_count,
+            "readers_idle": self._readers.qsize(),
+            "writer_open": self._writer is not None,
+            "writes_pending": len(self._pending),
+            "write_batches": self._batches,
+            "rows_written": self._rows_written,
+        }
+
+    def close(self):
+        """Flush queued rows, then close all idle connections and the writer."""
+        if self._closed:
+            return
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logger.error(f"Final write-behind flush failed: {e}")
+        self._closed = True
+        with self._pending_cond:
+            self._pending_cond.notify_all()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
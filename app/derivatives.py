@@ -0,0 +1,326 @@
+"""
+Single-decode derivative generation for images.
+
+This module turns one decode of a source image into every derivative the
+backend serves for it: dimensions, MIME type, thumbnail, preview, placeholder
+color and the perceptual hash used to find near duplicates. Opening an image
+is by far the most expensive step when populating the cache, so all
+derivatives are produced from the same decoded pixels instead of re-opening
+the file per endpoint.
+
+The pipeline:
+1. Opens the file lazily and records the original dimensions from the header
+2. Uses shrink-on-load (JPEG DCT scaling) to decode no larger than needed
+3. Waits until the estimated memory of the decode fits the decode budget
+4. Converts to sRGB once
+5. Emits the largest requested derivative first and derives the smaller ones
+   from it
+
+The decode budget is a weighted semaphore shared by all decodes. Each decode
+is admitted with the pixel footprint estimated from the header (width x height
+x bands of the decoded size), so many small images decode in parallel while a
+few huge ones queue instead of exhausting memory together. An image larger
+than the whole budget is decoded alone.
+"""
+
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+from .drhead_loader import ensure_srgb
+from .mime import SIGNATURE_LENGTH, detect_mime
+
+logger = logging.getLogger("uvicorn.error")
+
+THUMBNAIL_QUALITY = 80
+PREVIEW_QUALITY = 70
+
+DECODE_MEMORY_BUDGET = 1024 * 1024 * 1024  # bytes of decoded pixels at a time
+
+
+class DecodeBudget:
+    """
+    Weighted semaphore admitting decodes by estimated memory footprint.
+
+    Args:
+        capacity (int): Bytes that may be held by admitted decodes at a time
+
+    Notes:
+        - Admission is first come, first served, so a large decode is not
+          starved by a stream of small ones
+        - A weight above the capacity is clamped to it, the decode then runs
+          once nothing else is admitted
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._used = 0
+        self._waiters = deque()
+        self._condition = threading.Condition()
+        self.admitted = 0
+        self.waited = 0
+        self.oversized = 0
+        self.peak_used = 0
+
+    def configure(self, capacity: int):
+        """Change the capacity, waking decodes that fit now."""
+        with self._condition:
+            self.capacity = capacity
+            self._condition.notify_all()
+
+    def acquire(self, weight: int) -> int:
+        """
+        Block until `weight` bytes of the budget are held.
+
+        Returns:
+            int: Bytes actually held, to pass to release()
+        """
+        ticket = object()
+        with self._condition:
+            if weight > self.capacity:
+                self.oversized += 1
+            weight = min(weight, self.capacity)
+            self._waiters.append(ticket)
+            if len(self._waiters) > 1 or self._used + weight > self.capacity:
+                self.waited += 1
+            self._condition.wait_for(
+                lambda: self._waiters[0] is ticket
+                and self._used + weight <= self.capacity
+            )
+            self._waiters.popleft()
+            self._used += weight
+            self.admitted += 1
+            self.peak_used = max(self.peak_used, self._used)
+            # The next waiter may fit as well
+            self._condition.notify_all()
+        return weight
+
+    def release(self, weight: int):
+        """Give back bytes returned by acquire()."""
+        with self._condition:
+            self._used -= weight
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, weight: int):
+        """Hold `weight` bytes of the budget for the duration of the block."""
+        weight = self.acquire(weight)
+        try:
+            yield
+        finally:
+            self.release(weight)
+
+    def stats(self) -> dict:
+        """
+        Report budget use.
+
+        Returns:
+            dict: Statistics
+                - capacity: Budget in bytes
+                - used: Bytes held by running decodes
+                - waiting: Decodes queued for admission
+                - peak_used: Most bytes held at once since startup
+                - admitted: Decodes admitted since startup
+                - waited: Decodes that had to queue
+                - oversized: Decodes larger than the whole budget
+        """
+        with self._condition:
+            return {
+                "capacity": self.capacity,
+                "used": self._used,
+                "waiting": len(self._waiters),
+                "peak_used": self.peak_used,
+                "admitted": self.admitted,
+                "waited": self.waited,
+                "oversized": self.oversized,
+            }
+
+
+decode_budget = DecodeBudget(DECODE_MEMORY_BUDGET)
+
+
+@dataclass
+class Derivatives:
+    """
+    Result of a derivative generation pass.
+
+    Attributes:
+        width (int): Original image width in pixels
+        height (int): Original image height in pixels
+        mime (str): MIME type of the source file
+        thumbnail_webp (Optional[bytes]): WebP thumbnail, if requested
+        preview_webp (Optional[bytes]): WebP preview, if requested
+        placeholder (Optional[str]): Dominant color "#rrggbb", if requested
+        dhash (Optional[int]): 64-bit difference hash, if requested, see
+            compute_dhash
+    """
+
+    width: int
+    height: int
+    mime: str
+    thumbnail_webp: Optional[bytes] = None
+    preview_webp: Optional[bytes] = None
+    placeholder: Optional[str] = None
+    dhash: Optional[int] = None
+
+
+def compute_placeholder(img: Image.Image) -> str:
+    """
+    Compute a tiny placeholder for an image: its dominant color.
+
+    Args:
+        img: PIL Image, usually the freshly generated thumbnail
+
+    Returns:
+        str: CSS hex color (e.g. "#a0b1c2")
+
+    Notes:
+        - Box-filters the image down to a single pixel
+        - Alpha is ignored, transparent areas contribute their color
+        - Cheap enough to run for every thumbnail
+    """
+    r, g, b = img.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def compute_dhash(img: Image.Image) -> int:
+    """
+    Compute the difference hash of an image.
+
+    Args:
+        img: PIL Image, usually the freshly generated thumbnail
+
+    Returns:
+        int: 64-bit hash, one bit per horizontally adjacent pixel pair of a
+            9x8 grayscale reduction, set where the left pixel is brighter
+
+    Notes:
+        - Survives re-encoding, resizing and small color changes, which flip
+          few bits, so near duplicates have hashes a small Hamming distance
+          apart
+        - Alpha is ignored like in compute_placeholder
+    """
+    pixels = list(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(0, 72, 9):
+        for left, right in zip(pixels[row : row + 8], pixels[row + 1 : row + 9]):
+            value = (value << 1) | (left > right)
+    return value
+
+
+def estimate_decode_footprint(img: Image.Image) -> int:
+    """
+    Estimate the memory a decode of an opened image will take.
+
+    Args:
+        img: PIL Image opened lazily, after any draft() call
+
+    Returns:
+        int: Bytes for the decoded pixels plus the sRGB converted copy
+    """
+    width, height = img.size
+    # Pillow stores multi-band pixels in 32 bits, and modes like "I" and "F"
+    # are 32 bits per single band
+    bands = len(img.getbands())
+    bytes_per_pixel = 4 if bands > 1 or img.mode in ("I", "F") else 1
+    if img.mode.startswith("I;16"):
+        bytes_per_pixel = 2
+    return 2 * width * height * bytes_per_pixel
+
+
+def _encode_webp(img: Image.Image, **params) -> bytes:
+    output = BytesIO()
+    img.save(output, format="WebP", **params)
+    return output.getvalue()
+
+
+def generate_derivatives(
+    path: Path,
+    *,
+    thumbnail_size: Optional[tuple[int, int]] = None,
+    preview_size: Optional[tuple[int, int]] = None,
+    placeholder: bool = False,
+    dhash: bool = False,
+    data: Optional[bytes] = None,
+) -> Derivatives:
+    """
+    Decode an image once and generate the requested derivatives.
+
+    Args:
+        path (Path): Path to the source image
+        thumbnail_size (Optional[tuple[int, int]]): Max thumbnail box, or None
+            to skip the thumbnail
+        preview_size (Optional[tuple[int, int]]): Max preview box, or None to
+            skip the preview
+        placeholder (bool): Whether to compute the placeholder color. Implies a
+            thumbnail-sized intermediate even if no thumbnail is requested.
+        dhash (bool): Whether to compute the perceptual hash, from the same
+            intermediate as the placeholder
+        data (Optional[bytes]): File contents if already read, the file is then
+            not opened again
+
+    Returns:
+        Derivatives: Dimensions, MIME type and the requested derivatives
+
+    Notes:
+        - Dimensions always refer to the original image, not the decoded size
+        - The thumbnail is derived from the preview when both are requested
+        - MIME comes from the header bytes read for the decode, see app.mime
+        - Waits for room in the decode budget before decoding, see
+          DecodeBudget
+        - Runs synchronously, call it from an executor
+    """
+    with BytesIO(data) if data is not None else open(path, "rb") as f:
+        # The header lands in the read buffer, so sniffing it is free
+        head = f.read(SIGNATURE_LENGTH)
+        f.seek(0)
+        mime = detect_mime(path, head)
+        img = Image.open(f)
+        width, height = img.size
+
+        # Shrink-on-load: only formats with a draft mode (JPEG) honour this,
+        # everything else is decoded at full size.
+        boxes = [box for box in (preview_size, thumbnail_size) if box]
+        if not boxes and (placeholder or dhash):
+            boxes = [(64, 64)]
+        if boxes:
+            img.draft(None, max(boxes))
+
+        # Only JPEG shrinks on load, other formats decode at full size. An
+        # image that exceeds the budget alone is decoded with nothing else.
+        footprint = estimate_decode_footprint(img)
+        if footprint > decode_budget.capacity:
+            logger.info(
+                f"Decoding {path} ({img.width}x{img.height}) exclusively, it "
+                f"exceeds the decode memory budget"
+            )
+        with decode_budget.admit(footprint):
+            img.load()
+            img = ensure_srgb(img, fp=str(path))
+
+            result = Derivatives(width=width, height=height, mime=mime)
+
+            if preview_size:
+                img.thumbnail(preview_size)
+                result.preview_webp = _encode_webp(
+                    img, quality=PREVIEW_QUALITY, method=6
+                )
+
+            if thumbnail_size:
+                img.thumbnail(thumbnail_size)
+                result.thumbnail_webp = _encode_webp(img, quality=THUMBNAIL_QUALITY)
+
+            if placeholder:
+                result.placeholder = compute_placeholder(img)
+
+            if dhash:
+                result.dhash = compute_dhash(img)
+
+    return result
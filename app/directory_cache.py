@@ -0,0 +1,252 @@
+"""
+Compact, memory-budgeted cache of directory listings.
+
+Browsing a large tree used to keep one list of DirectoryModel objects and one
+dict per image for every directory ever visited, which adds up to hundreds of
+MB. This module keeps listings in a compact form and bounds their total size:
+- ImageEntry: one `__slots__` record per image. The name is stored as stem plus
+  suffix and sidecar files as suffixes only, all suffixes interned so the few
+  distinct ones are shared by every entry
+- DirectoryListing: subdirectory names and mtimes as parallel arrays next to
+  the image records. Modification times stay floats and are only turned into
+  datetimes for the page being serialized
+- DirectoryCache: LRU mapping of directory to listing, evicting the least
+  recently used listings once their estimated size exceeds a budget
+"""
+
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .models import DirectoryModel
+
+DIRECTORY_CACHE_BYTES = 128 * 1024 * 1024
+
+
+def to_datetime(timestamp: float) -> datetime:
+    """Convert a POSIX timestamp to an aware UTC datetime."""
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+class ImageEntry:
+    """
+    An image of a directory listing with its sidecar files.
+
+    Args:
+        stem (str): File name without the extension
+        suffix (str): Extension as found on disk, e.g. ".JPG"
+        size (int): File size in bytes
+        mtime (float): Latest modification time of the image and its sidecars
+        caption_suffixes (Tuple[str, ...]): Extensions of the caption files
+        metadata_suffixes (Tuple[str, ...]): Extensions of the metadata files
+
+    Notes:
+        - Sidecar files share the stem of the image, so their names are
+          rebuilt from it on demand
+    """
+
+    __slots__ = (
+        "stem",
+        "suffix",
+        "size",
+        "mtime",
+        "caption_suffixes",
+        "metadata_suffixes",
+    )
+
+    def __init__(
+        self,
+        stem: str,
+        suffix: str,
+        size: int,
+        mtime: float,
+        caption_suffixes: Tuple[str, ...] = (),
+        metadata_suffixes: Tuple[str, ...] = (),
+    ):
+        self.stem = stem
+        self.suffix = sys.intern(suffix)
+        self.size = size
+        self.mtime = mtime
+        self.caption_suffixes = tuple(sys.intern(s) for s in caption_suffixes)
+        self.metadata_suffixes = tuple(sys.intern(s) for s in metadata_suffixes)
+
+    @property
+    def name(self) -> str:
+        return self.stem + self.suffix
+
+    @property
+    def captions(self) -> Dict[str, str]:
+        """Caption file names by lower case extension."""
+        return {s.lower(): self.stem + s for s in self.caption_suffixes}
+
+    @property
+    def metadata(self) -> Dict[str, str]:
+        """Metadata file names by lower case extension."""
+        return {s.lower(): self.stem + s for s in self.metadata_suffixes}
+
+    def __sizeof__(self) -> int:
+        # The suffixes are interned and shared, only the stem is owned
+        return (
+            object.__sizeof__(self)
+            + sys.getsizeof(self.stem)
+            + sys.getsizeof(self.caption_suffixes)
+            + sys.getsizeof(self.metadata_suffixes)
+        )
+
+
+class DirectoryListing:
+    """
+    Contents of a directory, sorted naturally.
+
+    Args:
+        mtime (float): Modification time of the directory itself
+        dir_names (Sequence[str]): Subdirectory names
+        dir_mtimes (Iterable[float]): Subdirectory modification times, in the
+            order of dir_names
+        images (Sequence[ImageEntry]): Images with their sidecar files
+
+    Attributes:
+        nbytes (int): Estimated memory footprint, computed once
+    """
+
+    __slots__ = ("mtime", "dir_names", "dir_mtimes", "images", "nbytes")
+
+    def __init__(
+        self,
+        mtime: float,
+        dir_names: Sequence[str],
+        dir_mtimes: Iterable[float],
+        images: Sequence[ImageEntry],
+    ):
+        self.mtime = mtime
+        self.dir_names = tuple(dir_names)
+        self.dir_mtimes = array("d", dir_mtimes)
+        self.images = tuple(images)
+        self.nbytes = (
+            object.__sizeof__(self)
+            + sys.getsizeof(self.dir_names)
+            + sum(sys.getsizeof(name) for name in self.dir_names)
+            + sys.getsizeof(self.dir_mtimes)
+            + sys.getsizeof(self.images)
+            + sum(sys.getsizeof(entry) for entry in self.images)
+        )
+
+    def directories(
+        self, start: int = 0, end: Optional[int] = None
+    ) -> List[DirectoryModel]:
+        """Build DirectoryModel objects for a slice of the subdirectories."""
+        return [
+            DirectoryModel(name=name, mtime=to_datetime(mtime))
+            for name, mtime in zip(
+                self.dir_names[start:end], self.dir_mtimes[start:end]
+            )
+        ]
+
+
+class DirectoryCache:
+    """
+    LRU mapping of directories to listings with a memory budget.
+
+    Args:
+        max_bytes (int): Budget for the estimated size of all listings
+        on_evict (Optional[Callable[[Path], None]]): Called with the directory
+            of every listing dropped to stay within the budget
+
+    Notes:
+        - Thread-safe, listings are stored from executor threads
+        - The most recently stored listing is always kept, even when it alone
+          exceeds the budget
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DIRECTORY_CACHE_BYTES,
+        on_evict: Optional[Callable[[Path], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self._on_evict = on_evict
+        self._entries: "OrderedDict[Path, DirectoryListing]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, directory: Path, default=None) -> Optional[DirectoryListing]:
+        """Get a listing and mark it as recently used."""
+        with self._lock:
+            listing = self._entries.get(directory)
+            if listing is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(directory)
+            self.hits += 1
+            return listing
+
+    def __setitem__(self, directory: Path, listing: DirectoryListing):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(directory, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._entries[directory] = listing
+            self.nbytes += listing.nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                old_directory, old = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+                evicted.append(old_directory)
+        if self._on_evict:
+            for old_directory in evicted:
+                self._on_evict(old_directory)
+
+    def pop(self, directory: Path, default=None) -> Optional[DirectoryListing]:
+        """Drop a listing if present and return it."""
+        with self._lock:
+            listing = self._entries.pop(directory, None)
+            if listing is None:
+                return default
+            self.nbytes -= listing.nbytes
+            return listing
+
+    def keys(self) -> List[Path]:
+        """Snapshot of the cached directories, oldest first."""
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, directory: Path) -> bool:
+        with self._lock:
+            return directory in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        """
+        Report memory usage and effectiveness.
+
+        Returns:
+            Dict: Statistics
+                - listings: Cached directories
+                - images: Image entries across them
+                - bytes: Estimated memory footprint
+                - max_bytes: Budget
+                - hits, misses: Lookups since startup
+                - evictions: Listings dropped to stay within the budget
+        """
+        with self._lock:
+            return {
+                "listings": len(self._entries),
+                "images": sum(
+                    len(listing.images) for listing in self._entries.values()
+                ),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,273 @@
+"""
+Perceptual hash index for finding duplicate and near-duplicate images.
+
+Every fingerprint (the MD5 of a file's contents) gets a 64-bit difference hash
+computed from the thumbnail-sized image decoded for its derivatives, see
+app.derivatives.compute_dhash. Re-encoded, resized or slightly edited copies of
+an image have hashes a few bits apart, so near duplicates are the pairs within
+a small Hamming distance. Byte-identical copies share a fingerprint and are
+always duplicates.
+
+Comparing a hash against every other one is linear per lookup and quadratic
+for a whole folder, so hashes are kept in a multi-index hash table: each hash
+is split into four 16-bit chunks with one table per chunk. Two hashes at most
+d bits apart differ in at most d // 4 bits of at least one chunk, so a lookup
+only probes the chunk values within that many bits of the query's chunks and
+verifies the hashes found there.
+
+The index is loaded from image_derivative at startup. Fingerprints cached
+before hashes existed are hashed from their stored thumbnail while loading,
+new ones are added as their thumbnails are generated.
+"""
+
+import functools
+import itertools
+import logging
+import threading
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from PIL import Image
+
+from . import executors
+from .db import ConnectionManager
+from .derivatives import compute_dhash
+
+logger = logging.getLogger("uvicorn.error")
+
+# Hamming distances between 64-bit dHashes
+DUPLICATE_DISTANCE = 6  # default for near duplicates
+MAX_DISTANCE = 16  # largest distance a lookup may ask for
+
+CHUNKS = 4
+CHUNK_BITS = 16
+_CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# image_derivative rows read per batch while loading
+LOAD_BATCH_SIZE = 5000
+
+
+def to_signed(dhash: int) -> int:
+    """Map an unsigned 64-bit hash to the signed range SQLite stores."""
+    return dhash - (1 << 64) if dhash >= 1 << 63 else dhash
+
+
+def to_unsigned(value: int) -> int:
+    """Inverse of to_signed."""
+    return value + (1 << 64) if value < 0 else value
+
+
+def dhash_thumbnail(data: bytes) -> int:
+    """Compute the dHash of a stored WebP thumbnail."""
+    with Image.open(BytesIO(data)) as img:
+        return compute_dhash(img)
+
+
+@functools.lru_cache(maxsize=None)
+def _masks(radius: int) -> Tuple[int, ...]:
+    """Every chunk-sized mask with at most radius bits set."""
+    return tuple(
+        sum(1 << bit for bit in bits)
+        for count in range(radius + 1)
+        for bits in itertools.combinations(range(CHUNK_BITS), count)
+    )
+
+
+class HashIndex:
+    """
+    Perceptual hashes by fingerprint, searchable by Hamming distance.
+
+    Args:
+        db (ConnectionManager): Cache database holding image_derivative
+
+    Notes:
+        - Thread-safe, hashes are added from executor threads
+        - Fingerprints whose derivatives are dropped by cache garbage
+          collection are removed, see remove
+    """
+
+    def __init__(self, db: ConnectionManager):
+        self.db = db
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._hashes: Dict[str, int] = {}
+        # Per chunk: chunk value to the fingerprints carrying it
+        self._tables: List[Dict[int, List[str]]] = [{} for _ in range(CHUNKS)]
+
+    def start(self):
+        """Load the stored hashes in the background."""
+        executors.submit("io", self._load, priority=executors.BACKGROUND)
+
+    def _load(self):
+        last = ""
+        loaded = backfilled = 0
+        try:
+            while True:
+                with self.db.reader() as conn:
+                    rows = conn.execute(
+                        """
+                        SELECT md5sum, dhash,
+                               CASE WHEN dhash IS NULL THEN thumbnail_webp END
+                        FROM image_derivative
+                        WHERE md5sum > ?
+                        ORDER BY md5sum
+                        LIMIT ?
+                        """,
+                        (last, LOAD_BATCH_SIZE),
+                    ).fetchall()
+                if not rows:
+                    break
+                last = rows[-1][0]
+                computed = []
+                for md5sum, dhash, thumbnail in rows:
+                    if dhash is not None:
+                        self.add(md5sum, to_unsigned(dhash))
+                    elif thumbnail:
+                        try:
+                            dhash = dhash_thumbnail(thumbnail)
+                        except Exception as e:
+                            logger.warning(f"Cannot hash thumbnail of {md5sum}: {e}")
+                            continue
+                        self.add(md5sum, dhash)
+                        computed.append((to_signed(dhash), md5sum))
+                if computed:
+                    with self.db.writer() as conn:
+                        conn.executemany(
+                            "UPDATE image_derivative SET dhash = ? WHERE md5sum = ?",
+                            computed,
+                        )
+                loaded += len(rows)
+                backfilled += len(computed)
+        except Exception as e:
+            logger.error(f"Error loading the perceptual hash index: {e}")
+        finally:
+            self._ready.set()
+        logger.info(
+            f"Loaded {loaded} fingerprints into the perceptual hash index, "
+            f"{backfilled} hashed from their thumbnails"
+        )
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the stored hashes were loaded."""
+        return self._ready.wait(timeout)
+
+    def add(self, md5sum: str, dhash: int):
+        """Index the hash of a fingerprint, replacing a previous one."""
+        with self._lock:
+            previous = self._hashes.get(md5sum)
+            if previous == dhash:
+                return
+            if previous is not None:
+                self._unlink(md5sum, previous)
+            self._hashes[md5sum] = dhash
+            for table, chunk in zip(self._tables, self._chunks(dhash)):
+                fingerprints = table.get(chunk)
+                if fingerprints is None:
+                    fingerprints = table[chunk] = []
+                fingerprints.append(md5sum)
+
+    def remove(self, md5sums: Iterable[str]):
+        """Drop the hashes of fingerprints, unknown ones are ignored."""
+        with self._lock:
+            for md5sum in md5sums:
+                dhash = self._hashes.pop(md5sum, None)
+                if dhash is not None:
+                    self._unlink(md5sum, dhash)
+
+    def _unlink(self, md5sum: str, dhash: int):
+        # Caller holds the lock
+        for table, chunk in zip(self._tables, self._chunks(dhash)):
+            table[chunk].remove(md5sum)
+            if not table[chunk]:
+                del table[chunk]
+
+    def get(self, md5sum: str) -> Optional[int]:
+        """The hash of a fingerprint, None if it was not hashed."""
+        return self._hashes.get(md5sum)
+
+    @staticmethod
+    def _chunks(dhash: int) -> List[int]:
+        return [(dhash >> (i * CHUNK_BITS)) & _CHUNK_MASK for i in range(CHUNKS)]
+
+    def _within(self, dhash: int, distance: int) -> Dict[str, int]:
+        # Caller holds the lock
+        hashes = self._hashes
+        masks = _masks(distance // CHUNKS)
+        found = set()
+        for table, chunk in zip(self._tables, self._chunks(dhash)):
+            get = table.get
+            for mask in masks:
+                bucket = get(chunk ^ mask)
+                if bucket:
+                    found.update(
+                        md5sum
+                        for md5sum in bucket
+                        if (hashes[md5sum] ^ dhash).bit_count() <= distance
+                    )
+        return {md5sum: (hashes[md5sum] ^ dhash).bit_count() for md5sum in found}
+
+    def similar(self, dhash: int, distance: int = DUPLICATE_DISTANCE) -> Dict[str, int]:
+        """
+        Find the fingerprints whose hash is close to a hash.
+
+        Args:
+            dhash (int): Hash to look up
+            distance (int): Largest Hamming distance, at most MAX_DISTANCE
+
+        Returns:
+            Dict[str, int]: Fingerprints and their distance to dhash
+        """
+        with self._lock:
+            return self._within(dhash, min(distance, MAX_DISTANCE))
+
+    def clusters(
+        self, fingerprints: Iterable[str], distance: int = DUPLICATE_DISTANCE
+    ) -> List[Set[str]]:
+        """
+        Group fingerprints into clusters of near duplicates.
+
+        Args:
+            fingerprints (Iterable[str]): Fingerprints to group, those without
+                a hash are left out
+            distance (int): Largest Hamming distance linking two fingerprints,
+                at most MAX_DISTANCE
+
+        Returns:
+            List[Set[str]]: Connected groups of at least two fingerprints,
+                where each is within distance of another one in its group
+        """
+        distance = min(distance, MAX_DISTANCE)
+        parent: Dict[str, str] = {}
+
+        def find(md5sum: str) -> str:
+            while parent[md5sum] != md5sum:
+                parent[md5sum] = parent[parent[md5sum]]
+                md5sum = parent[md5sum]
+            return md5sum
+
+        with self._lock:
+            members = {f for f in fingerprints if f in self._hashes}
+            for md5sum in members:
+                parent[md5sum] = md5sum
+            for md5sum in members:
+                for other in self._within(self._hashes[md5sum], distance):
+                    if other in members:
+                        a, b = find(md5sum), find(other)
+                        if a != b:
+                            parent[b] = a
+
+        groups: Dict[str, Set[str]] = {}
+        for md5sum in members:
+            groups.setdefault(find(md5sum), set()).add(md5sum)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def stats(self) -> Dict:
+        """
+        Report the size of the index.
+
+        Returns:
+            Dict: Statistics
+                - fingerprints: Hashed fingerprints
+                - ready: Whether the stored hashes were loaded
+        """
+        return {"fingerprints": len(self._hashes), "ready": self._ready.is_set()}
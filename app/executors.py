@@ -0,0 +1,351 @@
+"""
+Thread pools per workload class, running queued work by priority.
+
+Blocking work is split into workload classes with their own thread pool and
+concurrency limit, so a burst in one class cannot starve the others:
+- io: stat calls, directory revalidation and cache database maintenance
+- image: image info, thumbnail and preview generation
+- inference: caption generation models
+- fs-mutation: moving and deleting files
+
+The standard ThreadPoolExecutor runs jobs strictly in submission order, so a
+burst of queued work (e.g. the image info jobs of a folder the user already
+scrolled away from) delays everything submitted after it. PriorityExecutor
+pops the job with the lowest priority value first and runs jobs of equal
+priority in submission order. Interactive requests take a fresh priority from
+interactive_priority(), so the newest request runs first and background work
+only runs when no interactive work is queued. Newest first alone would starve
+the remaining jobs of an older request under sustained browsing, so an
+interactive job queued for more than STARVATION_SECONDS runs before newer
+ones, oldest first. Jobs still queued can be cancelled through their future
+and are then skipped without running.
+
+Usage:
+    ```python
+    thumbnail = await executors.run("image", render, path)
+    executors.submit("io", revalidate, directory, priority=executors.BACKGROUND)
+    ```
+"""
+
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Priority of background work, interactive_priority() is always lower
+BACKGROUND = 1.0
+
+# Seconds after which a queued interactive job runs before newer ones
+STARVATION_SECONDS = 2.0
+
+# Default worker threads per workload class
+WORKLOAD_WORKERS = {
+    "io": 16,
+    "image": os.cpu_count() or 1,
+    "inference": 1,
+    "fs-mutation": 4,
+}
+
+# Sorts after every job, so workers drain the queue before they exit
+_SHUTDOWN = (float("inf"), float("inf"), 0.0, None, None, None, None)
+
+_interactive_sequence = itertools.count(1)
+_executors: Dict[str, "PriorityExecutor"] = {}
+_executors_lock = threading.Lock()
+
+
+def interactive_priority() -> float:
+    """Priority for the jobs of a new interactive request, newer runs first."""
+    return -float(next(_interactive_sequence))
+
+
+class _AgingQueue:
+    """
+    Blocking priority queue whose interactive entries age.
+
+    Entries are (priority, sequence, queued_at, ...) tuples with a unique
+    sequence. get() returns the lowest (priority, sequence) first, unless the
+    oldest interactive entry (priority below BACKGROUND) has been queued for
+    more than STARVATION_SECONDS, which is returned instead.
+
+    Notes:
+        - Interactive entries are kept in a heap and a FIFO, an entry taken
+          from one is skipped lazily in the other
+    """
+
+    def __init__(self):
+        self._heap: list = []
+        self._fifo: deque = deque()
+        self._taken: set = set()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def put(self, entry: tuple):
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if entry[0] < BACKGROUND:
+                self._fifo.append(entry)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, block: bool = True) -> Optional[tuple]:
+        """Next entry, or None if the queue is empty and block is False."""
+        with self._cond:
+            while True:
+                while self._fifo and self._fifo[0][1] in self._taken:
+                    self._taken.discard(self._fifo.popleft()[1])
+                if (
+                    self._fifo
+                    and time.monotonic() - self._fifo[0][2] > STARVATION_SECONDS
+                ):
+                    entry = self._fifo.popleft()
+                    self._taken.add(entry[1])
+                elif self._heap:
+                    entry = heapq.heappop(self._heap)
+                    if entry[1] in self._taken:
+                        self._taken.discard(entry[1])
+                        continue
+                    if entry[0] < BACKGROUND:
+                        self._taken.add(entry[1])
+                elif block:
+                    self._cond.wait()
+                    continue
+                else:
+                    return None
+                self._size -= 1
+                return entry
+
+    def qsize(self) -> int:
+        return self._size
+
+
+class PriorityExecutor(Executor):
+    """
+    Thread pool executing the lowest priority value first.
+
+    Args:
+        max_workers (int): Maximum number of worker threads
+        thread_name_prefix (str): Prefix of the worker thread names
+
+    Notes:
+        - Workers are started on demand, up to max_workers
+        - Worker threads are daemons, work still queued at interpreter exit is
+          dropped
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = "priority"):
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = _AgingQueue()
+        self._sequence = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._shutdown = False
+        # Metrics, updated under _lock
+        self._running = 0
+        self._peak_queued = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._wait_time = 0.0
+
+    def submit(self, fn: Callable, /, *args, priority: float = 0, **kwargs) -> Future:
+        """
+        Queue a call of fn(*args, **kwargs).
+
+        Args:
+            fn (Callable): Function to run on a worker thread
+            priority (float): Lower values run first
+
+        Returns:
+            Future: Result of the call, cancel() drops it while still queued
+
+        Raises:
+            RuntimeError: If the executor was shut down
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            future = Future()
+            self._queue.put(
+                (
+                    priority,
+                    next(self._sequence),
+                    time.monotonic(),
+                    future,
+                    fn,
+                    args,
+                    kwargs,
+                )
+            )
+            self._peak_queued = max(self._peak_queued, self._queue.qsize())
+            self._adjust_thread_count()
+        return future
+
+    def _adjust_thread_count(self):
+        # An idle worker will pick the job up
+        if self._idle.acquire(blocking=False):
+            return
+        if len(self._threads) < self.max_workers:
+            thread = threading.Thread(
+                target=self._work,
+                name=f"{self.thread_name_prefix}_{len(self._threads)}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            _, _, queued_at, future, fn, args, kwargs = self._queue.get()
+            if future is None:
+                self._queue.put(_SHUTDOWN)  # Wake the next worker
+                return
+            if future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._running += 1
+                    self._wait_time += time.monotonic() - queued_at
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                del future, fn, args, kwargs
+            else:
+                with self._lock:
+                    self._cancelled += 1
+            self._idle.release()
+
+    def qsize(self) -> int:
+        """Number of queued jobs, including cancelled ones not yet skipped."""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict:
+        """
+        Report concurrency and queue depth.
+
+        Returns:
+            Dict: Statistics
+                - max_workers: Concurrency limit
+                - threads: Worker threads started
+                - running: Jobs running now
+                - queued: Jobs waiting now
+                - peak_queued: Deepest queue since startup
+                - completed: Jobs run since startup
+                - cancelled: Jobs cancelled before they started
+                - average_wait: Mean seconds a job waited in the queue
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "threads": len(self._threads),
+                "running": self._running,
+                "queued": self._queue.qsize(),
+                "peak_queued": self._peak_queued,
+                "completed": self._completed,
+                "cancelled": self._cancelled,
+                "average_wait": (
+                    self._wait_time / self._completed if self._completed else 0.0
+                ),
+            }
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while (item := self._queue.get(block=False)) is not None:
+                    if item[3] is not None:
+                        item[3].cancel()
+            self._queue.put(_SHUTDOWN)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def configure(workload: str, max_workers: int):
+    """
+    Set the concurrency limit of a workload class.
+
+    Args:
+        workload (str): Workload class, one of WORKLOAD_WORKERS
+        max_workers (int): Maximum number of worker threads
+
+    Notes:
+        - Lowering the limit of a running executor takes effect for threads
+          started afterwards, running threads are kept
+    """
+    if workload not in WORKLOAD_WORKERS:
+        raise KeyError(f"Unknown workload class: {workload}")
+    if max_workers <= 0:
+        raise ValueError("max_workers must be greater than 0")
+    with _executors_lock:
+        WORKLOAD_WORKERS[workload] = max_workers
+        if workload in _executors:
+            _executors[workload].max_workers = max_workers
+
+
+def get_executor(workload: str) -> PriorityExecutor:
+    """Get the executor of a workload class, creating it on first use."""
+    with _executors_lock:
+        executor = _executors.get(workload)
+        if executor is None:
+            if workload not in WORKLOAD_WORKERS:
+                raise KeyError(f"Unknown workload class: {workload}")
+            executor = PriorityExecutor(WORKLOAD_WORKERS[workload], workload)
+            _executors[workload] = executor
+        return executor
+
+
+def submit(
+    workload: str, fn: Callable[..., T], /, *args, priority: float = 0, **kwargs
+) -> Future:
+    """Queue fn(*args, **kwargs) on the executor of a workload class."""
+    return get_executor(workload).submit(fn, *args, priority=priority, **kwargs)
+
+
+async def run(
+    workload: str,
+    fn: Callable[..., T],
+    /,
+    *args: Any,
+    priority: Optional[float] = None,
+    **kwargs: Any,
+) -> T:
+    """
+    Run fn(*args, **kwargs) on the executor of a workload class and await it.
+
+    Args:
+        workload (str): Workload class, one of WORKLOAD_WORKERS
+        fn (Callable[..., T]): Blocking function to run
+        priority (float, optional): Lower values run first, a fresh
+            interactive_priority() by default
+
+    Returns:
+        T: Result of the call
+
+    Notes:
+        - Cancelling the awaiting task drops the job if it has not started
+    """
+    if priority is None:
+        priority = interactive_priority()
+    job = submit(workload, functools.partial(fn, *args, **kwargs), priority=priority)
+    return await asyncio.wrap_future(job)
+
+
+def stats() -> Dict[str, Dict]:
+    """Statistics of every workload class, see PriorityExecutor.stats."""
+    return {name: get_executor(name).stats() for name in WORKLOAD_WORKERS}
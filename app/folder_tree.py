@@ -0,0 +1,567 @@
+"""
+Folder tree of the image root, kept in memory and in the cache database.
+
+`/api/folders` used to walk the whole root directory on every call, which takes
+tens of seconds on trees with millions of files. The tree is now built once,
+persisted in the `folder` table and kept current incrementally:
+- Directory scans report the subdirectories and images they saw (update)
+- Folder creation, moves and deletes through the API update it directly
+- A background refresh at startup re-lists only directories whose mtime
+  changed since they were last listed, since adding or removing a
+  subdirectory changes the mtime of its parent
+- Optionally, a watchfiles watcher reports folders created or deleted outside
+  of yipyap
+
+Every folder also carries aggregate statistics: image count, bytes, favorites
+and per caption type the number of images having that caption. The statistics
+of a folder's own files are persisted with its row; subtree totals are kept in
+memory and rolled up to all ancestors whenever a folder changes, so both are
+read in O(1).
+
+Responses are served from memory. Every change bumps a generation counter that
+is part of the ETag, so unchanged trees are answered with 304 Not Modified.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Set
+
+from . import executors
+from .db import ConnectionManager
+from .directory_cache import DirectoryListing
+
+logger = logging.getLogger("uvicorn.error")
+
+FOLDER_KEY = ("directory",)
+
+
+class FolderStats:
+    """
+    Aggregate statistics of the images in a folder or subtree.
+
+    Attributes:
+        images (int): Number of images
+        bytes (int): Total size of the images
+        favorites (int): Images with a favorite state set
+        captions (Dict[str, int]): Images having a caption, per caption type
+            (e.g. "tags")
+    """
+
+    __slots__ = ("images", "bytes", "favorites", "captions")
+
+    def __init__(
+        self,
+        images: int = 0,
+        bytes: int = 0,
+        favorites: int = 0,
+        captions: Optional[Dict[str, int]] = None,
+    ):
+        self.images = images
+        self.bytes = bytes
+        self.favorites = favorites
+        self.captions = captions or {}
+
+    @classmethod
+    def from_listing(cls, listing: DirectoryListing, favorites: int) -> "FolderStats":
+        stats = cls(len(listing.images), sum(e.size for e in listing.images))
+        stats.favorites = favorites
+        for entry in listing.images:
+            for suffix in entry.captions:
+                caption_type = suffix[1:]
+                stats.captions[caption_type] = stats.captions.get(caption_type, 0) + 1
+        return stats
+
+    def add(self, other: "FolderStats", sign: int = 1):
+        """Add (or with sign -1 subtract) another set of statistics in place."""
+        self.images += sign * other.images
+        self.bytes += sign * other.bytes
+        self.favorites += sign * other.favorites
+        for caption_type, count in other.captions.items():
+            total = self.captions.get(caption_type, 0) + sign * count
+            if total:
+                self.captions[caption_type] = total
+            else:
+                self.captions.pop(caption_type, None)
+
+    def to_dict(self) -> Dict:
+        return {
+            "images": self.images,
+            "bytes": self.bytes,
+            "favorites": self.favorites,
+            "captions": dict(self.captions),
+        }
+
+
+class _Folder:
+    """
+    A known directory.
+
+    Attributes:
+        children (Set[str]): Subdirectory names
+        mtime (Optional[float]): Directory mtime the children and local stats
+            were read at, None if not listed yet
+        local (FolderStats): Statistics of the images directly inside
+        total (FolderStats): Statistics of the whole subtree
+    """
+
+    __slots__ = ("children", "mtime", "local", "total")
+
+    def __init__(self, mtime: Optional[float] = None, local: FolderStats = None):
+        self.children: Set[str] = set()
+        self.mtime = mtime
+        self.local = local or FolderStats()
+        self.total = FolderStats()
+        self.total.add(self.local)
+
+
+class FolderTree:
+    """
+    Subdirectories of a root directory, served from memory.
+
+    Args:
+        root (Path): Root directory, itself not listed as a folder
+        db (ConnectionManager): Cache database holding the `folder` table
+        scan (Callable[[Path, float], DirectoryListing]): Lists a directory
+            given its mtime, used by refresh()
+
+    Notes:
+        - Hidden directories and their subtrees are skipped
+        - A folder row with a NULL mtime has not been listed yet
+        - Rows are moved and deleted together with the other per-directory
+          cache tables (see CachedFileSystemDataSource._forget_subtree), so
+          move() and forget() only update memory
+        - Thread-safe, updates come from executor and watcher threads
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        db: ConnectionManager,
+        scan: Callable[[Path, float], DirectoryListing],
+    ):
+        self.root = root
+        self.db = db
+        self._scan = scan
+        self._folders: Dict[Path, _Folder] = {}
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self._responses: Dict[Optional[Path], dict] = {}
+        self._token = f"{time.time_ns():x}"  # ETags do not survive restarts
+        self.generation = 0
+
+    def start(self):
+        """
+        Load the persisted tree and refresh it in the background.
+
+        Notes:
+            - The tree is served once loaded, a missing tree is built by the
+              refresh and requests wait for it
+        """
+        if self._load():
+            self._ready.set()
+        executors.submit("io", self.refresh, priority=executors.BACKGROUND)
+
+    def _load(self) -> bool:
+        base = str(self.root).rstrip("/")
+        with self.db.reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT directory, mtime, images, bytes, favorites, captions
+                FROM folder
+                WHERE directory = ? OR (directory >= ? AND directory < ?)
+                """,
+                (str(self.root), base + "/", base + "0"),
+            ).fetchall()
+        if not any(row[0] == str(self.root) for row in rows):
+            return False
+        with self._lock:
+            for directory, mtime, images, size, favorites, captions in rows:
+                local = FolderStats(
+                    images or 0,
+                    size or 0,
+                    favorites or 0,
+                    json.loads(captions) if captions else None,
+                )
+                self._folders[Path(directory)] = _Folder(mtime, local)
+            # Roll the local statistics up into the subtree totals
+            for directory, folder in self._folders.items():
+                if directory == self.root:
+                    continue
+                parent = self._folders.get(directory.parent)
+                if parent is not None:
+                    parent.children.add(directory.name)
+                for ancestor in directory.parents:
+                    if not ancestor.is_relative_to(self.root):
+                        break
+                    if ancestor in self._folders:
+                        self._folders[ancestor].total.add(folder.local)
+            self._changed()
+        logger.info(f"Loaded folder tree with {len(rows)} folders")
+        return True
+
+    def _changed(self):
+        self.generation += 1
+        self._responses.clear()
+
+    def _roll_up(self, directory: Path, stats: FolderStats, sign: int = 1):
+        # Caller holds the lock
+        current = directory
+        while True:
+            folder = self._folders.get(current)
+            if folder is not None:
+                folder.total.add(stats, sign)
+            if current == self.root or current.parent == current:
+                return
+            current = current.parent
+
+    def _count_favorites(self, directory: Path) -> int:
+        with self.db.reader() as conn:
+            return conn.execute(
+                """
+                SELECT count(*) FROM image_info
+                WHERE directory = ? AND favorite_state > 0 AND deleted = 0
+                """,
+                (str(directory),),
+            ).fetchone()[0]
+
+    def refresh(self, directory: Optional[Path] = None):
+        """
+        Bring the tree below a directory up to date with the file system.
+
+        Args:
+            directory (Optional[Path]): Subtree to refresh, the root by default
+
+        Notes:
+            - Stats every known directory but only scans those whose mtime
+              changed since they were last listed
+            - Runs synchronously, call it from an executor
+        """
+        directory = directory or self.root
+        start = time.monotonic()
+        listed = 0
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            try:
+                mtime = os.stat(current).st_mtime
+                with self._lock:
+                    folder = self._folders.get(current)
+                    unchanged = folder is not None and folder.mtime == mtime
+                if not unchanged:
+                    self.update(current, self._scan(current, mtime), walk=False)
+                    listed += 1
+            except FileNotFoundError:
+                self.remove(current)
+                continue
+            except OSError as e:
+                logger.warning(f"Could not list folder {current}: {e}")
+                continue
+            with self._lock:
+                folder = self._folders.get(current)
+                children = list(folder.children) if folder else []
+            stack.extend(current / name for name in children)
+        self._ready.set()
+        logger.info(
+            f"Refreshed folder tree below {directory} in "
+            f"{time.monotonic() - start:.1f}s, listed {listed} folders"
+        )
+
+    def update(self, directory: Path, listing: DirectoryListing, walk: bool = True):
+        """
+        Record the subdirectories and image statistics of a scanned directory.
+
+        Args:
+            directory (Path): Scanned directory
+            listing (DirectoryListing): Its listing
+            walk (bool): Refresh the subtrees of new subdirectories in the
+                background
+
+        Notes:
+            - Ignored for directories outside the known tree
+            - Subtrees of subdirectories that disappeared are dropped
+            - Changed statistics are rolled up to all ancestors
+        """
+        if directory not in self and directory != self.root:
+            return
+        names = set(listing.dir_names)
+        local = FolderStats.from_listing(listing, self._count_favorites(directory))
+        with self._lock:
+            folder = self._folders.get(directory)
+            if folder is None and directory != self.root:
+                return
+            if folder is None:
+                folder = self._folders[directory] = _Folder()
+            if (
+                folder.mtime == listing.mtime
+                and folder.children == names
+                and folder.local.to_dict() == local.to_dict()
+            ):
+                return
+            added = names - folder.children
+            removed = folder.children - names
+            for name in removed:
+                child = self._folders.get(directory / name)
+                if child is not None:
+                    self._roll_up(directory, child.total, -1)
+                self._drop(directory / name)
+            for name in added:
+                self._folders.setdefault(directory / name, _Folder())
+            self._roll_up(directory, folder.local, -1)
+            self._roll_up(directory, local)
+            folder.children = names
+            folder.mtime = listing.mtime
+            folder.local = local
+            self._changed()
+
+        for name in removed:
+            self._delete_rows(directory / name)
+        self.db.write_behind(
+            "folder",
+            FOLDER_KEY,
+            {
+                "directory": str(directory),
+                "mtime": listing.mtime,
+                "images": local.images,
+                "bytes": local.bytes,
+                "favorites": local.favorites,
+                "captions": json.dumps(local.captions),
+            },
+        )
+        for name in added:
+            self.db.write_behind(
+                "folder", FOLDER_KEY, {"directory": str(directory / name)}
+            )
+            if walk:
+                executors.submit(
+                    "io", self.refresh, directory / name, priority=executors.BACKGROUND
+                )
+
+    def add(self, directory: Path):
+        """Record a directory created through the API, with missing parents."""
+        new = []
+        with self._lock:
+            current = directory
+            while current != self.root and current not in self._folders:
+                if not current.is_relative_to(self.root):
+                    return
+                if current.name.startswith("."):
+                    return
+                new.append(current)
+                current = current.parent
+            if current not in self._folders:
+                return
+            for path in reversed(new):
+                self._folders[path] = _Folder()
+                self._folders[path.parent].children.add(path.name)
+            if new:
+                self._changed()
+        for path in new:
+            self.db.write_behind("folder", FOLDER_KEY, {"directory": str(path)})
+
+    def remove(self, directory: Path):
+        """Drop a deleted directory and its subtree, in memory and persisted."""
+        if self.forget(directory):
+            self._delete_rows(directory)
+
+    def forget(self, directory: Path) -> bool:
+        """
+        Drop a directory and its subtree from memory only.
+
+        Returns:
+            bool: Whether the directory was known
+        """
+        with self._lock:
+            folder = self._folders.get(directory)
+            if folder is None:
+                return False
+            parent = self._folders.get(directory.parent)
+            if parent is not None:
+                parent.children.discard(directory.name)
+                self._roll_up(directory.parent, folder.total, -1)
+            self._drop(directory)
+            self._changed()
+            return True
+
+    def update_favorites(self, directory: Path):
+        """Recount the favorites of a directory after a favorite changed."""
+        if directory not in self:
+            return
+        favorites = self._count_favorites(directory)
+        with self._lock:
+            folder = self._folders.get(directory)
+            if folder is None or folder.local.favorites == favorites:
+                return
+            delta = FolderStats(favorites=favorites - folder.local.favorites)
+            folder.local.favorites = favorites
+            self._roll_up(directory, delta)
+            self._changed()
+        with self.db.writer() as conn:
+            conn.execute(
+                "UPDATE folder SET favorites = ? WHERE directory = ?",
+                (favorites, str(directory)),
+            )
+
+    def stats(self, directory: Path) -> Dict:
+        """
+        Statistics of a folder.
+
+        Args:
+            directory (Path): A known folder or the root
+
+        Returns:
+            Dict: "local" statistics of the images directly inside and "total"
+                statistics of the whole subtree, see FolderStats
+
+        Raises:
+            KeyError: If the folder is not known
+        """
+        with self._lock:
+            folder = self._folders[directory]
+            return {
+                "path": str(directory.relative_to(self.root)),
+                "listed": folder.mtime is not None,
+                "local": folder.local.to_dict(),
+                "total": folder.total.to_dict(),
+            }
+
+    def move(self, source: Path, target: Path):
+        """Re-key a moved directory and its subtree in memory only."""
+        with self._lock:
+            moved = {
+                path: folder
+                for path, folder in self._folders.items()
+                if path == source or path.is_relative_to(source)
+            }
+            if not moved:
+                return
+            self.forget(source)
+            self.forget(target)
+            self.add(target.parent)
+            parent = self._folders.get(target.parent)
+            if parent is None:
+                return
+            parent.children.add(target.name)
+            for path, folder in moved.items():
+                self._folders[target / path.relative_to(source)] = folder
+            if source in moved:
+                self._roll_up(target.parent, moved[source].total)
+            self._changed()
+
+    def _drop(self, directory: Path):
+        # Caller holds the lock
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            folder = self._folders.pop(path, None)
+            if folder is not None:
+                stack.extend(path / name for name in folder.children)
+
+    def _delete_rows(self, directory: Path):
+        base = str(directory).rstrip("/")
+        with self.db.writer() as conn:
+            conn.execute(
+                """
+                DELETE FROM folder
+                WHERE directory = ? OR (directory >= ? AND directory < ?)
+                """,
+                (str(directory), base + "/", base + "0"),
+            )
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the tree was loaded or built."""
+        return self._ready.wait(timeout)
+
+    def etag(self) -> str:
+        return f'"{self._token}-{self.generation}"'
+
+    def folders(self, parent: Optional[Path] = None) -> dict:
+        """
+        Build the `/api/folders` response.
+
+        Args:
+            parent (Optional[Path]): Only list the direct subdirectories of
+                this directory, with a hasChildren flag for lazy expansion
+
+        Returns:
+            dict: {"folders": [{"name", "path", "fullPath", "stats"}], "root"}
+                sorted by fullPath, stats being the subtree totals
+
+        Raises:
+            KeyError: If parent is not a known folder
+        """
+        with self._lock:
+            response = self._responses.get(parent)
+            if response is not None:
+                return response
+            if parent is None:
+                paths = [path for path in self._folders if path != self.root]
+            else:
+                folder = self._folders[parent]
+                paths = [parent / name for name in folder.children]
+            entries = []
+            for path in paths:
+                entry = {
+                    "name": path.name,
+                    "path": str(path.parent.relative_to(self.root)),
+                    "fullPath": str(path.relative_to(self.root)),
+                    "stats": self._folders[path].total.to_dict(),
+                }
+                if parent is not None:
+                    entry["hasChildren"] = bool(self._folders[path].children)
+                entries.append(entry)
+            entries.sort(key=lambda x: x["fullPath"])
+            response = {"folders": entries, "root": str(self.root)}
+            self._responses[parent] = response
+            return response
+
+    def __contains__(self, directory: Path) -> bool:
+        with self._lock:
+            return directory in self._folders
+
+    def __len__(self) -> int:
+        return len(self._folders)
+
+
+def start_watcher(tree: FolderTree) -> Optional[threading.Thread]:
+    """
+    Watch the root directory for folders created or deleted outside yipyap.
+
+    Args:
+        tree (FolderTree): Tree to keep current
+
+    Returns:
+        Optional[threading.Thread]: The watcher thread, or None if watchfiles
+            is not installed
+
+    Notes:
+        - Uses inotify on Linux, which needs one watch per directory, see
+          /proc/sys/fs/inotify/max_user_watches for large trees
+    """
+    try:
+        import watchfiles
+    except ImportError:
+        logger.warning("watchfiles is not installed, folder watching disabled")
+        return None
+
+    def run():
+        for changes in watchfiles.watch(tree.root, recursive=True):
+            for change, path in changes:
+                path = Path(path)
+                try:
+                    if change == watchfiles.Change.deleted and path in tree:
+                        tree.remove(path)
+                    elif change == watchfiles.Change.added and path.is_dir():
+                        tree.add(path)
+                        executors.submit(
+                            "io", tree.refresh, path, priority=executors.BACKGROUND
+                        )
+                except Exception as e:
+                    logger.warning(f"Error updating folder tree for {path}: {e}")
+
+    thread = threading.Thread(target=run, name="folder-watcher", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,454 @@
+"""
+Integrity verification of the images in a folder subtree.
+
+Derivatives are generated with ImageFile.LOAD_TRUNCATED_IMAGES set (see
+app.drhead_loader), so a truncated file renders as a thumbnail with a grey
+band instead of failing, and an unreadable ICC profile only logs a warning.
+The verifier decodes every image strictly instead, in a pool of worker
+processes: decoding is CPU bound, and a decoder crashing on a corrupt file
+takes down a worker rather than the server. Like derivative generation, every
+decode first holds its estimated memory footprint in the decode budget (see
+app.derivatives), so a few huge images are verified one after another instead
+of together. Each outcome is one of:
+- ok: The image decodes completely
+- truncated: The file ends before its image data does
+- bad_icc: The image decodes, but its embedded ICC profile does not parse
+- decoder_error: The format is not recognized or the data is corrupt
+
+Outcomes are stored per fingerprint (the MD5 of a file's contents) in the
+image_integrity table (schema version 7, see app.cache_schema), so copies
+share one and a verification run only decodes contents it has not seen
+before. Fingerprints are read from image_info when the cached row matches the
+file's mtime and size, other files are hashed on the io executor.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageCms, ImageFile, ImageSequence, UnidentifiedImageError
+
+from . import executors
+from .db import ConnectionManager
+from .derivatives import DecodeBudget, decode_budget, estimate_decode_footprint
+
+logger = logging.getLogger("uvicorn.error")
+
+INTEGRITY_KEY = ("md5sum",)
+
+# Worker processes of a verification run. Decodes are admitted by the decode
+# memory budget like derivative generation, see app.derivatives.
+VERIFY_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Files fingerprinted and looked up per io job, and io jobs in flight
+LOOKUP_BATCH_SIZE = 64
+LOOKUP_CONCURRENCY = 4
+
+# Seconds between progress events while images are being decoded
+PROGRESS_INTERVAL = 1.0
+
+
+def _init_worker():
+    """Set up a worker process for strict decoding."""
+    Image.MAX_IMAGE_PIXELS = None
+    ImageFile.LOAD_TRUNCATED_IMAGES = False
+    try:
+        import pillow_jxl  # noqa: F401
+    except ImportError:
+        pass
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+
+
+def check_image(data: bytes) -> Tuple[str, Optional[str]]:
+    """
+    Decode an image strictly.
+
+    Args:
+        data (bytes): Contents of the image file
+
+    Returns:
+        Tuple[str, Optional[str]]: Status, see the module docstring, and the
+            error message for anything but "ok"
+
+    Notes:
+        - Decodes every frame of animated images
+        - Relies on ImageFile.LOAD_TRUNCATED_IMAGES being unset
+    """
+    try:
+        # Checks what the decoder skips, e.g. PNG chunk checksums
+        with Image.open(BytesIO(data)) as img:
+            img.verify()
+        with Image.open(BytesIO(data)) as img:
+            icc = img.info.get("icc_profile")
+            for frame in ImageSequence.Iterator(img):
+                frame.load()
+    except UnidentifiedImageError:
+        return "decoder_error", "Unrecognized image format"
+    except Exception as e:
+        message = str(e) or type(e).__name__
+        status = "truncated" if "truncated" in message.lower() else "decoder_error"
+        return status, message
+    if icc:
+        try:
+            ImageCms.ImageCmsProfile(BytesIO(icc))
+        except (OSError, ImageCms.PyCMSError) as e:
+            return "bad_icc", str(e)
+    return "ok", None
+
+
+def _ping() -> bool:
+    """Run by a fresh pool to check that its workers start."""
+    return True
+
+
+def estimate_footprint(path: Path) -> int:
+    """
+    Estimate the memory a worker holds to verify a file.
+
+    Args:
+        path (Path): Image file
+
+    Returns:
+        int: File size plus the decoded pixels estimated from the header,
+            see app.derivatives.estimate_decode_footprint
+
+    Notes:
+        - Files whose header cannot be read only count their size, the
+          worker rejects them before decoding
+    """
+    try:
+        with Image.open(path) as img:
+            pixels = estimate_decode_footprint(img)
+    except Exception:
+        pixels = 0
+    try:
+        return os.path.getsize(path) + pixels
+    except OSError:
+        return pixels
+
+
+def verify_file(path: str) -> Tuple[str, str, Optional[str]]:
+    """
+    Fingerprint and strictly decode an image file, in a worker process.
+
+    Args:
+        path (str): Image file
+
+    Returns:
+        Tuple[str, str, Optional[str]]: MD5 of the contents that were
+            decoded, status and error message, see check_image
+
+    Raises:
+        OSError: If the file cannot be read
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return hashlib.md5(data).hexdigest(), *check_image(data)
+
+
+class IntegrityVerifier:
+    """
+    Verifies images on a process pool and remembers the outcome.
+
+    Args:
+        db (ConnectionManager): Cache database holding image_integrity
+        fingerprint (Callable[[Path], str]): Computes the MD5 of a file
+        workers (int): Worker processes of a verification run
+        budget (DecodeBudget): Memory budget held by each decode until its
+            worker finishes
+
+    Notes:
+        - Every run starts its own pool, which is shut down when the run
+          ends or its consumer goes away
+        - A file that kills its worker is retried alone, and reported as a
+          decoder_error if it does so again. Such outcomes are not stored.
+        - A replacement pool is checked with a no-op job first, a run whose
+          workers cannot start ends with an error event instead of blaming
+          the files
+    """
+
+    def __init__(
+        self,
+        db: ConnectionManager,
+        fingerprint: Callable[[Path], str],
+        workers: int = VERIFY_WORKERS,
+        budget: DecodeBudget = decode_budget,
+    ):
+        self.db = db
+        self.fingerprint = fingerprint
+        self.workers = workers
+        self.budget = budget
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Forking a threaded server copies locks held by other threads
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def _lookup(
+        self, targets: Sequence[Tuple[Path, Optional[str]]], recheck: bool
+    ) -> List[Tuple[Path, Optional[str], Optional[Tuple[str, Optional[str]]], int]]:
+        """Fingerprint files, read their stored outcomes and size the rest."""
+        resolved = []
+        for path, md5sum in targets:
+            if md5sum is None:
+                try:
+                    md5sum = self.fingerprint(path)
+                except OSError as e:
+                    logger.warning(f"Cannot fingerprint {path}: {e}")
+            resolved.append((path, md5sum))
+        stored = {}
+        known = [md5sum for _, md5sum in resolved if md5sum]
+        if known and not recheck:
+            with self.db.reader() as conn:
+                stored = {
+                    md5sum: (status, error)
+                    for md5sum, status, error in conn.execute(
+                        f"""
+                        SELECT md5sum, status, error FROM image_integrity
+                        WHERE md5sum IN ({', '.join('?' for _ in known)})
+                        """,
+                        known,
+                    )
+                }
+        return [
+            (
+                path,
+                md5sum,
+                stored.get(md5sum),
+                estimate_footprint(path) if md5sum and md5sum not in stored else 0,
+            )
+            for path, md5sum in resolved
+        ]
+
+    def _store(self, md5sum: str, status: str, error: Optional[str]):
+        self.db.write_behind(
+            "image_integrity",
+            INTEGRITY_KEY,
+            {
+                "md5sum": md5sum,
+                "status": status,
+                "error": error,
+                "checked_time": int(time.time()),
+            },
+        )
+
+    def _release_unused(self, admission: Future):
+        """Give back the budget an abandoned admission acquired."""
+        if not admission.cancelled() and admission.exception() is None:
+            self.budget.release(admission.result())
+
+    async def verify(
+        self,
+        targets: Sequence[Tuple[Path, Optional[str]]],
+        root: Path,
+        recheck: bool = False,
+    ) -> AsyncIterator[Dict]:
+        """
+        Verify images, streaming progress.
+
+        Args:
+            targets (Sequence[Tuple[Path, Optional[str]]]): Image files and
+                their fingerprint, None if it has to be computed
+            root (Path): Directory the reported paths are relative to
+            recheck (bool): Decode images again even if their fingerprint
+                was verified before
+
+        Yields:
+            Dict: Events, each with a "type":
+                - start: "total" images to verify
+                - failure: "path", "status" and "error" of a broken image,
+                  "cached" if it was found broken by an earlier run
+                - progress: "checked" images of "total", "skipped" unreadable
+                  ones, "failed" ones and the distinct contents "decoded" by
+                  this run, sent every PROGRESS_INTERVAL seconds
+                - done: The final counts in the shape of progress, with the
+                  "statuses" of the checked images and the run's "seconds"
+                - error: Sent instead of done when the workers cannot start,
+                  with the counts so far and the "error"
+        """
+        started = time.monotonic()
+        total = len(targets)
+        statuses: Counter = Counter()
+        counts = {"checked": 0, "decoded": 0, "skipped": 0, "failed": 0}
+
+        def progress(kind: str) -> Dict:
+            return {"type": kind, **counts, "total": total}
+
+        def outcome(path: Path, status: str, error: Optional[str], cached: bool):
+            counts["checked"] += 1
+            statuses[status] += 1
+            if status == "ok":
+                return None
+            counts["failed"] += 1
+            return {
+                "type": "failure",
+                "path": str(path.relative_to(root)),
+                "status": status,
+                "error": error,
+                "cached": cached,
+            }
+
+        yield {"type": "start", "total": total}
+        pool = self._pool()
+        pending: Dict[asyncio.Future, Tuple] = {}
+        # (path, fingerprint, footprint, attempt) awaiting a worker
+        queued: deque = deque()
+        retries: deque = deque()  # files in flight when a worker died
+        # Fingerprints queued or decoding, to every path carrying them
+        copies: Dict[str, List[Path]] = {}
+        # The budget acquisition in flight and the file it admits
+        admission: Optional[Tuple[Future, Tuple]] = None
+        decoding = 0
+        next_batch = 0
+        last_progress = time.monotonic()
+        try:
+            while pending or queued or retries or next_batch < total:
+                # Fingerprint ahead only as far as the workers can keep up
+                lookups = sum(1 for job in pending.values() if job[0] == "lookup")
+                while (
+                    next_batch < total
+                    and lookups < LOOKUP_CONCURRENCY
+                    and len(queued) < self.workers * 4
+                ):
+                    batch = targets[next_batch : next_batch + LOOKUP_BATCH_SIZE]
+                    next_batch += len(batch)
+                    job = executors.run(
+                        "io",
+                        self._lookup,
+                        batch,
+                        recheck,
+                        priority=executors.BACKGROUND,
+                    )
+                    pending[asyncio.ensure_future(job)] = ("lookup",)
+                    lookups += 1
+                # Wait for the budget of one file at a time, retried files
+                # decode alone on the pool
+                source, room = (retries, 1) if retries else (queued, self.workers * 2)
+                if admission is None and source and decoding < room:
+                    item = source.popleft()
+                    acquire = executors.submit(
+                        "io",
+                        self.budget.acquire,
+                        item[2],
+                        priority=executors.BACKGROUND,
+                    )
+                    admission = (acquire, item)
+                    pending[asyncio.wrap_future(acquire)] = ("admit",)
+
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=PROGRESS_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                broken = False
+                for future in done:
+                    job = pending.pop(future)
+                    if job[0] == "lookup":
+                        for path, md5sum, stored, footprint in future.result():
+                            if md5sum is None:
+                                counts["skipped"] += 1
+                            elif md5sum in copies:
+                                copies[md5sum].append(path)
+                            elif stored is None:
+                                copies[md5sum] = [path]
+                                queued.append((path, md5sum, footprint, 1))
+                            elif event := outcome(path, *stored, cached=True):
+                                yield event
+                        continue
+
+                    if job[0] == "admit":
+                        weight = future.result()
+                        item = admission[1]
+                        admission = None
+                        if retries and item[3] == 1:
+                            # A worker died meanwhile, isolate the retries
+                            self.budget.release(weight)
+                            queued.appendleft(item)
+                            continue
+                        try:
+                            decode = pool.submit(verify_file, str(item[0]))
+                        except BrokenProcessPool:
+                            self.budget.release(weight)
+                            retries.appendleft(item)
+                            broken = True
+                            continue
+                        decode.add_done_callback(
+                            lambda _, weight=weight: self.budget.release(weight)
+                        )
+                        pending[asyncio.wrap_future(decode)] = ("decode", item, pool)
+                        decoding += 1
+                        continue
+
+                    _, (path, md5sum, footprint, attempt), job_pool = job
+                    decoding -= 1
+                    try:
+                        decoded, status, error = future.result()
+                    except BrokenProcessPool:
+                        # Every job of the dead pool fails, replace it once
+                        broken = broken or job_pool is pool
+                        if attempt > 1:
+                            status, error = "decoder_error", "Decoder crashed"
+                        else:
+                            retries.append((path, md5sum, footprint, attempt + 1))
+                            continue
+                    except OSError as e:
+                        logger.warning(f"Cannot verify {path}: {e}")
+                        counts["skipped"] += len(copies.pop(md5sum))
+                        continue
+                    else:
+                        executors.submit(
+                            "io",
+                            self._store,
+                            decoded,
+                            status,
+                            error,
+                            priority=executors.BACKGROUND,
+                        )
+                    counts["decoded"] += 1
+                    for copy in copies.pop(md5sum):
+                        if event := outcome(copy, status, error, cached=False):
+                            yield event
+                if broken:
+                    logger.warning("An image decoder crashed, restarting the pool")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self._pool()
+                    try:
+                        await asyncio.wrap_future(pool.submit(_ping))
+                    except BrokenProcessPool:
+                        logger.error("Image verification workers cannot start")
+                        yield {
+                            **progress("error"),
+                            "error": "Verification workers cannot start, "
+                            "see the server log",
+                        }
+                        return
+
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    yield progress("progress")
+        finally:
+            if admission is not None and not admission[0].cancel():
+                admission[0].add_done_callback(self._release_unused)
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        done_event = progress("done")
+        done_event["statuses"] = dict(statuses)
+        done_event["seconds"] = round(time.monotonic() - started, 3)
+        yield done_event
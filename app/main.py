@@ -24,13 +24,33 @@ Environment Variables:
     WDV3_MODEL_NAME (str): WDv3 model name (default: "vit")
     WDV3_GEN_THRESHOLD (float): General threshold for WDv3 (default: 0.35)
     WDV3_CHAR_THRESHOLD (float): Character threshold for WDv3 (default: 0.75)
+    REMOTE_FS (bool): Serve listings from the persistent index and revalidate
+        in the background, for network file systems (default: false)
+    REMOTE_FS_REVALIDATE_INTERVAL (float): Seconds before a served listing or
+        resolved path is revalidated in remote mode (default: 30)
+    REMOTE_FS_NEGATIVE_TTL (float): Seconds a missing path is remembered
+        (default: 60)
+    CACHE_GC_INTERVAL (float): Seconds between cache garbage collection
+        passes, 0 disables them (default: 86400)
+    DIRECTORY_CACHE_MB (float): Memory budget of the in-memory directory
+        listings, least recently browsed ones are dropped first (default: 128)
+    IO_WORKERS, IMAGE_WORKERS, INFERENCE_WORKERS, FS_MUTATION_WORKERS (int):
+        Concurrency limits of the workload classes, see app.executors
+        (defaults: 16, CPU count, 1, 4)
+    FOLDER_WATCH (bool): Watch ROOT_DIR with watchfiles for folders created
+        or deleted outside yipyap (default: false)
+    DECODE_MEMORY_MB (float): Memory budget for image decodes running at the
+        same time, larger decodes wait for room (default: 1024)
 """
 
-import asyncio
 from pathlib import Path
+import asyncio
 import logging
 import os
+import time
 import json
+import sqlite3
+from dataclasses import asdict
 from datetime import datetime, timezone
 
 from fastapi import FastAPI, HTTPException, Query, Request, File, UploadFile, Body
@@ -39,13 +59,21 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from email.utils import parsedate_to_datetime, format_datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import shutil
 import aiofiles
 
-from .data_access import CachedFileSystemDataSource
+from .data_access import IMAGE_EXTENSIONS, CachedFileSystemDataSource
 from . import utils
 from . import caption_generation
+from . import cache_gc
+from . import executors
+from . import folder_tree
+from .derivatives import decode_budget
+from .duplicates import DUPLICATE_DISTANCE, MAX_DISTANCE
+from .models import BrowseHeader
+from .tag_autocomplete import TagVocabulary
+from .tag_index import TagQueryError
 
 MODEL_REPO_MAP = {
     "vit": "SmilingWolf/wd-v1-4-vit-tagger-v2",
@@ -61,10 +89,18 @@ logger.info(f"Starting server in {'development' if is_dev else 'production'} mod
 # Paths for tag autocompletion
 FLORENCE2_BASE_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)),
-    "caption_generation/plugins/florence2/florence2_implementation",
+    "caption_generation/plugins/florence2",
 )
 JTP2_BASE_PATH = os.path.expanduser(os.getenv("JTP2_PATH", "~/source/repos/JTP2"))
 
+# Florence2 tags if available, otherwise JTP2 tags
+tag_vocabulary = TagVocabulary(
+    [
+        os.path.join(FLORENCE2_BASE_PATH, "tags.json"),
+        os.path.join(JTP2_BASE_PATH, "tags.json"),
+    ]
+)
+
 app = FastAPI()
 
 # Create logs directory if it doesn't exist
@@ -109,7 +145,97 @@ if not is_dev:
 ROOT_DIR = Path(os.getenv("ROOT_DIR", Path.cwd())).resolve()
 THUMBNAIL_SIZE = (300, 300)
 PREVIEW_SIZE = (1024, 1024)
-data_source = CachedFileSystemDataSource(ROOT_DIR, THUMBNAIL_SIZE, PREVIEW_SIZE)
+
+# Remote file system mode, for datasets on NFS and similar mounts
+REMOTE_FS = os.getenv("REMOTE_FS", "false").lower() == "true"
+REMOTE_FS_REVALIDATE_INTERVAL = float(os.getenv("REMOTE_FS_REVALIDATE_INTERVAL", "30"))
+REMOTE_FS_NEGATIVE_TTL = float(os.getenv("REMOTE_FS_NEGATIVE_TTL", "60"))
+
+# Concurrency limits per workload class, see app.executors
+for workload in executors.WORKLOAD_WORKERS:
+    workers = os.getenv(f"{workload.upper().replace('-', '_')}_WORKERS")
+    if workers:
+        executors.configure(workload, int(workers))
+
+# Memory budget of concurrent image decodes, see app.derivatives
+DECODE_MEMORY_MB = float(os.getenv("DECODE_MEMORY_MB", "1024"))
+decode_budget.configure(int(DECODE_MEMORY_MB * 1024 * 1024))
+
+# Memory budget of the in-memory directory listings
+DIRECTORY_CACHE_MB = float(os.getenv("DIRECTORY_CACHE_MB", "128"))
+
+data_source = CachedFileSystemDataSource(
+    ROOT_DIR,
+    THUMBNAIL_SIZE,
+    PREVIEW_SIZE,
+    remote_fs=REMOTE_FS,
+    revalidate_interval=REMOTE_FS_REVALIDATE_INTERVAL,
+    negative_ttl=REMOTE_FS_NEGATIVE_TTL,
+    directory_cache_bytes=int(DIRECTORY_CACHE_MB * 1024 * 1024),
+)
+if REMOTE_FS:
+    logger.info(
+        f"Remote file system mode enabled (revalidate every {REMOTE_FS_REVALIDATE_INTERVAL}s)"
+    )
+    utils.enable_resolve_cache(REMOTE_FS_REVALIDATE_INTERVAL)
+
+# Folder tree served by /api/folders, see app.folder_tree
+FOLDER_WATCH = os.getenv("FOLDER_WATCH", "false").lower() == "true"
+data_source.folder_tree.start()
+if FOLDER_WATCH:
+    folder_tree.start_watcher(data_source.folder_tree)
+
+# Tag vocabulary answering /api/tags/autocomplete, see app.tag_autocomplete
+tag_vocabulary.observe(data_source.tag_index)
+executors.submit("io", tag_vocabulary.refresh, priority=executors.BACKGROUND)
+
+# Tag index queried by /api/tags/query, see app.tag_index
+data_source.tag_index.start()
+
+# Perceptual hashes for /api/duplicates and /api/similar, see app.duplicates
+data_source.hash_index.start()
+
+# Seconds a request waits for an index loading at startup before a 503
+INDEX_READY_TIMEOUT = float(os.getenv("INDEX_READY_TIMEOUT", "30"))
+
+
+async def wait_ready(index, name: str):
+    """
+    Wait for an index to finish loading, without holding a worker thread.
+
+    Args:
+        index: Folder tree, tag index or hash index, anything with a
+            wait_ready(timeout) method
+        name (str): Name of the index for the error message
+
+    Raises:
+        HTTPException: 503 if the index is not ready within INDEX_READY_TIMEOUT
+    """
+    deadline = time.monotonic() + INDEX_READY_TIMEOUT
+    while not index.wait_ready(0):
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=503,
+                detail=f"The {name} is still loading, try again shortly",
+                headers={"Retry-After": "5"},
+            )
+        await asyncio.sleep(0.05)
+
+
+# Worker processes of /api/verify, see app.integrity
+VERIFY_WORKERS = os.getenv("VERIFY_WORKERS")
+if VERIFY_WORKERS:
+    data_source.verifier.workers = int(VERIFY_WORKERS)
+
+# Periodic cache garbage collection, see app.cache_gc
+CACHE_GC_INTERVAL = float(os.getenv("CACHE_GC_INTERVAL", "86400"))
+if CACHE_GC_INTERVAL > 0:
+    cache_gc.start_scheduler(
+        data_source.db,
+        ROOT_DIR,
+        CACHE_GC_INTERVAL,
+        on_remove=data_source.forget_collected,
+    )
 
 # Add this constant near the top of the file with other constants
 CAPTION_TYPE_ORDER = {".e621": 0, ".tags": 1, ".wd": 2, ".caption": 3}
@@ -175,7 +301,7 @@ async def browse(
         # Check if this is a HEAD request
         is_head = request.method == "HEAD"
 
-        browser_header, items, futures = data_source.analyze_dir(
+        browser_header, items, image_infos = data_source.analyze_dir(
             directory=target_path,
             page=page,
             page_size=page_size,
@@ -213,14 +339,17 @@ async def browse(
                     )
                 yield f"{item.model_dump_json()}\n"
 
-            # Process futures
-            for future in asyncio.as_completed(futures):
-                res = await future
-                if hasattr(res, "captions"):
-                    res.captions.sort(
-                        key=lambda x: CAPTION_TYPE_ORDER.get(f".{x[0]}", 999)
-                    )
-                yield f"{res.model_dump_json()}\n"
+            # Stream image info as it completes, a disconnect closes the
+            # generator and cancels the jobs not started yet
+            try:
+                async for res in image_infos:
+                    if hasattr(res, "captions"):
+                        res.captions.sort(
+                            key=lambda x: CAPTION_TYPE_ORDER.get(f".{x[0]}", 999)
+                        )
+                    yield f"{res.model_dump_json()}\n"
+            finally:
+                await image_infos.aclose()
 
         return StreamingResponse(
             stream_response(), media_type="application/ndjson", headers=headers
@@ -233,6 +362,193 @@ async def browse(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/search")
+async def search_captions(
+    q: str,
+    path: str = "",
+    caption_type: Optional[str] = None,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000),
+):
+    """
+    Search captions across the dataset.
+
+    Args:
+        q (str): Words that must all match, "quoted phrases", prefix* and
+            -excluded terms, see app.caption_search
+        path (str): Only search this folder and its subfolders, ROOT_DIR by
+            default
+        caption_type (Optional[str]): Only search captions of this type, e.g.
+            "tags" or "caption"
+        page (int): Page number for pagination (>= 1)
+        page_size (int): Number of images per page (1-1000)
+
+    Returns:
+        StreamingResponse: NDJSON stream in the shape of /api/browse
+            First line: BrowseHeader listing the page's images best match
+            first, total_images counting all matching images
+            Subsequent lines: ImageModel objects, named by their path
+            relative to ROOT_DIR
+
+    Raises:
+        HTTPException: 400 for a query without terms, 404 if path not found
+    """
+    try:
+        directory = utils.resolve_path(path, ROOT_DIR)
+        if not directory.is_dir():
+            raise HTTPException(status_code=404, detail="Path not found")
+        browser_header, image_infos = await executors.run(
+            "io",
+            data_source.search,
+            q,
+            page=page,
+            page_size=page_size,
+            caption_type=caption_type,
+            directory=directory,
+        )
+    except (ValueError, sqlite3.OperationalError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+    return stream_hits(browser_header, image_infos)
+
+
+def stream_hits(browser_header: BrowseHeader, image_infos) -> StreamingResponse:
+    """Stream a page of search hits in the NDJSON shape of /api/browse."""
+
+    async def stream_response():
+        yield f"{browser_header.model_dump_json()}\n"
+        try:
+            async for res in image_infos:
+                res.captions.sort(key=lambda x: CAPTION_TYPE_ORDER.get(f".{x[0]}", 999))
+                yield f"{res.model_dump_json()}\n"
+        finally:
+            await image_infos.aclose()
+
+    return StreamingResponse(
+        stream_response(),
+        media_type="application/ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/api/duplicates")
+async def get_duplicates(
+    path: str = "",
+    distance: int = Query(DUPLICATE_DISTANCE, ge=0, le=MAX_DISTANCE),
+    limit: int = Query(100, ge=1),
+):
+    """
+    Find duplicate and near-duplicate images in a folder subtree.
+
+    Args:
+        path (str): Folder to search, ROOT_DIR by default
+        distance (int): Largest Hamming distance between the perceptual
+            hashes of near duplicates, 0 for visually identical images
+        limit (int): Number of clusters to return
+
+    Returns:
+        dict: Clusters of image paths relative to ROOT_DIR, largest first, see
+            CachedFileSystemDataSource.find_duplicates
+
+    Raises:
+        HTTPException: 404 if path not found, 503 while the perceptual hash
+            index is loading
+
+    Notes:
+        - Only images cached by browsing their folder are compared
+    """
+    directory = utils.resolve_path(path, ROOT_DIR)
+    if not directory.is_dir():
+        raise HTTPException(status_code=404, detail="Path not found")
+    hash_index = data_source.hash_index
+    await wait_ready(hash_index, "perceptual hash index")
+    return await executors.run(
+        "io", data_source.find_duplicates, directory, distance, limit
+    )
+
+
+@app.get("/api/similar/{path:path}")
+async def get_similar_images(
+    path: str,
+    distance: int = Query(10, ge=0, le=MAX_DISTANCE),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000),
+):
+    """
+    Find images that look like an image.
+
+    Args:
+        path (str): Image to compare with
+        distance (int): Largest Hamming distance between perceptual hashes
+        page (int): Page number for pagination (>= 1)
+        page_size (int): Number of images per page (1-1000)
+
+    Returns:
+        StreamingResponse: NDJSON stream in the shape of /api/search, closest
+            images first
+
+    Raises:
+        HTTPException: 404 if the image is not found, 503 while the
+            perceptual hash index is loading
+    """
+    image_path = utils.resolve_path(path, ROOT_DIR)
+    if not image_path.is_file() or image_path.suffix.lower() not in IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=404, detail="Image not found")
+    hash_index = data_source.hash_index
+    await wait_ready(hash_index, "perceptual hash index")
+    browser_header, image_infos = await executors.run(
+        "image",
+        data_source.similar_images,
+        image_path,
+        distance,
+        page=page,
+        page_size=page_size,
+    )
+    return stream_hits(browser_header, image_infos)
+
+
+@app.post("/api/verify")
+async def verify_images(path: str = "", recheck: bool = False):
+    """
+    Decode every image of a folder subtree strictly to find broken files.
+
+    Args:
+        path (str): Folder to verify, ROOT_DIR by default
+        recheck (bool): Decode images again even if identical contents were
+            verified before
+
+    Returns:
+        StreamingResponse: NDJSON stream of verification events: "start",
+            a "failure" per truncated or corrupt image, "progress" every
+            second and "done" with the final counts, or "error" if the
+            workers cannot start, see app.integrity.IntegrityVerifier.verify
+
+    Raises:
+        HTTPException: 404 if path not found
+
+    Notes:
+        - Outcomes are stored per fingerprint, so a run only decodes images
+          whose contents changed since the last one
+    """
+    directory = utils.resolve_path(path, ROOT_DIR)
+    if not directory.is_dir():
+        raise HTTPException(status_code=404, detail="Path not found")
+    targets = await executors.run("io", data_source.verification_targets, directory)
+    events = data_source.verifier.verify(targets, ROOT_DIR, recheck)
+
+    async def stream_response():
+        try:
+            async for event in events:
+                yield f"{json.dumps(event)}\n"
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        stream_response(),
+        media_type="application/ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 # Used for deleting everything in a directory.
 @app.delete("/api/browse/{path:path}")
 async def delete_image(
@@ -379,6 +695,61 @@ async def update_thumbnail_size(size: int):
     return {"success": True}
 
 
+@app.post("/api/cache/gc")
+async def run_cache_gc():
+    """
+    Run a cache garbage collection pass now.
+
+    Returns:
+        dict: Rows and blobs removed and bytes reclaimed, see app.cache_gc
+
+    Raises:
+        HTTPException: 409 if a pass is already running, 503 if the dataset
+            root is not reachable
+    """
+    try:
+        report = await executors.run(
+            "io",
+            cache_gc.collect_garbage,
+            data_source.db,
+            ROOT_DIR,
+            on_remove=data_source.forget_collected,
+            priority=executors.BACKGROUND,
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return asdict(report)
+
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """
+    Get metadata cache statistics.
+
+    Returns:
+        dict: Cached image and fingerprint counts, the deduplication ratio and
+            bytes saved by sharing derivatives between identical files, see
+            CachedFileSystemDataSource.cache_stats
+    """
+    return await executors.run("io", data_source.cache_stats)
+
+
+@app.get("/api/executors")
+async def get_executor_stats():
+    """
+    Get concurrency and queue depth of the workload class executors.
+
+    Returns:
+        dict: Statistics per workload class (io, image, inference,
+            fs-mutation), see app.executors.PriorityExecutor.stats, and the
+            use of the decode memory budget under "decode_budget", see
+            app.derivatives.DecodeBudget.stats
+    """
+    return {**executors.stats(), "decode_budget": decode_budget.stats()}
+
+
 @app.put("/api/caption/{path:path}")
 async def update_caption(path: str, caption_data: dict):
     """
@@ -446,9 +817,11 @@ async def delete_caption(path: str, caption_type: str = Query(...)):
         logger.info(f"Caption path to delete: {caption_path}")
 
         try:
-            caption_path.unlink(missing_ok=True)
+            # Removes the file and the cached caption, and unindexes its tags
+            await data_source.delete_caption(image_path, caption_type)
             # Touch the parent directory to force cache invalidation
             image_path.touch()
+            data_source.invalidate_directory(image_path.parent)
 
             return {
                 "success": True,
@@ -465,46 +838,74 @@ async def delete_caption(path: str, caption_type: str = Query(...)):
 
 
 @app.get("/api/folders")
-async def get_all_folders():
-    """Get all folders recursively from ROOT_DIR"""
+async def get_all_folders(request: Request, parent: Optional[str] = Query(None)):
+    """
+    Get all folders below ROOT_DIR, or the subfolders of one folder.
+
+    Args:
+        parent (Optional[str]): Only list the direct subfolders of this folder,
+            each with a hasChildren flag for lazy expansion
+
+    Returns:
+        dict: {"folders": [{"name", "path", "fullPath", "stats"}], "root"}
+            sorted by fullPath, or 304 Not Modified if the If-None-Match ETag
+            matches. stats are the image count, bytes, favorites and caption
+            counts per type of the folder's subtree.
+
+    Notes:
+        - Served from the in-memory folder tree, see app.folder_tree
+    """
+    tree = data_source.folder_tree
     try:
-        folders = []
+        parent_path = None
+        if parent is not None:
+            parent_path = utils.resolve_path(parent, ROOT_DIR) if parent else ROOT_DIR
+        headers = {"ETag": tree.etag(), "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
 
-        def scan_directory(current_path: Path, relative_to: Path):
-            try:
-                # Skip hidden directories
-                if current_path.name.startswith("."):
-                    return
-
-                # Get relative path for the response
-                rel_path = str(current_path.relative_to(relative_to))
-                if rel_path != ".":  # Don't include the root itself
-                    folders.append(
-                        {
-                            "name": current_path.name,
-                            "path": str(current_path.parent.relative_to(ROOT_DIR)),
-                            "fullPath": rel_path,
-                        }
-                    )
+        # Only the first request after startup waits for the tree to be built
+        await wait_ready(tree, "folder tree")
+        headers["ETag"] = tree.etag()
+        response = tree.folders(parent_path)
+        return Response(
+            content=json.dumps(response),
+            media_type="application/json",
+            headers=headers,
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing folders: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-                # Recursively scan subdirectories
-                for item in current_path.iterdir():
-                    if item.is_dir() and not item.name.startswith("."):
-                        scan_directory(item, relative_to)
-            except (PermissionError, OSError) as e:
-                logger.warning(f"Could not scan directory {current_path}: {e}")
 
-        # Start recursive scan from ROOT_DIR
-        scan_directory(ROOT_DIR, ROOT_DIR)
+@app.get("/api/stats/{path:path}")
+async def get_folder_stats(path: str = ""):
+    """
+    Get aggregate statistics of a folder.
 
-        # Sort folders by path for consistent results
-        folders.sort(key=lambda x: x["fullPath"])
+    Args:
+        path (str): Folder path relative to ROOT_DIR, empty for the root
 
-        return {"folders": folders, "root": str(ROOT_DIR)}
+    Returns:
+        dict: "local" statistics of the images directly in the folder and
+            "total" statistics of its whole subtree, each with images, bytes,
+            favorites and captions (images having a caption, per type).
+            "listed" is false while the folder has not been scanned yet.
 
-    except Exception as e:
-        logger.error(f"Error scanning folders: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    Notes:
+        - Read from the in-memory folder tree, see app.folder_tree
+    """
+    tree = data_source.folder_tree
+    target_path = utils.resolve_path(path, ROOT_DIR) if path else ROOT_DIR
+    await wait_ready(tree, "folder tree")
+    try:
+        return tree.stats(target_path)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Folder not found")
 
 
 @app.get("/api/captioners")
@@ -699,6 +1100,7 @@ async def upload_files(path: str, files: List[UploadFile] = File(...)):
 
         if not target_dir.exists():
             target_dir.mkdir(parents=True, exist_ok=True)
+            data_source.folder_tree.add(target_dir)
 
         uploaded_files = []
         failed_files = []
@@ -718,7 +1120,9 @@ async def upload_files(path: str, files: List[UploadFile] = File(...)):
                 full_path = target_dir / relative_path
 
                 # Ensure the parent directory exists
-                full_path.parent.mkdir(parents=True, exist_ok=True)
+                if not full_path.parent.exists():
+                    full_path.parent.mkdir(parents=True, exist_ok=True)
+                    data_source.folder_tree.add(full_path.parent)
 
                 # Save the file
                 async with aiofiles.open(full_path, "wb") as buffer:
@@ -736,8 +1140,7 @@ async def upload_files(path: str, files: List[UploadFile] = File(...)):
         target_dir.touch()
 
         # Clear directory cache
-        if target_dir in data_source.directory_cache:
-            del data_source.directory_cache[target_dir]
+        data_source.invalidate_directory(target_dir)
 
         result = {
             "message": "Upload complete",
@@ -786,13 +1189,13 @@ async def create_folder(path: str):
 
         # Create the folder
         target_path.mkdir(parents=True, exist_ok=False)
+        data_source.folder_tree.add(target_path)
 
         # Touch parent directory to force cache invalidation
         target_path.parent.touch()
 
         # Clear directory cache to force rescan
-        if target_path.parent in data_source.directory_cache:
-            del data_source.directory_cache[target_path.parent]
+        data_source.invalidate_directory(target_path.parent)
 
         return {"success": True, "path": str(target_path)}
 
@@ -831,7 +1234,9 @@ async def move_items(
         )
 
         # Ensure target directory exists
-        target_dir.mkdir(parents=True, exist_ok=True)
+        if not target_dir.exists():
+            target_dir.mkdir(parents=True, exist_ok=True)
+            data_source.folder_tree.add(target_dir)
 
         moved_items = []
         failed_items = []
@@ -858,7 +1263,11 @@ async def move_items(
 
                 if source_path.is_dir():
                     # Move directory and all contents
-                    shutil.move(str(source_path), str(target_path))
+                    await executors.run(
+                        "fs-mutation", shutil.move, str(source_path), str(target_path)
+                    )
+                    data_source.invalidate_directory(source_path, recursive=True)
+                    data_source.move_cached(source_path, target_path)
                     moved_items.append(item)
                 else:
                     # Move file and associated files (captions, etc)
@@ -872,7 +1281,10 @@ async def move_items(
                         logger.info(
                             f"Moving associated file: {f} to {target_dir / f.name}"
                         )
-                        shutil.move(str(f), str(target_dir / f.name))
+                        await executors.run(
+                            "fs-mutation", shutil.move, str(f), str(target_dir / f.name)
+                        )
+                    data_source.move_cached(source_path, target_path)
                     moved_items.append(item)
 
             except Exception as e:
@@ -885,10 +1297,8 @@ async def move_items(
         target_dir.touch()
 
         # Clear cache for affected directories
-        if source_dir in data_source.directory_cache:
-            del data_source.directory_cache[source_dir]
-        if target_dir in data_source.directory_cache:
-            del data_source.directory_cache[target_dir]
+        data_source.invalidate_directory(source_dir)
+        data_source.invalidate_directory(target_dir)
 
         result = {
             "success": True,
@@ -1003,39 +1413,23 @@ async def update_favorite_state(path: str, config: dict = Body(...)):
             raise HTTPException(status_code=404, detail="Image not found")
 
         # Update favorite state in SQLite
-        conn = data_source._get_connection()
         directory = str(full_path.parent)
         filename = full_path.name
 
-        # Update both the favorite_state column and the info JSON
-        result = conn.execute(
-            "SELECT info FROM image_info WHERE directory = ? AND name = ?",
-            (directory, filename),
-        ).fetchone()
-
-        if result:
-            info = json.loads(result[0])
-            info["favorite_state"] = favorite_state
-
-            conn.execute(
+        # Favorites live in their own column, a single-column update
+        with data_source.db.writer() as conn:
+            result = conn.execute(
                 """
-                UPDATE image_info 
-                SET favorite_state = ?, info = ?, cache_time = ?
+                UPDATE image_info
+                SET favorite_state = ?
                 WHERE directory = ? AND name = ?
                 """,
-                (
-                    favorite_state,
-                    json.dumps(info),
-                    int(datetime.now(timezone.utc).timestamp()),
-                    directory,
-                    filename,
-                ),
-            )
-            conn.commit()
-
-            # Clear directory cache to force reload
-            data_source.directory_cache.pop(full_path.parent, None)
+                (favorite_state, directory, filename),
+            ).rowcount
 
+        if result:
+            # Listings hold no image metadata, no need to invalidate them
+            data_source.folder_tree.update_favorites(full_path.parent)
             return {"success": True}
         else:
             raise HTTPException(status_code=404, detail="Image info not found in cache")
@@ -1289,70 +1683,127 @@ async def log_frontend_messages(request: Request):
         return {"status": "error", "message": str(e)}
 
 
-@app.get("/api/tags/autocomplete")
-async def get_tag_suggestions(q: str, limit: int = 10):
-    """Get tag suggestions based on a query string."""
-    logger.info(f"Getting tag suggestions for query: '{q}'")
-
-    # Define the two potential tags files
-    florence2_tags_file = os.path.join(FLORENCE2_BASE_PATH, "tags.json")
-    jtp2_tags_file = os.path.join(JTP2_BASE_PATH, "tags.json")
-
-    # Use Florence2 tags if available, otherwise try JTP2 tags
-    if os.path.exists(florence2_tags_file):
-        tags_file = florence2_tags_file
-        logger.info(f"Using Florence2 tags file: {florence2_tags_file}")
-    elif os.path.exists(jtp2_tags_file):
-        tags_file = jtp2_tags_file
-        logger.info(f"Using JTP2 tags file: {jtp2_tags_file}")
-    else:
-        logger.warning("No tags file found for autocomplete")
-        return {"suggestions": []}
+@app.get("/api/tags/query")
+async def query_tags(
+    q: str,
+    path: str = "",
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000),
+):
+    """
+    Find images by a boolean query over their tag sidecars.
 
+    Args:
+        q (str): Tag query, e.g. `solo AND NOT text` or `(solo OR duo), -text,
+            anthro*`: AND (or a comma), OR, NOT (or a leading -), prefix*
+            and parentheses, see app.tag_index
+        path (str): Only match this folder and its subfolders, ROOT_DIR by
+            default
+        page (int): Page number for pagination (>= 1)
+        page_size (int): Number of images per page (1-1000)
+
+    Returns:
+        StreamingResponse: NDJSON stream in the shape of /api/browse, see
+            /api/search. Images are sorted by path.
+
+    Raises:
+        HTTPException: 400 for a malformed query, 404 if path not found, 503
+            while the tag index is loading
+    """
+    directory = utils.resolve_path(path, ROOT_DIR)
+    if not directory.is_dir():
+        raise HTTPException(status_code=404, detail="Path not found")
+    tag_index = data_source.tag_index
+    await wait_ready(tag_index, "tag index")
     try:
-        # Load the tags
-        with open(tags_file, "r", encoding="utf-8") as f:
-            tags_data = json.load(f)
-
-        # Extract tag names based on the structure of the JSON file
-        # Florence2 tags have a specific structure
-        if "categories" in tags_data:
-            # Florence2 tags structure
-            all_tags = []
-            for category in tags_data["categories"]:
-                for tag in category["tags"]:
-                    all_tags.append(tag["name"])
-        else:
-            # JTP2 or simple tags list
-            all_tags = tags_data
+        browser_header, image_infos = await executors.run(
+            "io",
+            data_source.query_tags,
+            q,
+            page=page,
+            page_size=page_size,
+            directory=directory,
+        )
+    except TagQueryError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid tag query: {e}")
+    return stream_hits(browser_header, image_infos)
+
+
+@app.get("/api/tags/top")
+async def get_top_tags(path: str = "", limit: int = Query(50, ge=1, le=1000)):
+    """
+    Get the most frequent tags of a folder and its subfolders.
 
-        logger.info(f"Loaded {len(all_tags)} tags from {os.path.basename(tags_file)}")
+    Args:
+        path (str): Folder path relative to ROOT_DIR, empty for the root
+        limit (int): Number of tags to return (1-1000)
 
-        # Filter tags by the query (case insensitive)
-        q = q.lower()
-        logger.info(f"Filtering tags with query: '{q}'")
+    Returns:
+        dict: "images" carrying tags in the folder and "tags" as
+            [{"tag", "count"}], most frequent first
 
-        # First get tags that start with the query
-        starts_with = [tag for tag in all_tags if tag.lower().startswith(q)]
-        logger.info(f"Found {len(starts_with)} tags that start with '{q}'")
+    Notes:
+        - Read from the tag index, see app.tag_index
+    """
+    tag_index = data_source.tag_index
+    directory = utils.resolve_path(path, ROOT_DIR)
+    await wait_ready(tag_index, "tag index")
+    return tag_index.top_tags(directory, limit)
 
-        # Then get tags that contain the query but don't start with it
-        contains = [
-            tag
-            for tag in all_tags
-            if q in tag.lower() and not tag.lower().startswith(q)
-        ]
-        logger.info(f"Found {len(contains)} additional tags that contain '{q}'")
 
-        # Combine and limit the results
-        suggestions = starts_with + contains
-        suggestions = suggestions[:limit]
+@app.get("/api/tags/related")
+async def get_related_tags(
+    tag: str, path: str = "", limit: int = Query(20, ge=1, le=1000)
+):
+    """
+    Get the tags most often found on the same images as a tag.
 
-        logger.info(f"Returning {len(suggestions)} suggestions: {suggestions}")
-        return {"suggestions": suggestions}
-    except Exception as e:
-        logger.error(f"Error getting tag suggestions: {str(e)}")
-        return {"suggestions": []}
+    Args:
+        tag (str): Tag to find related tags for
+        path (str): Only count images of this folder and its subfolders,
+            empty for the whole dataset
+        limit (int): Number of related tags to return (1-1000)
+
+    Returns:
+        dict: "tag", the "count" of images carrying it and "related" as
+            [{"tag", "count", "ratio"}], ratio being the share of the tag's
+            images also carrying the related tag, most frequent first
+
+    Notes:
+        - Read from the tag co-occurrence matrix, see app.tag_index
+    """
+    tag_index = data_source.tag_index
+    directory = utils.resolve_path(path, ROOT_DIR)
+    await wait_ready(tag_index, "tag index")
+    if directory == ROOT_DIR:
+        return tag_index.related_tags(tag, None, limit)
+    # Subfolders count the tag's images, which takes longer for common tags
+    return await executors.run("io", tag_index.related_tags, tag, directory, limit)
+
+
+@app.get("/api/tags/autocomplete")
+async def get_tag_suggestions(q: str, limit: int = 10, fuzzy: bool = True):
+    """
+    Get tag suggestions based on a query string.
+
+    Args:
+        q (str): What the user typed so far
+        limit (int): Maximum number of suggestions
+        fuzzy (bool): Fill up with tags the query misspells
+
+    Returns:
+        dict: Tags starting with the query, then tags containing it, then the
+            closest misspelled tags, under "suggestions", see
+            app.tag_autocomplete
+
+    Notes:
+        - The tags file is loaded once and reloaded when it changes
+        - Tags used in the dataset are suggested first, see
+          app.tag_autocomplete
+    """
+    suggestions = await executors.run("io", tag_vocabulary.suggest, q, limit, fuzzy)
+    logger.debug(f"Returning {len(suggestions)} tag suggestions for '{q}'")
+    return {"suggestions": suggestions}
 
 
 # # Add a direct route to handle pixelings assets
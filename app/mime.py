@@ -0,0 +1,95 @@
+"""
+MIME type detection for dataset images.
+
+This module determines the MIME type of image files from a small table of
+magic numbers covering the formats yipyap browses. Reading a handful of header
+bytes is far cheaper than a libmagic rule scan, and the header is usually
+already in memory because the file is about to be decoded anyway.
+
+libmagic is only consulted when the signature is unknown or disagrees with the
+file extension, so renamed or mislabelled files still get an authoritative
+answer.
+"""
+
+import logging
+from pathlib import Path
+from typing import Optional
+
+import magic
+
+logger = logging.getLogger("uvicorn.error")
+
+# Number of header bytes needed to match every signature below
+SIGNATURE_LENGTH = 16
+
+# (offset, magic bytes, MIME type)
+_SIGNATURES = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"\xff\x0a", "image/jxl"),  # Bare JPEG XL codestream
+    (0, b"\x00\x00\x00\x0cJXL \r\n\x87\n", "image/jxl"),  # JPEG XL container
+    (4, b"ftypavif", "image/avif"),
+    (4, b"ftypavis", "image/avif"),
+    (0, b"RIFF", "image/webp"),  # Checked further in sniff_mime
+]
+
+EXTENSION_MIME = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".jxl": "image/jxl",
+    ".avif": "image/avif",
+    ".webp": "image/webp",
+}
+
+
+def sniff_mime(head: bytes) -> Optional[str]:
+    """
+    Match the header of a file against the signature table.
+
+    Args:
+        head (bytes): First bytes of the file, at least SIGNATURE_LENGTH long
+            for a reliable match
+
+    Returns:
+        Optional[str]: MIME type, or None if no signature matched
+    """
+    for offset, signature, mime in _SIGNATURES:
+        if head.startswith(signature, offset):
+            if mime == "image/webp" and head[8:12] != b"WEBP":
+                continue
+            return mime
+    return None
+
+
+def detect_mime(path: Path, head: Optional[bytes] = None) -> str:
+    """
+    Determine the MIME type of an image file.
+
+    Args:
+        path (Path): Path to the file
+        head (Optional[bytes]): Header bytes if already read, saves an open
+
+    Returns:
+        str: MIME type
+
+    Notes:
+        - Uses the signature table when it agrees with the extension
+        - Falls back to libmagic on unknown signatures or mismatches
+    """
+    if head is None:
+        with open(path, "rb") as f:
+            head = f.read(SIGNATURE_LENGTH)
+
+    sniffed = sniff_mime(head)
+    expected = EXTENSION_MIME.get(path.suffix.lower())
+    if sniffed is not None and sniffed == expected:
+        return sniffed
+
+    logger.debug(
+        f"MIME signature mismatch for {path}: {sniffed} != {expected}, using libmagic"
+    )
+    return magic.from_file(str(path), mime=True)
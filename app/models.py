@@ -14,7 +14,7 @@ The models are organized into several categories:
 Each model includes validation rules and default values where appropriate.
 """
 
-from typing import List, Tuple, Union, Literal
+from typing import List, Optional, Tuple, Union, Literal
 from datetime import datetime
 from enum import Enum
 from pydantic import BaseModel, Field
@@ -111,6 +111,8 @@ class ImageModel(BaseItem):
             4 = full star
             5 = emphasis star
             6 = off star
+        placeholder (Optional[str]): Dominant color as a CSS hex string, shown
+            while the thumbnail loads
     """
 
     type: Literal["image"] = "image"
@@ -121,6 +123,7 @@ class ImageModel(BaseItem):
     height: int = Field(default=0)  # Image height
     captions: List[Tuple[str, str]] = Field(default=[])  # [(type, text), ...]
     favorite_state: int = Field(default=0)  # Favorite state (0-6)
+    placeholder: Optional[str] = Field(default=None)  # Dominant color "#rrggbb"
 
 
 class DirectoryModel(BaseItem):
@@ -0,0 +1,85 @@
+"""
+Helpers for running yipyap against network file systems.
+
+On NFS and similar mounts every metadata operation (stat, open, readdir,
+symlink resolution) is a network round trip. The remote file system mode
+trades a bounded amount of staleness for latency: listings and metadata are
+served from the persistent index right away and revalidated in the background,
+and repeated lookups of the same paths are answered from short-lived caches.
+
+This module provides the small caching primitive used for that:
+- ExpiringCache: size-bounded mapping whose entries expire after a TTL, used
+  for resolved request paths and as a negative cache for missing paths
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class ExpiringCache:
+    """
+    Size-bounded mapping with per-entry expiry.
+
+    Args:
+        ttl (float): Seconds an entry stays valid
+        max_entries (int): Maximum number of entries, oldest are dropped first
+        clock (Callable[[], float]): Time source, monotonic by default
+
+    Notes:
+        - Thread-safe, entries are written from executor threads
+        - Expired entries are dropped lazily on access
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int = 65536,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a live entry, or default if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < self._clock():
+                del self._entries[key]
+                return default
+            return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key: Hashable, value: Any = True, ttl: Optional[float] = None):
+        """Store an entry, replacing any previous one for the key."""
+        expires = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        """Drop an entry if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_MISSING = object()
@@ -0,0 +1,597 @@
+"""
+In-memory tag vocabulary answering /api/tags/autocomplete.
+
+The editor asks for suggestions on every keystroke. Reading and filtering the
+model's tags.json per request meant parsing thousands of tags and lowering
+each of them twice per key press, so the vocabulary is loaded once and kept
+in structures answering a query without visiting every tag:
+- Tags get ids in popularity order, id 0 being the most popular tag, so
+  sorting ids sorts by popularity
+- A sorted array of the folded tags answers prefix queries by binary search
+- A trigram index maps every three-character substring to the sorted ids of
+  the tags containing it, so substring matches are verified only on the tags
+  carrying all trigrams of the query
+
+Queries with too few exact matches are filled up with tags they misspell,
+e.g. `looking at veiwer` suggests `looking_at_viewer`: tags sharing enough
+trigrams with the query are compared by the edit distance between the query
+and their beginning, tolerating one typo in short queries and two in longer
+ones (see _Vocabulary.similar and benchmarks.bench_autocomplete).
+
+Model tag lists miss the project-specific tags and character names of a
+dataset, so the tags of its own sidecars are suggested as well, ahead of the
+model's tags and ranked by the number of images carrying them. They are kept
+in a second, mutable lookup structure that app.tag_index updates whenever a
+tag first appears in or vanishes from the dataset, e.g. on caption saves, along
+with the number of images carrying each tag. Groups of up to
+DATASET_CANDIDATES matches are ranked directly. Larger groups, e.g. after one
+or two typed characters, walk the tags in usage order instead, so they stop
+after the first matches rather than ranking every dataset tag on each
+keystroke.
+
+Tags are folded like app.tag_index does, lower case with underscores read as
+spaces, so `long h` suggests `long_hair`. Suggestions keep the spelling of the
+sidecars or the tags file. The file is checked on every query and reloaded when its
+modification time or size changes.
+
+Usage:
+    ```python
+    vocabulary = TagVocabulary([florence2_tags, jtp2_tags])
+    vocabulary.suggest("long h", 10)
+    ```
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+from array import array
+from collections import Counter
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from .tag_index import TagIndex, normalize_tag
+
+logger = logging.getLogger("uvicorn.error")
+
+# Shortest query matched with typos, shorter ones share too few trigrams
+FUZZY_MIN_LENGTH = 4
+
+# Trigram postings counted per fuzzy query, rarest trigrams first
+FUZZY_POSTINGS = 5000
+
+# Tags sharing the most trigrams with a fuzzy query compared in full
+FUZZY_CANDIDATES = 64
+
+# Dataset tags matching a prefix or substring ranked directly, larger groups
+# are found walking the tags in usage order
+DATASET_CANDIDATES = 256
+
+# Count changes moved into the dataset's usage order one by one, more of them
+# (e.g. while the tag index loads) sort it again
+USAGE_RESORT_CHANGES = 512
+
+
+# Marks the start of a tag, so trigrams like "\x02bl" anchor fuzzy matches of
+# short queries at the beginning of tags
+_START = "\x02"
+
+
+def _trigrams(text: str) -> set:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def max_edits(length: int) -> int:
+    """Typos tolerated in a query of this length, 0 below FUZZY_MIN_LENGTH."""
+    if length < FUZZY_MIN_LENGTH:
+        return 0
+    return 1 if length < 8 else 2
+
+
+def prefix_distance(text: str, tag: str, bound: int) -> int:
+    """
+    Edit distance between text and the closest prefix of tag.
+
+    Args:
+        text (str): Folded query
+        tag (str): Folded tag
+        bound (int): Largest distance of interest
+
+    Returns:
+        int: Number of insertions, deletions, substitutions and transpositions
+            of adjacent characters turning text into the best matching prefix
+            of tag, bound + 1 if that takes more than bound
+
+    Notes:
+        - Only cells within bound of the diagonal are computed, the others
+          cannot lead to a distance within bound
+    """
+    n = len(text)
+    over = bound + 1
+    previous = [j if j <= bound else over for j in range(n + 1)]
+    before = None
+    best = previous[n]
+    last = ""
+    for i in range(1, min(len(tag), n + bound) + 1):
+        char = tag[i - 1]
+        current = [over] * (n + 1)
+        if i <= bound:
+            current[0] = i
+        lowest = current[0]
+        for j in range(max(1, i - bound), min(n, i + bound) + 1):
+            cost = previous[j - 1] + (text[j - 1] != char)
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if (
+                before is not None
+                and j > 1
+                and char == text[j - 2]
+                and last == text[j - 1]
+                and before[j - 2] + 1 < cost
+            ):
+                cost = before[j - 2] + 1
+            current[j] = cost
+            if cost < lowest:
+                lowest = cost
+        best = min(best, current[n])
+        # Longer prefixes cannot get closer than the best cell of this row
+        if lowest > bound:
+            break
+        before, previous, last = previous, current, char
+    return min(best, over)
+
+
+def read_tags_file(path: str) -> List[str]:
+    """
+    Read the tags of a model's tags file, most popular first.
+
+    Args:
+        path (str): JSON file holding one of
+            - An object mapping tags to their rank or model output index
+            - A list of tags
+            - {"categories": [{"tags": [{"name": ...}]}]}
+
+    Returns:
+        List[str]: Tags in popularity order
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If the file is not a supported tags file
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and "categories" in data:
+        return [
+            tag["name"] for category in data["categories"] for tag in category["tags"]
+        ]
+    if isinstance(data, dict):
+        ranks = list(data.items())
+        if all(isinstance(rank, (int, float)) for _, rank in ranks):
+            ranks.sort(key=lambda item: item[1])
+        return [tag for tag, _ in ranks]
+    if isinstance(data, list):
+        return [tag for tag in data if isinstance(tag, str)]
+    raise ValueError(f"Unsupported tags file: {path}")
+
+
+def _typo_candidates(
+    grams: Mapping[str, Collection], text: str, bound: int
+) -> Dict[Hashable, int]:
+    """
+    Tags of a trigram index that may be within bound typos of text.
+
+    Args:
+        grams (Mapping[str, Collection]): Tags carrying each trigram, start
+            marker included
+        text (str): Folded query
+        bound (int): Typos tolerated
+
+    Returns:
+        Dict[Hashable, int]: Candidate tags and the number of counted
+            trigrams they share with text
+
+    Notes:
+        - A typo changes at most four trigrams of the query (a transposition
+          spans four), so a tag within k typos shares all but 4k of them.
+          Trigrams are counted rarest first until FUZZY_POSTINGS tags were
+          counted, which keeps common trigrams like "ing" from dominating the
+          cost. At least one shared trigram is always required
+    """
+    # Trigrams no tag has come first, they are shared by no candidate
+    postings = sorted(
+        (grams.get(gram, ()) for gram in _trigrams(_START + text)), key=len
+    )
+    counted = []
+    total = 0
+    for posting in postings:
+        if len(counted) > 4 * bound and total + len(posting) > FUZZY_POSTINGS:
+            break
+        counted.append(posting)
+        total += len(posting)
+    shared = Counter()
+    for posting in counted:
+        shared.update(posting)
+    needed = max(len(counted) - 4 * bound, 1)
+    return {tag: count for tag, count in shared.items() if count >= needed}
+
+
+class _Vocabulary:
+    """Immutable lookup structures over one tag list, see the module notes."""
+
+    def __init__(self, tags: Iterable[str]):
+        self.tags: List[str] = []
+        self.folded: List[str] = []
+        seen = set()
+        for tag in tags:
+            folded = normalize_tag(tag)
+            if folded and folded not in seen:
+                seen.add(folded)
+                self.tags.append(tag)
+                self.folded.append(folded)
+
+        order = sorted(range(len(self.folded)), key=self.folded.__getitem__)
+        self.keys = [self.folded[i] for i in order]
+        self.ids = array("I", order)
+
+        grams: Dict[str, array] = {}
+        for i, folded in enumerate(self.folded):
+            for gram in _trigrams(_START + folded):
+                posting = grams.get(gram)
+                if posting is None:
+                    posting = grams[gram] = array("I")
+                posting.append(i)
+        self.grams = grams
+
+    def prefixed(self, prefix: str, limit: int) -> List[int]:
+        """Ids of the most popular tags starting with prefix."""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        return heapq.nsmallest(limit, self.ids[lo:hi])
+
+    def containing(self, text: str, limit: int) -> List[int]:
+        """Ids of the most popular tags containing text but not starting with it."""
+        if len(text) < 3:
+            candidates: Iterable[int] = range(len(self.folded))
+        else:
+            postings = [self.grams.get(gram) for gram in _trigrams(text)]
+            if not all(postings):
+                return []
+            # Postings are in popularity order, walking the shortest one in
+            # order finds the most popular matches first
+            candidates = min(postings, key=len)
+        matches = []
+        for i in candidates:
+            folded = self.folded[i]
+            if text in folded and not folded.startswith(text):
+                matches.append(i)
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def similar(self, text: str, limit: int, exclude: Set[str]) -> List[int]:
+        """
+        Ids of the tags whose beginning is closest to text, typos allowed.
+
+        Args:
+            text (str): Folded query
+            limit (int): Maximum number of ids
+            exclude (Set[str]): Folded tags already suggested
+
+        Returns:
+            List[int]: Ids within max_edits(len(text)) edits of text, by
+                distance and then popularity
+
+        Notes:
+            - Of the candidates of _typo_candidates, the FUZZY_CANDIDATES
+              sharing the most trigrams are compared character by character
+        """
+        bound = max_edits(len(text))
+        if not bound:
+            return []
+        candidates = heapq.nlargest(
+            FUZZY_CANDIDATES,
+            (
+                (count, -i)
+                for i, count in _typo_candidates(self.grams, text, bound).items()
+                if self.folded[i] not in exclude
+            ),
+        )
+        scored = []
+        for _, i in candidates:
+            distance = prefix_distance(text, self.folded[-i], bound)
+            if distance <= bound:
+                scored.append((distance, -i))
+        return [i for _, i in heapq.nsmallest(limit, scored)]
+
+
+class _DatasetTags:
+    """
+    Tags of the dataset's own sidecars, kept current by app.tag_index.
+
+    The same lookups as _Vocabulary, over a sorted list and a trigram index of
+    sets that take single insertions and removals. Matches are ranked by the
+    number of images carrying them: groups of up to DATASET_CANDIDATES matches
+    are ranked directly, larger ones by walking all tags most used first until
+    enough of them match. Count changes are applied to that order on the next
+    query, see USAGE_RESORT_CHANGES.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spellings: Dict[str, str] = {}
+        self._keys: List[str] = []
+        self._grams: Dict[str, Set[str]] = {}
+        self._counts: Dict[str, int] = {}
+        # (-count, tag) in usage order, and the counts of the tags changed
+        # since as the order still has them
+        self._by_usage: List[Tuple[int, str]] = []
+        self._changed: Dict[str, int] = {}
+
+    def update(
+        self, appeared: Dict[str, str], vanished: List[str], counts: Dict[str, int]
+    ):
+        """Listener of TagIndex.add_listener."""
+        with self._lock:
+            for tag, spelling in appeared.items():
+                if tag in self.spellings:
+                    continue
+                self.spellings[tag] = spelling
+                bisect.insort(self._keys, tag)
+                for gram in _trigrams(_START + tag):
+                    tags = self._grams.get(gram)
+                    if tags is None:
+                        tags = self._grams[gram] = set()
+                    tags.add(tag)
+            for tag in vanished:
+                if self.spellings.pop(tag, None) is None:
+                    continue
+                del self._keys[bisect.bisect_left(self._keys, tag)]
+                for gram in _trigrams(_START + tag):
+                    tags = self._grams[gram]
+                    tags.discard(tag)
+                    if not tags:
+                        del self._grams[gram]
+            for tag, count in counts.items():
+                if tag not in self._changed:
+                    self._changed[tag] = self._counts.get(tag, 0)
+                if count:
+                    self._counts[tag] = count
+                else:
+                    self._counts.pop(tag, None)
+
+    def _usage_order(self) -> List[Tuple[int, str]]:
+        """(-count, tag) of all tags, most used first."""
+        # Caller holds the lock
+        changed, self._changed = self._changed, {}
+        if len(changed) > USAGE_RESORT_CHANGES:
+            self._by_usage = sorted((-n, tag) for tag, n in self._counts.items())
+            return self._by_usage
+        for tag, old in changed.items():
+            if old:
+                del self._by_usage[bisect.bisect_left(self._by_usage, (-old, tag))]
+            count = self._counts.get(tag)
+            if count:
+                bisect.insort(self._by_usage, (-count, tag))
+        return self._by_usage
+
+    def _most_used(
+        self, candidates: Collection[str], match: Callable[[str], bool], limit: int
+    ) -> List[str]:
+        """
+        The limit most used tags of candidates that match.
+
+        Args:
+            candidates (Collection[str]): Tags that may match
+            match (Callable[[str], bool]): Whether a candidate matches
+            limit (int): Maximum number of tags
+
+        Returns:
+            List[str]: Matching tags, most used first
+        """
+        # Caller holds the lock
+        counts = self._counts
+        if len(candidates) <= DATASET_CANDIDATES:
+            return heapq.nsmallest(
+                limit,
+                (tag for tag in candidates if match(tag)),
+                key=lambda tag: (-counts.get(tag, 0), tag),
+            )
+        ordered = (tag for _, tag in self._usage_order())
+        return list(itertools.islice(filter(match, ordered), limit))
+
+    def prefixed(self, prefix: str, limit: int) -> List[str]:
+        """The limit most used tags starting with prefix."""
+        with self._lock:
+            lo = bisect.bisect_left(self._keys, prefix)
+            hi = bisect.bisect_left(self._keys, prefix + "\U0010ffff", lo)
+            if hi - lo <= DATASET_CANDIDATES:
+                candidates: Collection[str] = self._keys[lo:hi]
+            else:
+                candidates = self._keys
+            return self._most_used(
+                candidates, lambda tag: tag.startswith(prefix), limit
+            )
+
+    def containing(self, text: str, limit: int) -> List[str]:
+        """The limit most used tags containing text but not starting with it."""
+        with self._lock:
+            if len(text) < 3:
+                candidates: Collection[str] = self._keys
+            else:
+                sets = [self._grams.get(gram) for gram in _trigrams(text)]
+                if not all(sets):
+                    return []
+                candidates = min(sets, key=len)
+            return self._most_used(
+                candidates,
+                lambda tag: text in tag and not tag.startswith(text),
+                limit,
+            )
+
+    def similar(self, text: str, exclude: Set[str]) -> List[Tuple[int, str]]:
+        """Tags whose beginning is within max_edits(len(text)) edits of text."""
+        bound = max_edits(len(text))
+        if not bound:
+            return []
+        with self._lock:
+            shared = _typo_candidates(self._grams, text, bound)
+        candidates = heapq.nlargest(
+            FUZZY_CANDIDATES,
+            ((count, tag) for tag, count in shared.items() if tag not in exclude),
+        )
+        scored = []
+        for _, tag in candidates:
+            distance = prefix_distance(text, tag, bound)
+            if distance <= bound:
+                scored.append((distance, tag))
+        return scored
+
+
+class TagVocabulary:
+    """
+    Autocomplete over the first existing of several tags files.
+
+    Args:
+        paths (Sequence[str]): Candidate tags files, the first existing one is
+            used, see read_tags_file for the formats
+
+    Notes:
+        - Reloading is serialized, queries keep using the previous vocabulary
+          until the new one is built
+        - A file failing to parse is not read again until it changes
+        - observe() merges in the tags of the dataset's sidecars
+    """
+
+    def __init__(self, paths: Sequence[str]):
+        self.paths = list(paths)
+        self._vocabulary = _Vocabulary(())
+        # Path, modification time and size of the loaded file, never equal to
+        # the result of _stat() before the first load
+        self._source: Optional[Tuple[str, int, int]] = ("", -1, -1)
+        self._lock = threading.Lock()
+        self._dataset = _DatasetTags()
+        self._tag_index: Optional[TagIndex] = None
+
+    def observe(self, tag_index: TagIndex):
+        """
+        Suggest the tags used in the dataset as well, most used first.
+
+        Args:
+            tag_index (TagIndex): Index of the dataset's tag sidecars, before
+                its start() so sidecar spellings are kept
+        """
+        self._tag_index = tag_index
+        tag_index.add_listener(self._dataset.update)
+
+    def _stat(self) -> Optional[Tuple[str, int, int]]:
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return path, st.st_mtime_ns, st.st_size
+        return None
+
+    def refresh(self) -> _Vocabulary:
+        """
+        Load the tags file if it changed since the last load.
+
+        Returns:
+            _Vocabulary: Current vocabulary, empty if no tags file exists
+        """
+        source = self._stat()
+        if source == self._source:
+            return self._vocabulary
+        with self._lock:
+            if source == self._source:
+                return self._vocabulary
+            tags: List[str] = []
+            if source is None:
+                logger.warning("No tags file found for autocomplete")
+            else:
+                try:
+                    tags = read_tags_file(source[0])
+                except (OSError, ValueError) as e:
+                    logger.error(f"Error loading tags file {source[0]}: {e}")
+            self._vocabulary = _Vocabulary(tags)
+            self._source = source
+            if source is not None:
+                logger.info(
+                    f"Loaded {len(self._vocabulary.tags)} autocomplete tags from {source[0]}"
+                )
+            return self._vocabulary
+
+    def suggest(self, query: str, limit: int = 10, fuzzy: bool = True) -> List[str]:
+        """
+        Suggest tags for what the user typed so far.
+
+        Args:
+            query (str): Partial tag
+            limit (int): Maximum number of suggestions
+            fuzzy (bool): Fill up with tags the query misspells, see
+                _Vocabulary.similar
+
+        Returns:
+            List[str]: Tags starting with the query, then tags containing it,
+                then the closest misspelled tags. In each group the dataset's
+                tags come first, most used first and spelled as in its
+                sidecars, followed by the most popular tags of the tags file
+        """
+        vocabulary = self.refresh()
+        dataset = self._dataset
+        text = normalize_tag(query)
+        if not text or limit <= 0:
+            return []
+        # A typed separator ends the word, "long " should not suggest "longer"
+        if query[-1].isspace() or query[-1] == "_":
+            text += " "
+
+        # Folded tag to suggestion, in order
+        suggestions: Dict[str, str] = {}
+
+        def add_dataset(tags: Iterable[str]):
+            for tag in tags:
+                if len(suggestions) == limit:
+                    return
+                if tag not in suggestions:
+                    suggestions[tag] = dataset.spellings.get(tag, tag)
+
+        def add_vocabulary(ids: Iterable[int]):
+            for i in ids:
+                if len(suggestions) == limit:
+                    return
+                suggestions.setdefault(vocabulary.folded[i], vocabulary.tags[i])
+
+        add_dataset(dataset.prefixed(text, limit))
+        add_vocabulary(vocabulary.prefixed(text, limit))
+        if len(suggestions) < limit:
+            add_dataset(dataset.containing(text, limit))
+            add_vocabulary(vocabulary.containing(text, limit))
+        if fuzzy and len(suggestions) < limit:
+            scored = dataset.similar(text, suggestions.keys())
+            if scored and self._tag_index is not None:
+                counts = self._tag_index.counts(tag for _, tag in scored)
+                ranked = sorted(
+                    (distance, -count, tag)
+                    for (distance, tag), count in zip(scored, counts)
+                    if count
+                )
+                add_dataset(tag for _, _, tag in ranked)
+            add_vocabulary(vocabulary.similar(text, limit, suggestions.keys()))
+        return list(suggestions.values())
@@ -0,0 +1,695 @@
+"""
+In-memory inverted index of the tags in tag sidecars.
+
+`.tags` and `.wd` sidecars hold comma-separated tag lists. Answering "images
+tagged `solo` but not `text` below folder X" used to mean reading every
+sidecar; this index maps each tag to the sorted array of ids of the images
+carrying it, so boolean queries only touch the postings of the tags involved.
+
+Every image with a tag caption gets a small integer id. Ids are assigned in
+increasing order and not reused, so postings stay sorted by appending, and
+the tags of each image are kept per caption type to update it incrementally:
+- At startup the index is loaded from the captions cached in image_caption
+- Cache fills, directory scans and caption edits replace an image's tags
+- Deleting and moving images or folders updates or drops their entries
+
+Tags are compared case-insensitively with underscores read as spaces, so
+`Long_Hair` in one sidecar and `long hair` in another are the same tag.
+
+The same updates maintain tag statistics, so curation views never read
+sidecars either:
+- Tag counts per folder subtree, rolled up to every ancestor folder below the
+  root whenever an image's tags change, like the folder statistics of
+  app.folder_tree
+- A sparse co-occurrence matrix over the whole dataset: per tag, the number
+  of images carrying it together with each other tag, its diagonal being the
+  tag count itself. Counting every pair up front costs seconds per 100k
+  images and grows with the square of the tags per image, so a tag's row is
+  counted from its postings the first time it is requested and kept current
+  from then on. Related tags within a subfolder are counted from the
+  postings each time.
+
+Listeners are told when a tag first appears in or vanishes from the dataset,
+which keeps the dataset tags offered by app.tag_autocomplete current.
+
+Query syntax, with NOT binding tighter than AND and AND tighter than OR:
+    ```
+    solo AND NOT text
+    (solo OR duo), -text, anthro*
+    "tag with AND in it" OR long hair
+    ```
+A comma means AND, a leading - means NOT, a trailing * matches every tag with
+that prefix and parentheses group. Words not separated by an operator form
+one tag, e.g. `long hair`.
+"""
+
+import bisect
+import heapq
+import logging
+import re
+import sys
+import threading
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import executors
+from .db import ConnectionManager
+
+logger = logging.getLogger("uvicorn.error")
+
+# Caption types holding comma-separated tag lists
+TAG_CAPTION_TYPES = ("tags", "wd")
+
+# image_caption rows read per batch while loading
+LOAD_BATCH_SIZE = 10000
+
+# Listener of TagIndex.add_listener: appeared tags with their spelling,
+# vanished tags and the new image count of every changed tag
+Listener = Callable[[Dict[str, str], List[str], Dict[str, int]], None]
+
+_TOKEN = re.compile(r'\(|\)|,|"[^"]*"\*?|[^\s(),"]+')
+_OPERATORS = {"AND", "OR", "NOT"}
+
+
+def normalize_tag(tag: str) -> str:
+    """Fold a tag to its indexed form: lower case, underscores as spaces."""
+    return " ".join(tag.replace("_", " ").lower().split())
+
+
+def parse_tags(caption: str) -> List[str]:
+    """
+    Split a tag caption into normalized tags.
+
+    Args:
+        caption (str): Tags separated by commas or line breaks
+
+    Returns:
+        List[str]: Distinct normalized tags in caption order
+    """
+    tags = {}
+    for part in re.split(r"[,\n]", caption):
+        tag = normalize_tag(part)
+        if tag:
+            tags[tag] = None
+    return list(tags)
+
+
+def _spellings(caption: str) -> Dict[str, str]:
+    """Map the normalized tags of a caption to their first spelling in it."""
+    spellings = {}
+    for part in re.split(r"[,\n]", caption):
+        spellings.setdefault(normalize_tag(part), part.strip())
+    return spellings
+
+
+def _prune(counts: Counter, keys: Iterable[str]):
+    """Drop the entries of keys that were counted down to zero."""
+    for key in keys:
+        if counts.get(key, 1) <= 0:
+            del counts[key]
+
+
+class TagQueryError(ValueError):
+    """A tag query could not be parsed."""
+
+
+class _Parser:
+    """Recursive descent parser producing nested tuples, see TagIndex.query."""
+
+    def __init__(self, query: str):
+        self.tokens = _TOKEN.findall(query)
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self) -> str:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self) -> tuple:
+        if not self.tokens:
+            raise TagQueryError("Tag query is empty")
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise TagQueryError(f"Unexpected {self.peek()!r} in tag query")
+        return node
+
+    def parse_or(self) -> tuple:
+        nodes = [self.parse_and()]
+        while self.peek() == "OR":
+            self.take()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and(self) -> tuple:
+        nodes = [self.parse_not()]
+        while self.peek() in ("AND", ","):
+            self.take()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not(self) -> tuple:
+        token = self.peek()
+        if token == "NOT":
+            self.take()
+            return ("not", self.parse_not())
+        if token is not None and token.startswith("-") and len(token) > 1:
+            self.tokens[self.position] = token[1:]
+            return ("not", self.parse_not())
+        if token == "(":
+            self.take()
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise TagQueryError("Unbalanced parentheses in tag query")
+            self.take()
+            return node
+        return self.parse_tag()
+
+    def parse_tag(self) -> tuple:
+        words = []
+        prefix = False
+        while True:
+            token = self.peek()
+            if token is None or token in _OPERATORS or token in "(),":
+                break
+            self.take()
+            if token.startswith('"'):
+                prefix = token.endswith("*")
+                words.append(token.rstrip("*").strip('"'))
+                break
+            if token.endswith("*"):
+                prefix = True
+                words.append(token.rstrip("*"))
+                break
+            words.append(token)
+        tag = normalize_tag(" ".join(words))
+        if not tag:
+            raise TagQueryError(
+                f"Expected a tag at {self.peek()!r}" if self.peek() else "Tag expected"
+            )
+        return ("prefix" if prefix else "tag", tag)
+
+
+class TagIndex:
+    """
+    Tags of the images below a root directory, mapped to sorted image ids.
+
+    Args:
+        root (Path): Root directory, the top of the rolled up statistics
+        db (ConnectionManager): Cache database holding image_caption
+
+    Notes:
+        - Thread-safe, updates come from executor threads
+        - Updates made while the index loads win over the loaded rows, which
+          may predate them
+    """
+
+    def __init__(self, root: Path, db: ConnectionManager):
+        self.root = str(root)
+        self.db = db
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        # Per image id: (directory, name) and its tags per caption type, None
+        # once the image was dropped
+        self._paths: List[Optional[Tuple[str, str]]] = []
+        self._tags: List[Optional[Tuple[Tuple[str, Tuple[str, ...]], ...]]] = []
+        self._ids: Dict[Tuple[str, str], int] = {}
+        self._postings: Dict[str, array] = {}
+        self._sorted_tags: Optional[List[str]] = None
+        self._directories: Dict[str, str] = {}
+        # Images updated while loading, the loaded rows are older
+        self._touched: Optional[Set[Tuple[str, str]]] = set()
+        # Statistics: tag counts and tagged images per directory subtree, and
+        # the co-occurrence matrix rows requested so far
+        self._subtree_tags: Dict[str, Counter] = {}
+        self._subtree_images: Counter = Counter()
+        self._cooccurrence: Dict[str, Counter] = {}
+        # Called with the tags appearing in and vanishing from the dataset
+        self._listeners: List[Listener] = []
+
+    def add_listener(self, listener: Listener):
+        """
+        Get notified when tags appear in or vanish from the dataset.
+
+        Args:
+            listener (Listener): Called with the tags carried by their first
+                image, mapped to their spelling in its sidecar, the tags whose
+                last image lost them, and the new number of images carrying
+                each tag whose number changed. Runs under the index lock, so
+                it must not call back into the index
+
+        Notes:
+            - Tags already indexed are passed right away, spelled normalized,
+              register before start() to get the sidecar spellings
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            if self._postings:
+                listener(
+                    {tag: tag for tag in self._postings},
+                    [],
+                    {tag: len(postings) for tag, postings in self._postings.items()},
+                )
+
+    def start(self):
+        """Load the cached tag captions in the background."""
+        executors.submit("io", self._load, priority=executors.BACKGROUND)
+
+    def _load(self):
+        placeholders = ", ".join("?" for _ in TAG_CAPTION_TYPES)
+        last = ("", "", "")
+        loaded = 0
+        try:
+            while True:
+                with self.db.reader() as conn:
+                    rows = conn.execute(
+                        f"""
+                        SELECT directory, name, caption_type, caption
+                        FROM image_caption
+                        WHERE (directory, name, caption_type) > (?, ?, ?)
+                        AND caption_type IN ({placeholders})
+                        ORDER BY directory, name, caption_type
+                        LIMIT ?
+                        """,
+                        (*last, *TAG_CAPTION_TYPES, LOAD_BATCH_SIZE),
+                    ).fetchall()
+                if not rows:
+                    break
+                last = rows[-1][:3]
+                with self._lock:
+                    for directory, name, caption_type, caption in rows:
+                        if (directory, name) not in self._touched:
+                            self._set(directory, name, caption_type, caption)
+                loaded += len(rows)
+        except Exception as e:
+            logger.error(f"Error loading the tag index: {e}")
+        finally:
+            with self._lock:
+                self._touched = None
+            self._ready.set()
+        logger.info(f"Loaded {loaded} tag captions into the tag index")
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the cached captions were loaded."""
+        return self._ready.wait(timeout)
+
+    def _intern_directory(self, directory: str) -> str:
+        return self._directories.setdefault(directory, directory)
+
+    def _set(
+        self, directory: str, name: str, caption_type: str, caption: Optional[str]
+    ):
+        # Caller holds the lock
+        key = (directory, name)
+        image_id = self._ids.get(key)
+        if image_id is None:
+            if not caption:
+                return
+            image_id = len(self._paths)
+            self._paths.append((self._intern_directory(directory), name))
+            self._tags.append(())
+            self._ids[key] = image_id
+        by_type = dict(self._tags[image_id])
+        old = set().union(*by_type.values())
+        if caption:
+            by_type[caption_type] = tuple(
+                sys.intern(tag) for tag in parse_tags(caption)
+            )
+        else:
+            by_type.pop(caption_type, None)
+        new = set().union(*by_type.values())
+        self._count(directory, old, new)
+        appeared, vanished = [], []
+        for tag in old - new:
+            postings = self._postings[tag]
+            del postings[bisect.bisect_left(postings, image_id)]
+            if not postings:
+                del self._postings[tag]
+                self._sorted_tags = None
+                vanished.append(tag)
+        for tag in new - old:
+            postings = self._postings.get(tag)
+            if postings is None:
+                postings = self._postings[tag] = array("I")
+                self._sorted_tags = None
+                appeared.append(tag)
+            if not postings or postings[-1] < image_id:
+                postings.append(image_id)
+            else:
+                postings.insert(bisect.bisect_left(postings, image_id), image_id)
+        self._tags[image_id] = tuple(by_type.items())
+        if not by_type:
+            self._drop(image_id)
+        if self._listeners and old != new:
+            # Tags only appear from the caption being set
+            spellings = _spellings(caption) if appeared else {}
+            spelled = {tag: spellings.get(tag, tag) for tag in appeared}
+            counts = {tag: len(self._postings.get(tag, ())) for tag in old ^ new}
+            for listener in self._listeners:
+                listener(spelled, vanished, counts)
+
+    def _ancestors(self, directory: str) -> List[str]:
+        """The directory and its ancestors up to the root."""
+        chain = [directory]
+        below_root = self.root.rstrip("/") + "/"
+        while directory.startswith(below_root):
+            parent = directory.rpartition("/")[0] or "/"
+            if parent == directory:
+                break
+            chain.append(parent)
+            directory = parent
+        return chain
+
+    def _count(self, directory: str, old: Set[str], new: Set[str], pairs: bool = True):
+        """Update the statistics for an image whose tags changed from old to new."""
+        # Caller holds the lock
+        removed, added = old - new, new - old
+        if not removed and not added:
+            return
+        images = bool(new) - bool(old)
+        for ancestor in self._ancestors(directory):
+            self._subtree_images[ancestor] += images
+            counts = self._subtree_tags.get(ancestor)
+            if counts is None:
+                counts = self._subtree_tags[ancestor] = Counter()
+            counts.update(added)
+            if removed:
+                counts.subtract(removed)
+                _prune(counts, removed)
+            if not counts:
+                del self._subtree_tags[ancestor]
+                del self._subtree_images[ancestor]
+        if not pairs:
+            return
+        # Only the pairs involving a removed or added tag change
+        for tag in (old | new) & self._cooccurrence.keys():
+            row = self._cooccurrence[tag]
+            if tag in removed:
+                row.subtract(old)
+                _prune(row, old)
+            elif tag in added:
+                row.update(new)
+            else:
+                row.subtract(removed)
+                _prune(row, removed)
+                row.update(added)
+
+    def _cooccurrence_row(self, tag: str) -> Counter:
+        """Co-occurrence counts of a tag, counted on first use."""
+        # Caller holds the lock
+        row = self._cooccurrence.get(tag)
+        if row is None:
+            row = Counter()
+            for image_id in self._postings.get(tag, ()):
+                row.update(self._image_tags(image_id))
+            self._cooccurrence[tag] = row
+        return row
+
+    def _drop(self, image_id: int):
+        # Caller holds the lock, the image's tags are already unlinked
+        del self._ids[self._paths[image_id]]
+        self._paths[image_id] = None
+        self._tags[image_id] = None
+
+    def _touch(self, directory: str, name: str):
+        if self._touched is not None:
+            self._touched.add((directory, name))
+
+    def update(self, directory: Path, name: str, captions: Iterable[Tuple[str, str]]):
+        """
+        Replace the tags of an image.
+
+        Args:
+            directory (Path): Directory containing the image
+            name (str): Image file name
+            captions (Iterable[Tuple[str, str]]): All (caption type, text)
+                pairs of the image, types other than TAG_CAPTION_TYPES are
+                ignored
+        """
+        captions = dict(c for c in captions if c[0] in TAG_CAPTION_TYPES)
+        with self._lock:
+            self._touch(str(directory), name)
+            image_id = self._ids.get((str(directory), name))
+            if image_id is not None:
+                for caption_type, _ in self._tags[image_id]:
+                    captions.setdefault(caption_type, None)
+            for caption_type, caption in captions.items():
+                self._set(str(directory), name, caption_type, caption)
+
+    def set_caption(
+        self, directory: Path, name: str, caption_type: str, caption: Optional[str]
+    ):
+        """Replace (or with None, remove) one caption of an image."""
+        if caption_type not in TAG_CAPTION_TYPES:
+            return
+        with self._lock:
+            self._touch(str(directory), name)
+            self._set(str(directory), name, caption_type, caption)
+
+    def remove(self, path: Path):
+        """Drop an image, or every image below a directory."""
+        with self._lock:
+            for image_id in self._subtree_ids(path):
+                directory, name = self._paths[image_id]
+                self._touch(directory, name)
+                for caption_type, _ in self._tags[image_id]:
+                    self._set(directory, name, caption_type, None)
+
+    def discard(self, directory: Path, names: Iterable[str]):
+        """
+        Drop images of a directory whose files are gone.
+
+        Args:
+            directory (Path): Directory containing the images
+            names (Iterable[str]): Image file names, unknown ones are ignored
+
+        Notes:
+            - Unlike remove, never falls back to a subtree walk, so it is cheap
+              for names the index never held
+        """
+        with self._lock:
+            for name in names:
+                image_id = self._ids.get((str(directory), name))
+                if image_id is None:
+                    continue
+                self._touch(str(directory), name)
+                for caption_type, _ in self._tags[image_id]:
+                    self._set(str(directory), name, caption_type, None)
+
+    def move(self, source: Path, target: Path):
+        """Re-key an image, or every image below a directory, after a move."""
+        with self._lock:
+            self.remove(target)
+            for image_id in self._subtree_ids(source):
+                directory, name = self._paths[image_id]
+                path = target / Path(directory, name).relative_to(source)
+                del self._ids[(directory, name)]
+                key = (self._intern_directory(str(path.parent)), path.name)
+                # A move changes the subtree counts but not the co-occurrences
+                tags = self._image_tags(image_id)
+                self._count(directory, tags, set(), pairs=False)
+                self._count(key[0], set(), tags, pairs=False)
+                self._paths[image_id] = key
+                self._ids[key] = image_id
+                self._touch(*key)
+
+    def _subtree_ids(self, path: Path) -> List[int]:
+        # Caller holds the lock
+        image_id = self._ids.get((str(path.parent), path.name))
+        if image_id is not None:
+            return [image_id]
+        base = str(path).rstrip("/") + "/"
+        return [
+            image_id
+            for (directory, _), image_id in self._ids.items()
+            if directory == str(path) or directory.startswith(base)
+        ]
+
+    def _image_tags(self, image_id: int) -> Set[str]:
+        # Caller holds the lock
+        return set().union(*(tags for _, tags in self._tags[image_id]))
+
+    def top_tags(self, directory: Optional[Path] = None, limit: int = 50) -> Dict:
+        """
+        Most frequent tags of a folder subtree.
+
+        Args:
+            directory (Optional[Path]): Folder, the root by default
+            limit (int): Number of tags to return
+
+        Returns:
+            Dict: "images" carrying any tag in the subtree, and "tags" as
+                [{"tag", "count"}] most frequent first
+        """
+        directory = str(directory) if directory is not None else self.root
+        with self._lock:
+            counts = self._subtree_tags.get(directory, {})
+            top = heapq.nsmallest(
+                limit, counts.items(), key=lambda item: (-item[1], item[0])
+            )
+            images = self._subtree_images.get(directory, 0)
+        return {
+            "images": images,
+            "tags": [{"tag": tag, "count": count} for tag, count in top],
+        }
+
+    def related_tags(
+        self, tag: str, directory: Optional[Path] = None, limit: int = 20
+    ) -> Dict:
+        """
+        Tags most often found on the same images as a tag.
+
+        Args:
+            tag (str): Tag, normalized before lookup
+            directory (Optional[Path]): Only count images of this folder
+                subtree, the root by default
+            limit (int): Number of related tags to return
+
+        Returns:
+            Dict: The normalized "tag", the "count" of images carrying it and
+                "related" as [{"tag", "count", "ratio"}], count being the
+                images carrying both tags and ratio the share of the tag's
+                images that do, most frequent first
+
+        Notes:
+            - For the root the co-occurrence matrix row is read, counting it
+              first if it was never requested; for a subfolder the tags of the
+              tag's images in it are counted
+        """
+        tag = normalize_tag(tag)
+        with self._lock:
+            if directory is None or str(directory) == self.root:
+                row = self._cooccurrence_row(tag)
+            else:
+                base = str(directory).rstrip("/") + "/"
+                row = Counter()
+                for image_id in self._postings.get(tag, ()):
+                    image_directory = self._paths[image_id][0]
+                    if image_directory == str(directory) or image_directory.startswith(
+                        base
+                    ):
+                        row.update(self._image_tags(image_id))
+            count = row.get(tag, 0)
+            top = heapq.nsmallest(
+                limit + 1, row.items(), key=lambda item: (-item[1], item[0])
+            )
+        related = [
+            {"tag": other, "count": n, "ratio": n / count}
+            for other, n in top
+            if other != tag
+        ]
+        return {"tag": tag, "count": count, "related": related[:limit]}
+
+    def counts(self, tags: Iterable[str]) -> List[int]:
+        """Number of images carrying each of the tags, in the whole dataset."""
+        with self._lock:
+            return [len(self._postings.get(tag, ())) for tag in tags]
+
+    def tags(self) -> List[str]:
+        """All indexed tags, sorted."""
+        with self._lock:
+            if self._sorted_tags is None:
+                self._sorted_tags = sorted(self._postings)
+            return self._sorted_tags
+
+    def _evaluate(self, node: tuple) -> Tuple[Set[int], bool]:
+        """Evaluate a parsed query to (image ids, negated)."""
+        kind, value = node
+        if kind == "tag":
+            return set(self._postings.get(value, ())), False
+        if kind == "prefix":
+            tags = self.tags()
+            ids = set()
+            for tag in tags[bisect.bisect_left(tags, value) :]:
+                if not tag.startswith(value):
+                    break
+                ids.update(self._postings[tag])
+            return ids, False
+        if kind == "not":
+            ids, negated = self._evaluate(value)
+            return ids, not negated
+        # Negated operands are kept as complements, the universe of all images
+        # is only needed if the whole query is negated
+        results = [self._evaluate(child) for child in value]
+        positive = [ids for ids, negated in results if not negated]
+        negative = [ids for ids, negated in results if negated]
+        if kind == "and":
+            if positive:
+                ids = set.intersection(*positive)
+                for excluded in negative:
+                    ids -= excluded
+                return ids, False
+            return set.union(*negative), True
+        if negative:
+            # OR of complements is the complement of their intersection
+            ids = set.intersection(*negative)
+            for included in positive:
+                ids -= included
+            return ids, True
+        return set.union(*positive), False
+
+    def query(
+        self, query: str, directory: Optional[Path] = None
+    ) -> List[Tuple[str, str]]:
+        """
+        Find the images matching a tag query.
+
+        Args:
+            query (str): Tag query, see the module documentation
+            directory (Optional[Path]): Only match images in this directory
+                and its subdirectories
+
+        Returns:
+            List[Tuple[str, str]]: (directory, name) of the matching images,
+                sorted by path
+
+        Raises:
+            TagQueryError: If the query cannot be parsed
+        """
+        node = _Parser(query).parse()
+        with self._lock:
+            ids, negated = self._evaluate(node)
+            if negated:
+                ids = {
+                    image_id
+                    for image_id, path in enumerate(self._paths)
+                    if path is not None and image_id not in ids
+                }
+            paths = [self._paths[image_id] for image_id in ids]
+        if directory is not None:
+            base = str(directory).rstrip("/") + "/"
+            paths = [
+                path
+                for path in paths
+                if path[0] == str(directory) or path[0].startswith(base)
+            ]
+        paths.sort()
+        return paths
+
+    def stats(self) -> Dict:
+        """
+        Report the size of the index.
+
+        Returns:
+            Dict: Statistics
+                - images: Images with tags
+                - tags: Distinct tags
+                - postings: Image-tag pairs
+                - cooccurrences: Entries of the co-occurrence rows counted so
+                  far
+                - ready: Whether the cached captions were loaded
+        """
+        with self._lock:
+            return {
+                "images": len(self._ids),
+                "tags": len(self._postings),
+                "postings": sum(len(p) for p in self._postings.values()),
+                "cooccurrences": sum(len(r) for r in self._cooccurrence.values()),
+                "ready": self._ready.is_set(),
+            }
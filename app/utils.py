@@ -5,7 +5,8 @@ This module provides helper functions for common operations like:
 - File name sanitization
 - Human-readable size formatting
 - Path safety validation
-- Path resolution with security checks
+- Path resolution with security checks, optionally cached for remote file
+  systems
 
 These utilities are used throughout the application to ensure consistent
 handling of files and paths while maintaining security.
@@ -13,8 +14,14 @@ handling of files and paths while maintaining security.
 
 import re
 from pathlib import Path
+from typing import Optional
 from fastapi import HTTPException
 
+from .remote_fs import ExpiringCache
+
+# Cache of resolved request paths, only enabled in remote file system mode
+_resolve_cache: Optional[ExpiringCache] = None
+
 
 def get_safe_filename(filename: str) -> str:
     """
@@ -95,11 +102,35 @@ def resolve_path(path: str, root: Path) -> Path:
         - Handles empty paths as root directory
         - Prevents directory traversal
         - Resolves symlinks
+        - Results are reused when enable_resolve_cache() was called
     """
     if path in {"", "/"}:
         return root
-    resolved_path = (root / path).resolve()
+    if _resolve_cache is not None:
+        resolved_path = _resolve_cache.get((root, path))
+        if resolved_path is None:
+            resolved_path = (root / path).resolve()
+            _resolve_cache.set((root, path), resolved_path)
+    else:
+        resolved_path = (root / path).resolve()
     if resolved_path.is_relative_to(root):
         return resolved_path
     else:
         raise HTTPException(status_code=403, detail="Access denied")
+
+
+def enable_resolve_cache(ttl: float) -> None:
+    """
+    Cache resolve_path results for `ttl` seconds.
+
+    Args:
+        ttl (float): Seconds a resolved path is reused
+
+    Notes:
+        - Path.resolve() issues one lstat per path component, a round trip each
+          on network file systems
+        - Only symlink changes can make a cached result stale, the lexical part
+          of a resolved path never changes
+    """
+    global _resolve_cache
+    _resolve_cache = ExpiringCache(ttl)
@@ -0,0 +1,111 @@
+"""
+Micro-benchmark: tag autocomplete over a large vocabulary.
+
+Builds a vocabulary of synthetic tags from the words of the Florence2 tags
+file, as large as a big booru tag list, and times app.tag_autocomplete for
+prefix queries, substring queries and misspelled queries answered by the
+fuzzy mode. The linear filter the endpoint used before is timed for
+comparison.
+
+Usage:
+    python -m benchmarks.bench_autocomplete [tags] [queries]
+"""
+
+import random
+import sys
+import time
+from pathlib import Path
+
+from app.tag_autocomplete import TagVocabulary, _Vocabulary, read_tags_file
+
+TAGS_FILE = (
+    Path(__file__).resolve().parent.parent
+    / "app/caption_generation/plugins/florence2/tags.json"
+)
+
+
+def make_tags(count: int, rng: random.Random) -> list:
+    tags = read_tags_file(str(TAGS_FILE))
+    words = sorted({word for tag in tags for word in tag.split("_") if word})
+    seen = set(tags)
+    while len(tags) < count:
+        tag = "_".join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        if tag not in seen:
+            seen.add(tag)
+            tags.append(tag)
+    return tags[:count]
+
+
+def misspell(tag: str, rng: random.Random) -> str:
+    chars = list(tag.replace("_", " "))
+    for _ in range(1 if len(chars) < 8 else 2):
+        i = rng.randrange(len(chars))
+        edit = rng.choice(("drop", "swap", "replace"))
+        if edit == "drop" and len(chars) > 4:
+            del chars[i]
+        elif edit == "swap" and i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+        else:
+            chars[i] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+    return "".join(chars)
+
+
+def linear(tags: list, query: str, limit: int) -> list:
+    q = query.lower()
+    starts_with = [tag for tag in tags if tag.lower().startswith(q)]
+    contains = [
+        tag for tag in tags if q in tag.lower() and not tag.lower().startswith(q)
+    ]
+    return (starts_with + contains)[:limit]
+
+
+def timed(label: str, func, queries: list, expected: list):
+    start = time.perf_counter()
+    results = [func(query) for query in queries]
+    elapsed = time.perf_counter() - start
+    found = sum(tag in result for tag, result in zip(expected, results))
+    print(
+        f"{label:28s} {elapsed / len(queries) * 1e3:8.3f} ms/query"
+        f"  (intended tag suggested for {found}/{len(queries)})"
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = random.Random(0)
+    tags = make_tags(count, rng)
+
+    vocabulary = TagVocabulary([])
+    start = time.perf_counter()
+    vocabulary._vocabulary = _Vocabulary(tags)
+    print(f"{len(tags)} tags indexed in {time.perf_counter() - start:.2f}s")
+    # Keep the benchmark on the in-memory lookups
+    vocabulary.refresh = lambda: vocabulary._vocabulary
+
+    sample = rng.sample(tags, n)
+    long_tags = [tag for tag in sample if len(tag) > 6]
+    prefixes = [tag[: rng.randint(2, len(tag))] for tag in sample]
+    infixes = [tag[len(tag) // 3 :][:6] for tag in long_tags]
+    typos = [misspell(tag, rng) for tag in long_tags]
+
+    def exact(query):
+        return vocabulary.suggest(query, 10, fuzzy=False)
+
+    def fuzzy(query):
+        return vocabulary.suggest(query, 10)
+
+    timed(
+        "linear filter (prefix)",
+        lambda q: linear(tags, q, 10),
+        prefixes[:50],
+        sample[:50],
+    )
+    timed("prefix", exact, prefixes, sample)
+    timed("substring", exact, infixes, long_tags)
+    timed("misspelled, exact only", exact, typos, long_tags)
+    timed("misspelled, fuzzy", fuzzy, typos, long_tags)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Benchmark: directory scanning with Path.iterdir() + stat vs. os.scandir.
+
+Either point it at an existing directory (e.g. on an NFS mount) or let it
+create a synthetic one with the given number of entries: images with a
+`.tags` and a `.caption` sidecar each, plus a few subdirectories.
+
+Usage:
+    python -m benchmarks.bench_scan --create 100000
+    python -m benchmarks.bench_scan --path /mnt/nfs/dataset/folder
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+
+from natsort import os_sort_keygen as natsort_keygen
+
+from app.data_access import (
+    CAPTION_EXTENSIONS,
+    IMAGE_EXTENSIONS,
+    CachedFileSystemDataSource,
+    _stat_entries,
+)
+from app.models import DirectoryModel
+
+
+def legacy_scan(directory: Path):
+    """The Path.iterdir() + entry.stat() scanner that os.scandir replaced."""
+    dir_entries = list()
+    img_entries = list()
+    mtimes = dict()
+    all_side_car_files = defaultdict(dict)
+    for entry in directory.iterdir():
+        name = entry.name
+        if name.startswith("."):
+            continue
+        stat = entry.stat()
+        st_mode = stat.st_mode
+
+        if S_ISDIR(st_mode):
+            dir_entries.append(
+                DirectoryModel(
+                    name=name,
+                    mtime=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                )
+            )
+        elif S_ISREG(st_mode):
+            suffix = entry.suffix.lower()
+            if suffix in IMAGE_EXTENSIONS:
+                stem = entry.stem
+                img_entries.append(
+                    {"name": name, "stem": stem, "type": "image", "size": stat.st_size}
+                )
+                mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
+            elif suffix in CAPTION_EXTENSIONS:
+                stem = entry.stem
+                all_side_car_files[stem][suffix] = name
+                mtimes[stem] = max(stat.st_mtime, mtimes.get(stem, 0))
+
+    for entry in img_entries:
+        side_car_files = all_side_car_files.get(entry["stem"], {})
+        entry["captions"] = {
+            k: v for k, v in side_car_files.items() if k in CAPTION_EXTENSIONS
+        }
+        entry["metadata"] = {}
+        entry["mtime"] = datetime.fromtimestamp(mtimes[entry["stem"]], tz=timezone.utc)
+
+    dir_entries.sort(key=natsort_keygen(lambda x: x.name))
+    img_entries.sort(key=natsort_keygen(lambda x: x["name"]))
+    return dir_entries, img_entries
+
+
+def populate(directory: Path, count: int):
+    images = count // 3
+    for i in range(images):
+        for suffix in (".png", ".tags", ".caption"):
+            (directory / f"{i:07d}{suffix}").touch()
+    for i in range(count - images * 3):
+        (directory / f"dir{i:04d}").mkdir()
+
+
+def timed(label: str, func, repeat: int):
+    """Print the best wall time of `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:30s} {best * 1000:10.1f} ms (best of {repeat})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--path", type=Path, help="existing directory to scan")
+    group.add_argument("--create", type=int, help="entries to create in a temp dir")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.path
+        if directory is None:
+            directory = Path(tmp) / "dataset"
+            directory.mkdir()
+            populate(directory, args.create)
+
+        source = CachedFileSystemDataSource(
+            directory, (300, 300), (1024, 1024), db_path=str(Path(tmp) / "cache.db")
+        )
+        # Listing and stat only, this is the part that hits the file system
+        timed(
+            "list: iterdir + stat",
+            lambda: [entry.stat() for entry in directory.iterdir()],
+            args.repeat,
+        )
+        timed(
+            "list: scandir + batched stat",
+            lambda: _stat_entries(list(os.scandir(directory))),
+            args.repeat,
+        )
+        # Full scans including grouping and natural sorting
+        timed("scan: iterdir + stat", lambda: legacy_scan(directory), args.repeat)
+        timed(
+            "scan: scandir + batched stat",
+            lambda: source._scan_directory(directory),
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
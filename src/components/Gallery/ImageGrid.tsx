@@ -356,6 +356,10 @@ export const ImageItem = (props: {
         "multi-selected": isMultiSelected(),
         loading: isLoading()
       }}
+      style={{
+        // Paint the placeholder color until the thumbnail has loaded
+        "background-color": isLoading() ? props.item()?.placeholder ?? undefined : undefined,
+      }}
       onClick={handleClick}
       draggable={true}
       onDragStart={handleDragStart}
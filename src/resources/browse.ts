@@ -80,6 +80,7 @@ export interface ImageData extends BaseData {
   height: number;   // Image height in pixels
   captions: Captions; // Associated captions
   favorite_state?: number; // Favorite state (0-6)
+  placeholder?: string | null; // Dominant color shown until the thumbnail loads
 }
 
 /**